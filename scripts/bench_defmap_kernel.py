@@ -0,0 +1,61 @@
+"""Micro-benchmark of the post-flow DefMap stage.
+
+Run via ``python scripts/bench_defmap_kernel.py [--size 2048] [--repeat 20]``.
+Compares the reference path (blur the flow components, ``derive_metrics`` with
+``np.gradient``, copy into the stack) with :class:`btflow.defmap.MetricKernel`
+writing into the same preallocated stack slot, for one and for all metrics.
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT / "src"))
+
+from btflow.defmap import METRICS, MetricKernel, derive_metrics  # noqa: E402
+
+
+def _time(fn: Callable[[], object], repeat: int) -> float:
+    fn()  # warm-up
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t0) / repeat * 1e3
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=2048, help="Flow field edge length.")
+    parser.add_argument("--repeat", type=int, default=20, help="Timed iterations.")
+    parser.add_argument("--sigma", type=float, default=1.5, help="Smoothing sigma.")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    flow = rng.normal(0, 2, size=(args.size, args.size, 2)).astype(np.float32)
+    print(f"{'metrics':<20} {'reference [ms]':>15} {'kernel [ms]':>12} {'speed-up':>9}")
+    for metrics in (("div",), ("div", "mag"), METRICS):
+        out = {m: np.empty((args.size, args.size), dtype=np.float32) for m in metrics}
+
+        def reference(metrics: tuple[str, ...] = metrics, out: dict = out) -> None:
+            vx = cv2.GaussianBlur(flow[..., 0], (0, 0), sigmaX=args.sigma)
+            vy = cv2.GaussianBlur(flow[..., 1], (0, 0), sigmaX=args.sigma)
+            for metric, data in derive_metrics(vx, vy, metrics).items():
+                out[metric][...] = data
+
+        kernel = MetricKernel(flow.shape[:2], metrics, args.sigma)
+        ref_ms = _time(reference, args.repeat)
+        kern_ms = _time(lambda kernel=kernel, out=out: kernel(flow, out), args.repeat)
+        print(f"{','.join(metrics):<20} {ref_ms:>15.1f} {kern_ms:>12.1f} {ref_ms / kern_ms:>8.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
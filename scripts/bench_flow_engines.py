@@ -0,0 +1,41 @@
+"""Compare optical-flow engines on synthetic frames with known flow.
+
+Run via ``python scripts/bench_flow_engines.py [--size 512] [--pairs 5]``.
+Prints frames/s and mean endpoint error (px) for every engine preset that is
+available in the installed OpenCV build; TV-L1 needs opencv-contrib-python.
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT / "src"))
+
+from btflow.flow import ENGINES, benchmark_engines  # noqa: E402
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=512, help="Frame edge length in pixels.")
+    parser.add_argument("--pairs", type=int, default=5, help="Frame pairs per engine.")
+    args = parser.parse_args()
+
+    print(f"{'engine':<10} {'preset':<10} {'fps':>8} {'EPE [px]':>9}")
+    for engine, spec in ENGINES.items():
+        for preset in spec.presets:
+            try:
+                (row,) = benchmark_engines(
+                    [(engine, preset)], size=(args.size, args.size), n_pairs=args.pairs
+                )
+            except RuntimeError as exc:
+                print(f"{engine:<10} {preset:<10} skipped: {exc}")
+                continue
+            print(f"{engine:<10} {preset:<10} {row['fps']:>8.1f} {row['epe']:>9.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
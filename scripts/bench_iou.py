@@ -0,0 +1,110 @@
+"""Micro-benchmark of pairwise IoU computation.
+
+Run via ``python scripts/bench_iou.py [--boxes 5 50 500] [--frames 200]``.
+Compares the double Python loop over :func:`btflow.iou.calculate_iou` with
+:func:`btflow.iou.calculate_iou_matrix` for one frame of ``N x N`` boxes, and
+a per-frame loop over the matrix function with a single
+:func:`btflow.iou.calculate_iou_batch` call over ``--frames`` padded frames.
+Finally it times :func:`btflow.iou.sparse_iou` with the dense matrix and with
+the sort-and-sweep index on frames of constant box density (``--dense``
+boxes), which locates the crossover used by ``method="auto"``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT / "src"))
+
+from btflow.iou import (  # noqa: E402
+    SWEEP_MIN_PAIRS,
+    calculate_iou,
+    calculate_iou_batch,
+    calculate_iou_matrix,
+    pad_boxes,
+    sparse_iou,
+)
+
+
+def _time(fn: Callable[[], object], repeat: int) -> float:
+    fn()  # warm-up
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t0) / repeat * 1e3
+
+
+def _boxes(rng: np.random.Generator, n: int, size: int = 2048) -> np.ndarray:
+    xy = rng.integers(0, size, size=(n, 2))
+    wh = rng.integers(8, 64, size=(n, 2))
+    return np.concatenate([xy, wh], axis=1)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--boxes", type=int, nargs="+", default=[5, 20, 50, 200, 500])
+    parser.add_argument("--frames", type=int, default=200, help="Frames for the batched run.")
+    parser.add_argument(
+        "--dense",
+        type=int,
+        nargs="+",
+        default=[20, 50, 100, 200, 500, 1000, 2000, 5000],
+        help="Boxes per frame for the sparse comparison.",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Timed iterations.")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'boxes':>6} {'loop [ms]':>11} {'matrix [ms]':>12} {'speed-up':>9}")
+    for n in args.boxes:
+        a, b = _boxes(rng, n), _boxes(rng, n)
+        tuples_a = [tuple(int(v) for v in box) for box in a]
+        tuples_b = [tuple(int(v) for v in box) for box in b]
+
+        def loop(ta: list = tuples_a, tb: list = tuples_b) -> None:
+            [[calculate_iou(p, q) for q in tb] for p in ta]
+
+        loop_ms = _time(loop, args.repeat)
+        matrix_ms = _time(lambda a=a, b=b: calculate_iou_matrix(a, b), args.repeat)
+        print(f"{n:>6} {loop_ms:>11.1f} {matrix_ms:>12.2f} {loop_ms / matrix_ms:>8.0f}x")
+
+    print(f"\n{'frames x boxes':>15} {'per-frame [ms]':>15} {'batch [ms]':>11} {'speed-up':>9}")
+    for n in args.boxes:
+        frames_a = [_boxes(rng, int(k)) for k in rng.integers(n // 2, n + 1, args.frames)]
+        frames_b = [_boxes(rng, int(k)) for k in rng.integers(n // 2, n + 1, args.frames)]
+        boxes_a, _ = pad_boxes(frames_a)
+        boxes_b, _ = pad_boxes(frames_b)
+
+        def per_frame(fa: list = frames_a, fb: list = frames_b) -> None:
+            for a, b in zip(fa, fb, strict=True):
+                calculate_iou_matrix(a, b)
+
+        frame_ms = _time(per_frame, args.repeat)
+        batch_ms = _time(lambda a=boxes_a, b=boxes_b: calculate_iou_batch(a, b), args.repeat)
+        label = f"{args.frames} x {n}"
+        print(f"{label:>15} {frame_ms:>15.1f} {batch_ms:>11.1f} {frame_ms / batch_ms:>8.1f}x")
+
+    print(f"\n{'boxes':>6} {'pairs':>10} {'dense [ms]':>11} {'sweep [ms]':>11} {'speed-up':>9}")
+    for n in args.dense:
+        # Frame area grows with the box count: about one box per 100 x 100 px.
+        a = _boxes(rng, n, size=int(100 * np.sqrt(n)))
+        b = a + rng.integers(-5, 6, size=a.shape)
+        dense_ms = _time(lambda a=a, b=b: sparse_iou(a, b, "dense"), args.repeat)
+        sweep_ms = _time(lambda a=a, b=b: sparse_iou(a, b, "sweep"), args.repeat)
+        auto = "  <- auto: sweep" if n * n > SWEEP_MIN_PAIRS else ""
+        print(
+            f"{n:>6} {n * n:>10} {dense_ms:>11.2f} {sweep_ms:>11.2f} "
+            f"{dense_ms / sweep_ms:>8.1f}x{auto}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,104 @@
+"""Sidecar manifests that make long stack-building runs resumable.
+
+A :class:`StackManifest` lives next to an on-disk ``.npy`` stack (as
+``<stem>.manifest.json``) and records which time indices of that stack have
+been written and flushed. It also stores the run parameters, so a restart can
+refuse to resume a stack that was produced with different settings.
+
+The manifest is rewritten atomically (temp file + ``os.replace``) and only
+after the stack's pages have been flushed, so a crash at any point leaves a
+manifest that never claims more than what is on disk.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import time
+from collections.abc import Callable, Iterable
+from pathlib import Path
+from typing import Any
+
+# Rewrite the manifest at most this often while pairs keep completing.
+CHECKPOINT_SECONDS = 10.0
+
+
+def manifest_path(stack_path: Path) -> Path:
+    """Return the sidecar manifest path for ``stack_path``."""
+    return stack_path.with_suffix(".manifest.json")
+
+
+class StackManifest:
+    """Record of completed indices for one on-disk stack.
+
+    Args:
+        path: Manifest file location (see :func:`manifest_path`).
+        meta: JSON-serialisable run parameters the stack was produced with.
+        done: Indices already known to be complete.
+        flush: Called before every save to push the stack's data to disk.
+        interval: Minimum seconds between saves triggered by :meth:`mark`.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        meta: dict[str, Any],
+        done: Iterable[int] = (),
+        flush: Callable[[], None] | None = None,
+        interval: float = CHECKPOINT_SECONDS,
+    ) -> None:
+        self.path = path
+        self.meta = meta
+        self.done: set[int] = set(done)
+        self._flush = flush
+        self._interval = interval
+        self._last_save = time.monotonic()
+
+    @staticmethod
+    def read_done(path: Path, meta: dict[str, Any]) -> set[int]:
+        """Load the completed indices recorded at ``path``.
+
+        Returns an empty set when no manifest exists. Raises ``ValueError`` if
+        the manifest was written for different run parameters.
+        """
+        if not path.exists():
+            return set()
+        record = json.loads(path.read_text())
+        # Round-trip ``meta`` through JSON so tuples compare equal to lists.
+        if record.get("meta") != json.loads(json.dumps(meta)):
+            raise ValueError(
+                f"{path} was written with different parameters; "
+                "remove it (and its stack) or rerun without resuming"
+            )
+        return {int(i) for i in record.get("done", [])}
+
+    def mark(self, *indices: int) -> None:
+        """Record ``indices`` as complete, saving if the checkpoint interval elapsed."""
+        self.done.update(indices)
+        if time.monotonic() - self._last_save >= self._interval:
+            self.save()
+
+    def save(self) -> None:
+        """Flush the stack, then atomically rewrite the manifest."""
+        if self._flush is not None:
+            self._flush()
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps({"meta": self.meta, "done": sorted(self.done)}))
+        os.replace(tmp, self.path)
+        self._last_save = time.monotonic()
+
+
+def pending_runs(done: set[int], n: int) -> list[tuple[int, int]]:
+    """Return contiguous ``(start, stop)`` runs of indices in ``range(n)`` not in ``done``."""
+    runs: list[tuple[int, int]] = []
+    start: int | None = None
+    for i in range(n):
+        if i in done:
+            if start is not None:
+                runs.append((start, i))
+                start = None
+        elif start is None:
+            start = i
+    if start is not None:
+        runs.append((start, n))
+    return runs
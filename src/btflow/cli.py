@@ -7,7 +7,7 @@ import sys
 from collections.abc import Sequence
 
 from . import __version__, defmap, lagcorr, match_labels, rgb_stack
-from .plots import confidence_kde, heatmap, iou_boxplot
+from .plots import confidence_kde, defmap_video, heatmap, iou_boxplot
 
 
 def build_parser() -> argparse.ArgumentParser:
@@ -28,6 +28,7 @@ def build_parser() -> argparse.ArgumentParser:
     confidence_kde.register(subparsers)
     heatmap.register(subparsers)
     iou_boxplot.register(subparsers)
+    defmap_video.register(subparsers)
 
     return parser
 
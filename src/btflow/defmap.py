@@ -1,64 +1,605 @@
-"""Build per-z DefMap stacks from RGB time-lapse frames via Farnebäck optical flow.
+"""Build per-z DefMap stacks from RGB time-lapse frames via dense optical flow.
 
 For each z-slice in the input directory, dense optical flow is computed between
-consecutive frames using ``cv2.calcOpticalFlowFarneback``. The resulting flow
-field is reduced either to its **divergence** (``div``: ``∂vx/∂x + ∂vy/∂y``)
-or its **magnitude** (``mag``: ``√(vx² + vy²)``) and saved as a NumPy stack.
+consecutive frames, by default with ``cv2.calcOpticalFlowFarneback`` and the
+thesis parameters (other engines are listed in :mod:`btflow.flow`). Each frame is
+decoded once by a prefetching :class:`~btflow.frames.FrameSource` and slid
+through a two-frame window. The smoothed flow field ``(vx, vy)`` is reduced to
+one or more derived maps, all from the same flow computation:
+
+- ``div``: divergence ``∂vx/∂x + ∂vy/∂y``
+- ``mag``: magnitude ``√(vx² + vy²)``
+- ``curl``: vorticity ``∂vy/∂x - ∂vx/∂y`` (pixel coordinates, y pointing down)
+- ``shear``: shear-rate magnitude ``√((∂vx/∂x - ∂vy/∂y)² + (∂vx/∂y + ∂vy/∂x)²)``
+
+Each metric is saved as its own ``defmap_stack_Z{z}_{metric}.npy`` stack.
+
+With ``append`` an existing stack is extended with the pairs of newly arrived
+frames only, and :func:`watch_defmap_stacks` keeps stacks current while an
+acquisition is still writing frames.
+
+With ``workers > 1`` the ``(z, t)`` pair space is split into contiguous time
+shards that are processed in a process pool. Each shard re-reads the one frame
+it shares with its neighbour, so the reassembled stacks are identical to a
+serial run.
 """
 
 from __future__ import annotations
 
 import argparse
+import math
+import os
+import time
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack, suppress
+from dataclasses import dataclass
+from functools import partial
+from multiprocessing import get_context
 from pathlib import Path
+from typing import Any
 
 import cv2
-import matplotlib.pyplot as plt
 import numpy as np
 from tqdm import tqdm
 
-from .io import group_frames_by_z_t, imread
-
-# Farnebäck parameters used throughout the thesis.
-FLOW_KWARGS: dict[str, float | int] = {
-    "pyr_scale": 0.5,
-    "levels": 3,
-    "winsize": 15,
-    "iterations": 3,
-    "poly_n": 5,
-    "poly_sigma": 1.2,
-    "flags": 0,
-}
+from .checkpoint import StackManifest, manifest_path, pending_runs
+from .flow import (
+    DEFAULT_ENGINE,
+    ENGINES,
+    WarmStartFlow,
+    engine_params,
+    farneback,
+    make_engine,
+)
+from .flow import FLOW_KWARGS as FLOW_KWARGS  # re-export; it used to live here
+from .flowcache import DEFAULT_MAX_BYTES, FlowCache, file_digest
+from .frames import DOWNSCALES, FrameSource, read_plane
+from .io import group_frames_by_z_t
+from .preview import DEFAULT_FPS, PngPreviewWriter, VideoPreviewWriter, render_stack_video
+from .stackio import QUANTIZE, SUFFIX, ChunkedStack, grow_npy, save_chunked
+
+METRICS: tuple[str, ...] = ("div", "mag", "curl", "shear")
+STACK_FORMATS: tuple[str, ...] = ("npy", "chunked")
 
 CMAP = "coolwarm"
 VMAX_DIV = 4.0
 VMAX_MAG = 4.0
+VMAX_CURL = 4.0
+VMAX_SHEAR = 4.0
 
+# Colour-scale limits for previews; signed metrics are centred on zero.
+CLIP_RANGES: dict[str, tuple[float, float]] = {
+    "div": (-VMAX_DIV, VMAX_DIV),
+    "mag": (0.0, VMAX_MAG),
+    "curl": (-VMAX_CURL, VMAX_CURL),
+    "shear": (0.0, VMAX_SHEAR),
+}
 
-def build_defmap_stack(
+
+@dataclass(frozen=True)
+class _PairParams:
+    """Per-pair settings shipped to pool workers alongside each shard."""
+
+    metrics: tuple[str, ...]
+    sigma: float
+    channel: int | None
+    crop: tuple[int, int, int, int] | None
+    save_png: bool
+    out_dir: Path
+    cache_dir: Path | None = None
+    cache_bytes: int = DEFAULT_MAX_BYTES
+    flow_engine: str = DEFAULT_ENGINE
+    flow_preset: str | None = None
+    warm_start: bool = False
+    flow_tile: int | None = None
+    downscale: int = 1
+    upsample_to: tuple[int, int] | None = None
+
+    def flow_spec(self) -> dict[str, Any]:
+        """Everything the raw flow depends on besides the two frames."""
+        return {
+            "channel": self.channel,
+            "crop": self.crop,
+            "engine": self.flow_engine,
+            "flow": engine_params(self.flow_engine, self.flow_preset),
+            "warm_start": self.warm_start,
+            "tile": self.flow_tile,
+            "downscale": self.downscale,
+        }
+
+
+def derive_metrics(
+    vx: np.ndarray, vy: np.ndarray, metrics: Sequence[str], spacing: float = 1.0
+) -> dict[str, np.ndarray]:
+    """Reduce a flow field to the requested DefMap metrics.
+
+    Spatial derivatives (``np.gradient``) are computed at most once each and
+    shared between metrics.
+
+    Args:
+        vx: Horizontal flow component, shape ``(H, W)``.
+        vy: Vertical flow component, shape ``(H, W)``.
+        metrics: Names from :data:`METRICS`.
+        spacing: Grid spacing of the flow field in the units of ``vx``/``vy``
+            (e.g. ``2`` for a half-resolution field in full-resolution pixels).
+
+    Returns:
+        ``{metric: float32 map}`` in the order of ``metrics``.
+    """
+    grads: dict[tuple[int, int], np.ndarray] = {}
+
+    def d(component: int, axis: int) -> np.ndarray:
+        # d(0, 1) = ∂vx/∂x, d(1, 0) = ∂vy/∂y, ...
+        if (component, axis) not in grads:
+            grads[component, axis] = np.gradient(vy if component else vx, spacing, axis=axis)
+        return grads[component, axis]
+
+    out: dict[str, np.ndarray] = {}
+    for metric in metrics:
+        if metric == "mag":
+            data = np.sqrt(vx**2 + vy**2)
+        elif metric == "div":
+            data = d(0, 1) + d(1, 0)
+        elif metric == "curl":
+            data = d(1, 1) - d(0, 0)
+        elif metric == "shear":
+            data = np.sqrt((d(0, 1) - d(1, 0)) ** 2 + (d(0, 0) + d(1, 1)) ** 2)
+        else:
+            raise ValueError(f"metric must be one of {METRICS}, got {metric!r}")
+        out[metric] = data.astype(np.float32)
+    return out
+
+
+# Flow derivatives ``(component, axis)`` each metric needs; see ``derive_metrics``.
+_METRIC_GRADS: dict[str, tuple[tuple[int, int], ...]] = {
+    "div": ((0, 1), (1, 0)),
+    "mag": (),
+    "curl": ((1, 1), (0, 0)),
+    "shear": ((0, 1), (1, 0), (0, 0), (1, 1)),
+}
+
+
+class MetricKernel:
+    """Allocation-free post-flow stage: smoothing, derivatives and metrics.
+
+    Produces the same maps as Gaussian-blurring the flow components and
+    calling :func:`derive_metrics`, but every intermediate lives in a
+    ``float32`` buffer allocated once: the velocity components are blurred in
+    place, derivatives are central differences from ``cv2.Sobel`` with
+    ``ksize=1`` plus the one-sided edges of ``np.gradient``, and each metric
+    is written straight into a caller-supplied destination (e.g. its slot in
+    the output stack).
+
+    Args:
+        shape: ``(H, W)`` of the flow fields.
+        metrics: Names from :data:`METRICS`.
+        sigma: Gaussian smoothing sigma in full-resolution pixels; ``0`` disables.
+        scale: Grid spacing of the flow in full-resolution pixels (the
+            ``downscale`` factor); velocities are multiplied by it.
+        upsample_to: Resize the maps to this ``(H, W)`` before returning them.
+    """
+
+    def __init__(
+        self,
+        shape: tuple[int, int],
+        metrics: Sequence[str],
+        sigma: float = 0.0,
+        scale: int = 1,
+        upsample_to: tuple[int, int] | None = None,
+    ) -> None:
+        self.metrics = parse_metrics(metrics)
+        self.sigma = sigma
+        self.scale = scale
+        self.upsample_to = upsample_to
+        h, w = shape
+        self._v = np.empty((2, h, w), dtype=np.float32)
+        needed = dict.fromkeys(g for m in self.metrics for g in _METRIC_GRADS[m])
+        self._grads = {g: np.empty((h, w), dtype=np.float32) for g in needed}
+        self._tmp = np.empty((2, h, w), dtype=np.float32)
+        self._maps = {m: np.empty((h, w), dtype=np.float32) for m in self.metrics}
+        self._resized: dict[str, np.ndarray] = {}
+        if upsample_to is not None:
+            self._resized = {m: np.empty(upsample_to, dtype=np.float32) for m in self.metrics}
+
+    def _gradient(self, src: np.ndarray, axis: int, dst: np.ndarray) -> None:
+        dx, dy = (1, 0) if axis == 1 else (0, 1)
+        cv2.Sobel(src, cv2.CV_32F, dx, dy, dst=dst, ksize=1, scale=0.5 / self.scale)
+        # One-sided differences at the edges, as in ``np.gradient``.
+        first, last = (dst[:, 0], dst[:, -1]) if axis == 1 else (dst[0], dst[-1])
+        if axis == 1:
+            np.subtract(src[:, 1], src[:, 0], out=first)
+            np.subtract(src[:, -1], src[:, -2], out=last)
+        else:
+            np.subtract(src[1], src[0], out=first)
+            np.subtract(src[-1], src[-2], out=last)
+        if self.scale != 1:
+            first /= self.scale
+            last /= self.scale
+
+    def _hypot(self, a: np.ndarray, b: np.ndarray, dst: np.ndarray) -> None:
+        # sqrt(a² + b²) in NumPy rather than ``cv2.magnitude``, whose SIMD and
+        # scalar paths differ in the last bit depending on buffer alignment.
+        np.multiply(a, a, out=self._tmp[0])
+        np.multiply(b, b, out=dst)
+        np.add(self._tmp[0], dst, out=dst)
+        np.sqrt(dst, out=dst)
+
+    def __call__(
+        self, flow: np.ndarray, out: dict[str, np.ndarray] | None = None
+    ) -> dict[str, np.ndarray]:
+        """Compute the maps of one ``(H, W, 2)`` flow field.
+
+        Args:
+            flow: Raw flow; not modified.
+            out: Optional ``{metric: (H, W) float32 array}`` destinations.
+
+        Returns:
+            ``{metric: map}``: the ``out`` arrays, or internal buffers that are
+            overwritten by the next call.
+        """
+        for c in (0, 1):
+            v = self._v[c]
+            # Express reduced-resolution flow in full-resolution pixels on a grid
+            # of spacing ``scale``: ``mag`` scales up, derivatives are unchanged.
+            np.multiply(flow[..., c], self.scale, out=v)
+            if self.sigma > 0:
+                cv2.GaussianBlur(v, (0, 0), sigmaX=self.sigma / self.scale, dst=v)
+        for (c, axis), g in self._grads.items():
+            self._gradient(self._v[c], axis, g)
+
+        resize = self.upsample_to is not None
+        d = self._grads
+        result: dict[str, np.ndarray] = {}
+        for metric in self.metrics:
+            dst = self._maps[metric] if resize or out is None else out[metric]
+            if metric == "mag":
+                self._hypot(self._v[0], self._v[1], dst)
+            elif metric == "div":
+                np.add(d[0, 1], d[1, 0], out=dst)
+            elif metric == "curl":
+                np.subtract(d[1, 1], d[0, 0], out=dst)
+            else:
+                np.subtract(d[0, 1], d[1, 0], out=dst)
+                np.add(d[0, 0], d[1, 1], out=self._tmp[1])
+                self._hypot(dst, self._tmp[1], dst)
+            if resize:
+                target = self._resized[metric] if out is None else out[metric]
+                h, w = target.shape
+                cv2.resize(dst, (w, h), dst=target, interpolation=cv2.INTER_LINEAR)
+                dst = target
+            result[metric] = dst
+        return result
+
+
+def _compute_flow(
+    g1: np.ndarray, g2: np.ndarray, params: _PairParams, out: np.ndarray | None = None
+) -> np.ndarray:
+    if params.flow_engine == "farneback" and params.flow_tile is None:
+        # Plain Farnebäck can refill the previous pair's flow buffer.
+        return farneback(g1, g2, engine_params("farneback", params.flow_preset), out)
+    return make_engine(params.flow_engine, params.flow_preset, params.flow_tile)(g1, g2)
+
+
+def _decode_flows(
+    frames: list[Path], start: int, stop: int, params: _PairParams
+) -> Iterator[tuple[int, np.ndarray]]:
+    """Yield ``(i, flow)`` for pairs ``start .. stop - 1``, decoding each frame once.
+
+    The yielded flow may be a buffer that is refilled for the next pair, so
+    consumers must be done with it before advancing. In warm-start mode the
+    flow of each pair seeds the next one; the first pair of the range starts
+    cold.
+    """
+    warm = WarmStartFlow() if params.warm_start else None
+    with FrameSource(
+        frames[start : stop + 1], params.channel, params.crop, downscale=params.downscale
+    ) as source:
+        # Two-frame sliding window: every frame is decoded once and serves as
+        # ``g2`` of pair i and ``g1`` of pair i + 1.
+        decoded = iter(source)
+        g1 = next(decoded)
+        flow: np.ndarray | None = None
+        for i, g2 in zip(range(start, stop), decoded, strict=True):
+            flow = warm(g1, g2) if warm is not None else _compute_flow(g1, g2, params, flow)
+            yield i, flow
+            g1 = g2
+    if warm is not None and warm.drift:
+        print(
+            f"Warm start {frames[start].name} .. {frames[stop].name}: drift vs cold start "
+            f"mean {np.mean(warm.drift):.4f} px, max {max(warm.drift):.4f} px "
+            f"({len(warm.drift)} checks)"
+        )
+
+
+def _iter_flows(
+    frames: list[Path], start: int, stop: int, params: _PairParams
+) -> Iterator[tuple[int, np.ndarray]]:
+    """Yield ``(i, flow)`` for pairs ``start .. stop - 1``, consulting the flow cache.
+
+    With a cache, the shard is walked as maximal runs of hits and misses:
+    hit runs are served from disk without decoding a single frame, miss runs
+    go through the decoding sliding window and populate the cache.
+    """
+    if params.cache_dir is None:
+        yield from _decode_flows(frames, start, stop, params)
+        return
+
+    cache = FlowCache(params.cache_dir, params.cache_bytes)
+    key_params = params.flow_spec()
+    digests = [file_digest(f) for f in frames[start : stop + 1]]
+    keys = [cache.key(digests[k], digests[k + 1], key_params) for k in range(stop - start)]
+    hits = [key in cache for key in keys]
+
+    run_start = start
+    while run_start < stop:
+        run_stop = run_start
+        while run_stop < stop and hits[run_stop - start] == hits[run_start - start]:
+            run_stop += 1
+        if hits[run_start - start]:
+            for i in range(run_start, run_stop):
+                flow = cache.get(keys[i - start])
+                if flow is None:  # evicted since the membership check: recompute as a miss
+                    ((_, fresh),) = _decode_flows(frames, i, i + 1, params)
+                    flow = cache.put(keys[i - start], fresh)
+                yield i, flow
+        else:
+            # Yield the stored (rounded) flow so cold and warm runs agree exactly.
+            for i, flow in _decode_flows(frames, run_start, run_stop, params):
+                yield i, cache.put(keys[i - start], flow)
+        run_start = run_stop
+
+
+def _png_path(params: _PairParams, z_use: int, metric: str, i: int) -> Path:
+    # Single-metric runs keep the historical file names.
+    if len(params.metrics) == 1:
+        return params.out_dir / f"defmap_Z{z_use}_{i + 1:03d}.png"
+    return params.out_dir / f"defmap_Z{z_use}_{metric}_{i + 1:03d}.png"
+
+
+def _compute_shard(
+    z_use: int,
+    frames: list[Path],
+    start: int,
+    stop: int,
+    params: _PairParams,
+    out: dict[str, np.ndarray] | None = None,
+    progress: bool = False,
+    on_pair: Callable[[int], None] | None = None,
+    videos: dict[str, VideoPreviewWriter] | None = None,
+) -> list[dict[str, np.ndarray]]:
+    """Compute the maps for pairs ``start .. stop - 1`` of one z-slice.
+
+    Pair ``i`` is built from ``frames[i]`` and ``frames[i + 1]``, so a shard
+    reads frames ``start .. stop`` inclusive — one frame of overlap with the
+    next shard. Maps are written straight into ``out[metric][i]`` when output
+    stacks are given; otherwise they are returned. ``on_pair(i)`` is called
+    once pair ``i`` has been stored. ``videos`` receive every map in order.
+    """
+    maps: list[dict[str, np.ndarray]] = []
+    kernel: MetricKernel | None = None
+    flows: Iterable[tuple[int, np.ndarray]] = _iter_flows(frames, start, stop, params)
+    if progress:
+        flows = tqdm(flows, total=stop - start, desc=f"Z{z_use}")
+    with ExitStack() as stack:
+        previews = stack.enter_context(PngPreviewWriter(CMAP)) if params.save_png else None
+        for i, flow in flows:
+            if kernel is None:
+                kernel = MetricKernel(
+                    flow.shape[:2],
+                    params.metrics,
+                    params.sigma,
+                    params.downscale,
+                    params.upsample_to,
+                )
+            if out is None:
+                data = {metric: m.copy() for metric, m in kernel(flow).items()}
+                maps.append(data)
+            else:
+                # Maps land directly in their stack slots, which previews may
+                # read asynchronously since they are never written again.
+                data = kernel(flow, {metric: out[metric][i] for metric in params.metrics})
+            if on_pair is not None:
+                on_pair(i)
+            if videos is not None:
+                for metric, m in data.items():
+                    videos[metric].write(m)
+
+            if previews is not None:
+                for metric, m in data.items():
+                    previews.submit(m, _png_path(params, z_use, metric, i), *CLIP_RANGES[metric])
+    return maps
+
+
+def _run_shard(
+    z_use: int,
+    frames: list[Path],
+    start: int,
+    stop: int,
+    params: _PairParams,
+    out_npys: dict[str, Path] | None,
+) -> tuple[int, int, list[dict[str, np.ndarray]]]:
+    """Pool task: compute one shard, writing into ``out_npys`` in place if given."""
+    if out_npys is None:
+        return z_use, start, _compute_shard(z_use, frames, start, stop, params)
+    out = {metric: np.load(path, mmap_mode="r+") for metric, path in out_npys.items()}
+    _compute_shard(z_use, frames, start, stop, params, out)
+    for mm in out.values():
+        mm.flush()
+    return z_use, start, []
+
+
+def _shard_ranges(n_pairs: int, n_shards: int, offset: int = 0) -> list[tuple[int, int]]:
+    """Split ``range(offset, offset + n_pairs)`` into at most ``n_shards`` contiguous runs."""
+    n_shards = max(1, min(n_shards, n_pairs))
+    size = math.ceil(n_pairs / n_shards)
+    return [(offset + s, offset + min(s + size, n_pairs)) for s in range(0, n_pairs, size)]
+
+
+def _init_worker(cv_threads: int) -> None:
+    cv2.setNumThreads(cv_threads)
+
+
+def parse_metrics(value: str | Sequence[str]) -> tuple[str, ...]:
+    """Normalise ``"div,mag"`` or ``["div", "mag"]`` to a validated, de-duplicated tuple."""
+    names = value.split(",") if isinstance(value, str) else list(value)
+    metrics = tuple(dict.fromkeys(n.strip() for n in names if n.strip()))
+    if not metrics or any(m not in METRICS for m in metrics):
+        raise ValueError(f"metric must be one of {METRICS}, got {value!r}")
+    return metrics
+
+
+def _appendable_done(out_npy: Path, m_path: Path, meta: dict[str, Any]) -> set[int]:
+    """Grow an existing stack to ``meta["shape"]`` and return its finished indices.
+
+    The stack's manifest must match ``meta`` up to the stack's current length
+    (same parameters, same leading frames); stacks built without a manifest
+    are trusted to hold their first ``len(stack)`` pairs.
+    """
+    old_shape = tuple(np.load(out_npy, mmap_mode="r").shape)
+    shape = tuple(meta["shape"])
+    n_old = old_shape[0]
+    if old_shape[1:] != shape[1:] or n_old > shape[0]:
+        raise ValueError(
+            f"Cannot append to {out_npy}: it has shape {old_shape}, expected up to {shape}"
+        )
+    if m_path.exists():
+        done = StackManifest.read_done(
+            m_path, {**meta, "shape": old_shape, "frames": meta["frames"][: n_old + 1]}
+        )
+    else:
+        done = set(range(n_old))
+    if n_old < shape[0]:
+        grow_npy(out_npy, shape[0])
+    return done
+
+
+def build_defmap_stacks(
     rgb_dir: Path,
     out_dir: Path,
-    metric: str = "div",
+    metrics: str | Sequence[str] = ("div",),
     sigma: float = 1.5,
     channel: int | None = None,
     crop: tuple[int, int, int, int] | None = None,
     save_png: bool = False,
-) -> dict[int, np.ndarray]:
-    """Build divergence or magnitude stacks per z-slice.
+    workers: int = 1,
+    out_of_core: bool = False,
+    resume: bool = False,
+    append: bool = False,
+    flow_cache: Path | None = None,
+    flow_cache_bytes: int = DEFAULT_MAX_BYTES,
+    save_mp4: bool = False,
+    fps: float = DEFAULT_FPS,
+    flow_engine: str = DEFAULT_ENGINE,
+    flow_preset: str | None = None,
+    warm_start: bool = False,
+    flow_tile: int | None = None,
+    downscale: int = 1,
+    upsample: bool = False,
+    stack_format: str = "npy",
+    quantize: str = "float16",
+) -> dict[str, dict[int, np.ndarray | ChunkedStack]]:
+    """Build one DefMap stack per z-slice and metric from a single flow pass.
 
     Args:
         rgb_dir: Directory with raw frames named ``..._tXXXX_zXXXX.png``.
         out_dir: Output directory for ``.npy`` stacks and optional PNG previews.
-        metric: ``"div"`` for divergence or ``"mag"`` for magnitude.
+        metrics: Metric names from :data:`METRICS`, as a sequence or a
+            comma-separated string such as ``"div,mag"``. Optical flow is
+            computed once per frame pair and shared by all of them.
         sigma: Gaussian sigma for flow smoothing (``0`` disables smoothing).
         channel: Single colour channel index (0/1/2) or ``None`` for grayscale.
         crop: Optional ``(x0, y0, w, h)`` crop box in pixels.
-        save_png: Whether to also write a PNG preview per frame.
+        save_png: Whether to also write a colour-mapped PNG preview per frame
+            and metric (rendered off-thread by
+            :class:`~btflow.preview.PngPreviewWriter`).
+        workers: Number of worker processes. ``1`` runs serially in-process;
+            larger values shard every z-slice's frame pairs across a process
+            pool, with OpenCV's internal thread count divided between workers.
+        out_of_core: Allocate each ``.npy`` with ``np.lib.format.open_memmap``
+            and write every map into place as it is computed, so peak memory
+            is a few frames regardless of sequence length.
+        resume: Checkpoint progress in a ``.manifest.json`` sidecar next to
+            each stack and, on restart, skip the pairs recorded as done in
+            every requested metric's manifest. Implies ``out_of_core``; refuses
+            to resume a stack whose manifest was written with different
+            parameters or input frames.
+        append: Extend existing stacks instead of rebuilding them: the
+            ``.npy`` of every stack is grown in place to the current number of
+            frames and only the pairs it does not hold yet are computed.
+            Implies ``resume``. Only time points present in every z-slice are
+            used, so a z-slice that is still being written does not shift the
+            others. Cannot be combined with ``save_mp4`` or chunked output.
+        flow_cache: Directory of a :class:`~btflow.flowcache.FlowCache`. Raw
+            flow fields are looked up by the content of both input frames, the
+            channel, the crop and the flow engine and its parameters; misses are computed and
+            stored. Reruns that only change ``sigma`` or ``metrics`` then skip
+            decoding and optical flow. Cached flow is stored as ``float16``,
+            and misses use the stored copy too, so cold and warm runs agree.
+        flow_cache_bytes: Size bound of the flow cache; least-recently-used
+            entries are evicted beyond it.
+        save_mp4: Also write one colour-mapped ``defmap_stack_Z{z}_{metric}.mp4``
+            per stack. Serial runs stream maps into the encoder thread as they
+            are computed; pool and partially resumed runs render the finished
+            stack instead, since their maps are not produced in order.
+        fps: Frame rate of the MP4 previews.
+        flow_engine: Optical-flow engine from :data:`btflow.flow.ENGINES`
+            (default Farnebäck, as in the thesis).
+        flow_preset: Named parameter preset of ``flow_engine``; ``None`` picks
+            the engine's default.
+        warm_start: Farnebäck only. Seed each pair with the previous pair's
+            flow and run the cheaper :data:`btflow.flow.WARM_START_KWARGS`
+            (see :class:`~btflow.flow.WarmStartFlow`). Every
+            :data:`~btflow.flow.WARM_START_CHECK_EVERY` pairs the flow is
+            recomputed from scratch, re-anchoring the chain, and the endpoint
+            error between the two is printed as a drift report. Results depend
+            slightly on where shards start, so keep this off for publication
+            runs.
+        flow_tile: Compute the flow of each frame as overlapping tiles of this
+            size on a thread pool (see :class:`~btflow.flow.TiledFlow`) and
+            blend them into one field before any metric is derived. Meant for
+            very large frames; halos are sized from the engine parameters so
+            the blended field matches the untiled flow to well below 0.1 px.
+        downscale: Screening mode: decode frames at ``1/downscale``
+            resolution (``IMREAD_REDUCED_*``), compute flow on the small
+            frames and report velocities and derivatives in full-resolution
+            pixels, so ``div``/``curl``/``shear`` keep their scale and ``mag``
+            is multiplied back up; ``sigma`` and ``crop`` stay in
+            full-resolution pixels. Maps are saved at the reduced size. See
+            the README for accuracy against full resolution.
+        upsample: With ``downscale``, resize the maps back to the full frame
+            (or crop) size with bilinear interpolation before saving.
+        stack_format: ``"npy"`` or ``"chunked"``. Chunked stacks are written
+            as ``defmap_stack_Z{z}_{metric}.dmz`` (see :mod:`btflow.stackio`)
+            with the run parameters in their header. Out-of-core and resumable
+            runs still build the ``.npy`` as a working file and replace it
+            (and its manifest) once the stack is complete.
+        quantize: Chunked storage type, ``"float16"`` or ``"int16"``.
 
     Returns:
-        Mapping ``{z_slice: stack}`` where each ``stack`` has shape ``(T-1, H, W)``.
+        Mapping ``{metric: {z_slice: stack}}`` where each ``stack`` has shape
+        ``(T-1, H, W)``. With ``out_of_core`` the stacks are read-only memmaps
+        of the saved files; chunked stacks are returned as
+        :class:`~btflow.stackio.ChunkedStack` readers.
     """
-    if metric not in {"div", "mag"}:
-        raise ValueError(f"metric must be 'div' or 'mag', got {metric!r}")
+    metric_names = parse_metrics(metrics)
+    flow_spec = engine_params(flow_engine, flow_preset)
+    if warm_start and flow_engine != "farneback":
+        raise ValueError(f"warm_start requires the 'farneback' flow engine, got {flow_engine!r}")
+    if flow_tile is not None and (flow_tile < 1 or warm_start):
+        raise ValueError("flow_tile must be >= 1 and cannot be combined with warm_start")
+    if downscale not in DOWNSCALES:
+        raise ValueError(f"downscale must be one of {DOWNSCALES}, got {downscale}")
+    if stack_format not in STACK_FORMATS:
+        raise ValueError(f"stack_format must be one of {STACK_FORMATS}, got {stack_format!r}")
+    if quantize not in QUANTIZE:
+        raise ValueError(f"quantize must be one of {QUANTIZE}, got {quantize!r}")
+    if workers < 1:
+        raise ValueError(f"workers must be >= 1, got {workers}")
+    if append and (save_mp4 or stack_format != "npy"):
+        raise ValueError("append requires stack_format='npy' and cannot write MP4 previews")
+    resume = resume or append
+    out_of_core = out_of_core or resume
 
     rgb_dir = rgb_dir.resolve()
     out_dir = out_dir.resolve()
@@ -69,71 +610,301 @@ def build_defmap_stack(
         raise SystemExit("No raw frames matching the expected '_t####_z####' pattern were found.")
 
     z_slices = sorted(frame_dict.keys())
-    t_list = sorted(next(iter(frame_dict.values())).keys())
+    t_list = sorted(set.intersection(*(set(by_t) for by_t in frame_dict.values())))
     print(f"Raw data loaded: z-slices = {z_slices}, time steps = {len(t_list)}")
 
-    stacks: dict[int, np.ndarray] = {}
+    first = frame_dict[z_slices[0]][t_list[0]]
+    upsample_to: tuple[int, int] | None = None
+    if upsample and downscale > 1:
+        full_h, full_w = read_plane(first, channel, crop).shape
+        upsample_to = (full_h, full_w)
+
+    params = _PairParams(
+        metric_names,
+        sigma,
+        channel,
+        crop,
+        save_png,
+        out_dir,
+        flow_cache.resolve() if flow_cache is not None else None,
+        flow_cache_bytes,
+        flow_engine,
+        flow_preset,
+        warm_start,
+        flow_tile,
+        downscale,
+        upsample_to,
+    )
+    frames_by_z = {z: [frame_dict[z][t] for t in t_list] for z in z_slices}
+    n_pairs = len(t_list) - 1
+    out_paths = {
+        z: {m: out_dir / f"defmap_stack_Z{z}_{m}.npy" for m in metric_names} for z in z_slices
+    }
+    # Out-of-core and resumed runs write into ``work_paths``. Chunked runs use
+    # a scratch file of their own there, so an existing ``.npy`` stack from an
+    # earlier run is neither overwritten nor deleted.
+    work_paths = {
+        z: {
+            m: p.with_name(f"{p.stem}{SUFFIX}.partial.npy") if stack_format == "chunked" else p
+            for m, p in paths.items()
+        }
+        for z, paths in out_paths.items()
+    }
+
+    # Every map is written into a preallocated stack — an in-RAM array, or an
+    # on-disk memmap in out-of-core mode — instead of being collected and copied
+    # by ``np.stack``.
+    stacks: dict[int, dict[str, np.ndarray]] = {z: {} for z in z_slices}
+    memmaps: dict[int, dict[str, np.memmap]] = {z: {} for z in z_slices}
+    manifests: dict[int, dict[str, StackManifest]] = {z: {} for z in z_slices}
+    metas: dict[int, dict[str, dict[str, Any]]] = {z: {} for z in z_slices}
+    pending: dict[int, list[tuple[int, int]]] = {}
     for z_use in z_slices:
-        frames = [frame_dict[z_use][t] for t in t_list]
-        stack = []
+        plane_shape = (
+            upsample_to or read_plane(frames_by_z[z_use][0], channel, crop, downscale).shape
+        )
+        shape = (n_pairs, *plane_shape)
+        # A pair is only skipped on resume once every requested metric has it.
+        done_all = set(range(n_pairs))
+        for metric in metric_names:
+            out_npy = work_paths[z_use][metric]
+            done: set[int] = set()
+            metas[z_use][metric] = meta = {
+                "metric": metric,
+                "sigma": sigma,
+                "channel": channel,
+                "crop": crop,
+                "engine": flow_engine,
+                "flow": flow_spec,
+                "warm_start": warm_start,
+                "tile": flow_tile,
+                "downscale": downscale,
+                "upsample": upsample_to is not None,
+                "shape": shape,
+                "frames": [f.name for f in frames_by_z[z_use]],
+            }
+            if resume:
+                m_path = manifest_path(out_npy)
+                if append and out_npy.exists():
+                    done = _appendable_done(out_npy, m_path, meta)
+                elif out_npy.exists():
+                    done = StackManifest.read_done(m_path, meta)
+            if done:
+                memmaps[z_use][metric] = np.load(out_npy, mmap_mode="r+")
+                print(f"Z{z_use} {metric}: resuming, {len(done)}/{n_pairs} pairs already done")
+            elif out_of_core:
+                memmaps[z_use][metric] = np.lib.format.open_memmap(
+                    out_npy, mode="w+", dtype=np.float32, shape=shape
+                )
+            if resume:
+                manifest = StackManifest(m_path, meta, done, flush=memmaps[z_use][metric].flush)
+                manifest.save()
+                manifests[z_use][metric] = manifest
+                done_all &= done
+            stacks[z_use][metric] = (
+                memmaps[z_use][metric] if out_of_core else np.empty(shape, dtype=np.float32)
+            )
+        pending[z_use] = pending_runs(done_all, n_pairs) if resume else [(0, n_pairs)]
+
+    def mark_done(z_use: int, *indices: int) -> None:
+        for manifest in manifests[z_use].values():
+            manifest.mark(*indices)
 
-        for i in tqdm(range(len(frames) - 1), desc=f"Z{z_use}"):
-            if channel is None:
-                g1 = imread(frames[i], cv2.IMREAD_GRAYSCALE)
-                g2 = imread(frames[i + 1], cv2.IMREAD_GRAYSCALE)
+    # Videos still to be rendered from finished stacks: {z: metrics}.
+    render_later: dict[int, tuple[str, ...]] = {}
+    if workers == 1:
+        for z_use in z_slices:
+            stream = save_mp4 and pending[z_use] == [(0, n_pairs)]
+            if save_mp4 and not stream:
+                render_later[z_use] = metric_names
+            with ExitStack() as video_stack:
+                videos = (
+                    {
+                        m: video_stack.enter_context(
+                            VideoPreviewWriter(
+                                out_paths[z_use][m].with_suffix(".mp4"),
+                                CMAP,
+                                *CLIP_RANGES[m],
+                                fps=fps,
+                            )
+                        )
+                        for m in metric_names
+                    }
+                    if stream
+                    else None
+                )
+                for start, stop in pending[z_use]:
+                    _compute_shard(
+                        z_use,
+                        frames_by_z[z_use],
+                        start,
+                        stop,
+                        params,
+                        stacks[z_use],
+                        progress=True,
+                        on_pair=partial(mark_done, z_use) if resume else None,
+                        videos=videos,
+                    )
+    else:
+        if save_mp4:
+            render_later = dict.fromkeys(z_slices, metric_names)
+        # Workers reopen the out-of-core files themselves; flush the headers first.
+        for by_metric in memmaps.values():
+            for mm in by_metric.values():
+                mm.flush()
+        # A few shards per worker keeps the pool busy when z-slices finish unevenly.
+        shards_per_z = math.ceil(4 * workers / len(z_slices))
+        cv_threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(cv_threads,),
+        ) as pool:
+            futures = {
+                pool.submit(
+                    _run_shard,
+                    z_use,
+                    frames_by_z[z_use],
+                    start,
+                    stop,
+                    params,
+                    work_paths[z_use] if out_of_core else None,
+                ): stop - start
+                for z_use in z_slices
+                for run_start, run_stop in pending[z_use]
+                for start, stop in _shard_ranges(
+                    run_stop - run_start,
+                    math.ceil(shards_per_z * (run_stop - run_start) / n_pairs),
+                    offset=run_start,
+                )
+            }
+            with tqdm(total=sum(futures.values()), desc="pairs") as bar:
+                for fut in as_completed(futures):
+                    z_use, start, maps = fut.result()
+                    for offset, data in enumerate(maps):
+                        for metric, m in data.items():
+                            stacks[z_use][metric][start + offset] = m
+                    mark_done(z_use, *range(start, start + futures[fut]))
+                    bar.update(futures[fut])
+
+    for z_manifests in manifests.values():
+        for manifest in z_manifests.values():
+            manifest.save()
+
+    result: dict[str, dict[int, np.ndarray | ChunkedStack]] = {m: {} for m in metric_names}
+    for z_use in z_slices:
+        for metric in metric_names:
+            out_npy = out_paths[z_use][metric]
+            stack = stacks[z_use][metric]
+            if out_of_core:
+                memmaps[z_use].pop(metric).flush()
+            if metric in render_later.get(z_use, ()):
+                render_stack_video(
+                    stack, out_npy.with_suffix(".mp4"), *CLIP_RANGES[metric], cmap=CMAP, fps=fps
+                )
+            if stack_format == "chunked":
+                out_path = save_chunked(
+                    out_npy.with_suffix(SUFFIX), stack, quantize=quantize, meta=metas[z_use][metric]
+                )
+                del stack, stacks[z_use][metric]
+                if out_of_core:
+                    work_npy = work_paths[z_use][metric]
+                    work_npy.unlink(missing_ok=True)
+                    manifest_path(work_npy).unlink(missing_ok=True)
+                result[metric][z_use] = ChunkedStack(out_path)
+            elif out_of_core:
+                out_path = out_npy
+                result[metric][z_use] = np.load(out_npy, mmap_mode="r")
             else:
-                g1 = cv2.split(imread(frames[i]))[channel]
-                g2 = cv2.split(imread(frames[i + 1]))[channel]
+                out_path = out_npy
+                np.save(out_npy, stack)
+                result[metric][z_use] = stack
+            print(f"DefMap stack Z{z_use} -> {out_path}  shape={result[metric][z_use].shape}")
 
-            if crop is not None:
-                x0, y0, w, h = crop
-                g1 = g1[y0 : y0 + h, x0 : x0 + w]
-                g2 = g2[y0 : y0 + h, x0 : x0 + w]
+    return result
 
-            # opencv-python stubs reject the generic ndarray dtype Any here even though
-            # a uint8 grayscale array is valid input.
-            flow = cv2.calcOpticalFlowFarneback(g1, g2, None, **FLOW_KWARGS)  # type: ignore[call-overload]
-            vx, vy = flow[..., 0], flow[..., 1]
 
-            if sigma > 0:
-                vx = cv2.GaussianBlur(vx, (0, 0), sigmaX=sigma)
-                vy = cv2.GaussianBlur(vy, (0, 0), sigmaX=sigma)
+def build_defmap_stack(
+    rgb_dir: Path, out_dir: Path, metric: str = "div", **kwargs: Any
+) -> dict[int, np.ndarray | ChunkedStack]:
+    """Build divergence or magnitude stacks per z-slice for a single metric.
 
-            if metric == "mag":
-                data = np.sqrt(vx**2 + vy**2).astype(np.float32)
-                clip_lo, clip_hi = 0.0, VMAX_MAG
-            else:
-                dvx_dx = np.gradient(vx, axis=1)
-                dvy_dy = np.gradient(vy, axis=0)
-                data = (dvx_dx + dvy_dy).astype(np.float32)
-                clip_lo, clip_hi = -VMAX_DIV, VMAX_DIV
+    Thin wrapper around :func:`build_defmap_stacks`; every keyword argument
+    (``sigma``, ``channel``, ``crop``, ``save_png``, ``workers``, ...) is
+    forwarded unchanged.
+
+    Args:
+        rgb_dir: Directory with raw frames named ``..._tXXXX_zXXXX.png``.
+        out_dir: Output directory for ``.npy`` stacks and optional PNG previews.
+        metric: One metric name from :data:`METRICS` (default ``"div"``).
+        **kwargs: Forwarded to :func:`build_defmap_stacks`.
 
-            stack.append(data)
+    Returns:
+        Mapping ``{z_slice: stack}`` where each ``stack`` has shape ``(T-1, H, W)``.
+    """
+    if metric not in METRICS:
+        raise ValueError(f"metric must be one of {METRICS}, got {metric!r}")
+    return build_defmap_stacks(rgb_dir, out_dir, metrics=(metric,), **kwargs)[metric]
+
+
+def _complete_time_points(rgb_dir: Path) -> int:
+    """Number of time points present in every z-slice of ``rgb_dir``."""
+    frame_dict = group_frames_by_z_t(rgb_dir)
+    if not frame_dict:
+        return 0
+    return len(set.intersection(*(set(by_t) for by_t in frame_dict.values())))
 
-            if save_png:
-                shown = np.clip(data, clip_lo, clip_hi)
-                fig = plt.figure(figsize=(4, 3))
-                plt.imshow(shown, cmap=CMAP, vmin=clip_lo, vmax=clip_hi)
-                plt.axis("off")
-                plt.tight_layout(pad=0)
-                png_path = out_dir / f"defmap_Z{z_use}_{i + 1:03d}.png"
-                fig.savefig(png_path, dpi=120, bbox_inches="tight", pad_inches=0)
-                plt.close(fig)
 
-        stack_arr = np.stack(stack)
-        out_npy = out_dir / f"defmap_stack_Z{z_use}_{metric}.npy"
-        np.save(out_npy, stack_arr)
-        print(f"DefMap stack Z{z_use} -> {out_npy}  shape={stack_arr.shape}")
-        stacks[z_use] = stack_arr
+def watch_defmap_stacks(
+    rgb_dir: Path,
+    out_dir: Path,
+    interval: float = 10.0,
+    max_polls: int | None = None,
+    **kwargs: Any,
+) -> int:
+    """Keep DefMap stacks current while new frames arrive in ``rgb_dir``.
 
-    return stacks
+    Polls the directory every ``interval`` seconds and, whenever a new time
+    point is complete in every z-slice, runs :func:`build_defmap_stacks` with
+    ``append=True``. Each update only computes the new pairs, so the work per
+    new frame stays constant as the stacks grow. A frame that cannot be
+    decoded yet (still being written) aborts the update; it is retried at the
+    next poll, and pairs finished before the error are kept.
+
+    Args:
+        rgb_dir: Directory the acquisition writes raw frames to.
+        out_dir: Output directory for the ``.npy`` stacks.
+        interval: Seconds between polls.
+        max_polls: Stop after this many polls; ``None`` watches until interrupted.
+        **kwargs: Forwarded to :func:`build_defmap_stacks`.
+
+    Returns:
+        Number of time points covered by the stacks when watching stopped.
+    """
+    covered = 0
+    polls = 0
+    while max_polls is None or polls < max_polls:
+        if polls:
+            time.sleep(interval)
+        polls += 1
+        n_t = _complete_time_points(rgb_dir)
+        if n_t < 2 or n_t == covered:
+            continue
+        try:
+            build_defmap_stacks(rgb_dir, out_dir, append=True, **kwargs)
+        except FileNotFoundError as exc:
+            print(f"Frame not readable yet, retrying next poll: {exc}")
+            continue
+        covered = n_t
+    return covered
 
 
 def register(subparsers: argparse._SubParsersAction[argparse.ArgumentParser]) -> None:
     p = subparsers.add_parser(
         "defmap",
-        help="Build DefMap stacks (divergence or magnitude) from RGB frames.",
-        description="Build DefMap stack from RGB frames via Farnebäck optical flow.",
+        help="Build DefMap stacks (divergence, magnitude, curl, shear) from RGB frames.",
+        description="Build DefMap stack from RGB frames via dense optical flow.",
     )
     p.add_argument(
         "--rgb-dir",
@@ -149,9 +920,13 @@ def register(subparsers: argparse._SubParsersAction[argparse.ArgumentParser]) ->
     )
     p.add_argument(
         "--metric",
-        choices=["div", "mag"],
-        default="div",
-        help="'div' = divergence ∇·v  |  'mag' = magnitude ‖v‖  (default: div).",
+        type=_metrics_arg,
+        default=("div",),
+        help=(
+            "Comma-separated metrics computed from one flow pass: 'div' = divergence ∇·v, "
+            "'mag' = magnitude ‖v‖, 'curl' = vorticity, 'shear' = shear rate "
+            "(default: div). Example: --metric div,mag."
+        ),
     )
     p.add_argument(
         "--sigma",
@@ -174,25 +949,164 @@ def register(subparsers: argparse._SubParsersAction[argparse.ArgumentParser]) ->
         default=None,
         help="Crop box in pixels (x0 y0 w h).",
     )
+    p.add_argument(
+        "--flow-engine",
+        choices=sorted(ENGINES),
+        default=DEFAULT_ENGINE,
+        help=(
+            "Optical-flow engine: 'farneback' (thesis default), 'dis' (fast), "
+            "'tvl1' (accurate, needs opencv-contrib-python)."
+        ),
+    )
+    p.add_argument(
+        "--flow-preset",
+        default=None,
+        help=(
+            "Parameter preset of the flow engine (farneback: thesis; "
+            "dis: ultrafast/fast/medium; tvl1: default/fast). Default: the engine's default."
+        ),
+    )
+    p.add_argument(
+        "--warm-start",
+        action="store_true",
+        help=(
+            "Seed Farnebäck with the previous pair's flow and fewer levels/iterations; "
+            "faster on long sequences, prints drift vs cold start. Not for publication runs."
+        ),
+    )
+    p.add_argument(
+        "--flow-tile",
+        type=int,
+        default=None,
+        metavar="PX",
+        help=(
+            "Compute flow in overlapping PX-sized tiles on a thread pool and blend them; "
+            "for very large frames (e.g. 1024 for 8k x 8k)."
+        ),
+    )
+    p.add_argument(
+        "--downscale",
+        type=int,
+        choices=DOWNSCALES[1:],
+        default=1,
+        help=(
+            "Screening mode: decode frames at 1/2 or 1/4 resolution and compute flow there; "
+            "velocities and derivatives are rescaled to full-resolution pixels."
+        ),
+    )
+    p.add_argument(
+        "--upsample",
+        action="store_true",
+        help="With --downscale, resize the DefMaps back to full resolution before saving.",
+    )
+    p.add_argument(
+        "--stack-format",
+        choices=STACK_FORMATS,
+        default="npy",
+        help="Save stacks as .npy (default) or chunked, compressed .dmz files.",
+    )
+    p.add_argument(
+        "--quantize",
+        choices=QUANTIZE,
+        default="float16",
+        help="Storage type of chunked stacks: float16 (default) or int16 scaled to the data.",
+    )
     p.add_argument(
         "--save-png",
         action="store_true",
         help="Save PNG previews of individual DefMaps.",
     )
+    p.add_argument(
+        "--save-mp4",
+        action="store_true",
+        help="Save one MP4 preview per z-slice and metric, encoded while the stack is built.",
+    )
+    p.add_argument(
+        "--fps",
+        type=float,
+        default=DEFAULT_FPS,
+        help=f"Frame rate of MP4 previews (default: {DEFAULT_FPS:g}).",
+    )
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes; >1 shards the (z, t) pairs across a process pool (default: 1).",
+    )
+    p.add_argument(
+        "--out-of-core",
+        action="store_true",
+        help="Stream DefMaps into memory-mapped .npy files instead of building stacks in RAM.",
+    )
+    p.add_argument(
+        "--resume",
+        action="store_true",
+        help="Checkpoint finished pairs in a sidecar manifest and skip them when rerun.",
+    )
+    p.add_argument(
+        "--append",
+        action="store_true",
+        help="Grow existing .npy stacks in place with the pairs of newly arrived frames only.",
+    )
+    p.add_argument(
+        "--watch",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="Poll --rgb-dir every SECONDS and append new frames until interrupted.",
+    )
+    p.add_argument(
+        "--flow-cache",
+        type=Path,
+        default=None,
+        help="Directory of an on-disk optical-flow cache shared between runs.",
+    )
+    p.add_argument(
+        "--flow-cache-size",
+        type=float,
+        default=DEFAULT_MAX_BYTES / 2**30,
+        help="Flow cache size limit in GiB; least-recently-used entries are evicted (default: 20).",
+    )
     p.set_defaults(_handler=_handle)
 
 
+def _metrics_arg(value: str) -> tuple[str, ...]:
+    try:
+        return parse_metrics(value)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc)) from exc
+
+
 def _handle(args: argparse.Namespace) -> int:
     crop: tuple[int, int, int, int] | None = (
         (args.crop[0], args.crop[1], args.crop[2], args.crop[3]) if args.crop else None
     )
-    build_defmap_stack(
-        rgb_dir=args.rgb_dir,
-        out_dir=args.out_dir,
-        metric=args.metric,
-        sigma=args.sigma,
-        channel=args.channel,
-        crop=crop,
-        save_png=args.save_png,
+    kwargs: dict[str, Any] = {
+        "metrics": args.metric,
+        "sigma": args.sigma,
+        "channel": args.channel,
+        "crop": crop,
+        "save_png": args.save_png,
+        "save_mp4": args.save_mp4,
+        "fps": args.fps,
+        "workers": args.workers,
+        "out_of_core": args.out_of_core,
+        "flow_cache": args.flow_cache,
+        "flow_cache_bytes": int(args.flow_cache_size * 2**30),
+        "flow_engine": args.flow_engine,
+        "flow_preset": args.flow_preset,
+        "warm_start": args.warm_start,
+        "flow_tile": args.flow_tile,
+        "downscale": args.downscale,
+        "upsample": args.upsample,
+        "stack_format": args.stack_format,
+        "quantize": args.quantize,
+    }
+    if args.watch is not None:
+        with suppress(KeyboardInterrupt):
+            watch_defmap_stacks(args.rgb_dir, args.out_dir, interval=args.watch, **kwargs)
+        return 0
+    build_defmap_stacks(
+        args.rgb_dir, args.out_dir, resume=args.resume, append=args.append, **kwargs
     )
     return 0
@@ -0,0 +1,393 @@
+"""Dense optical-flow engines and a small speed/accuracy benchmark.
+
+Every engine turns two single-plane ``uint8`` frames into an ``(H, W, 2)``
+``float32`` flow field (``flow[y, x] = (dx, dy)`` from the first frame to the
+second). Engines are looked up by name in :data:`ENGINES`; each comes with
+named parameter presets so runs are reproducible from two short strings:
+
+- ``farneback`` — ``cv2.calcOpticalFlowFarneback``; preset ``thesis`` is
+  :data:`FLOW_KWARGS`, the parameters used for every figure in the thesis.
+- ``dis`` — ``cv2.DISOpticalFlow`` (Dense Inverse Search); several times
+  faster on CPU at some loss of accuracy, useful for screening runs.
+- ``tvl1`` — Dual TV-L1 from ``cv2.optflow``; slow but accurate. Requires the
+  ``opencv-contrib-python`` build.
+
+:class:`WarmStartFlow` is an opt-in Farnebäck variant for sequences: it seeds
+each pair with the previous pair's flow (``cv2.OPTFLOW_USE_INITIAL_FLOW``), so
+a shallower pyramid and fewer iterations suffice, and periodically measures
+how far it has drifted from a cold start.
+
+:class:`TiledFlow` computes the flow of very large frames as overlapping tiles
+on a thread pool and blends them back into one field; halos are sized from
+the engine's support (:func:`tile_halo`) so the result matches the untiled
+flow away from numerical noise.
+
+:func:`benchmark_engines` warps a synthetic texture with a known smooth flow
+field and reports frames/s next to the average endpoint error (EPE) for each
+engine, so an engine can be chosen with data (see
+``scripts/bench_flow_engines.py``).
+"""
+
+from __future__ import annotations
+
+import math
+import threading
+import time
+from collections.abc import Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import cache, partial
+from typing import Any
+
+import cv2
+import numpy as np
+
+FlowFn = Callable[[np.ndarray, np.ndarray], np.ndarray]
+
+# Farnebäck parameters used throughout the thesis.
+FLOW_KWARGS: dict[str, float | int] = {
+    "pyr_scale": 0.5,
+    "levels": 3,
+    "winsize": 15,
+    "iterations": 3,
+    "poly_n": 5,
+    "poly_sigma": 1.2,
+    "flags": 0,
+}
+
+DEFAULT_ENGINE = "farneback"
+
+# Warm-started Farnebäck: the previous flow replaces most of the coarse-to-fine
+# search, so a single pyramid level and two iterations suffice.
+WARM_START_KWARGS: dict[str, float | int] = {**FLOW_KWARGS, "levels": 1, "iterations": 2}
+# Every this many pairs, also compute the cold-start flow to measure drift.
+WARM_START_CHECK_EVERY = 25
+# Tile halo for engines without a support formula in ``tile_halo``.
+DEFAULT_TILE_HALO = 64
+
+
+def farneback(
+    g1: np.ndarray,
+    g2: np.ndarray,
+    params: dict[str, Any] = FLOW_KWARGS,
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """Farnebäck flow from ``g1`` to ``g2``, optionally into a reused ``out`` buffer.
+
+    ``out`` must be a ``float32`` ``(H, W, 2)`` array; its contents are ignored
+    unless ``params["flags"]`` contains ``cv2.OPTFLOW_USE_INITIAL_FLOW``.
+    """
+    # opencv-python stubs declare ``flow`` as required although ``None`` (allocate
+    # a new field) is valid.
+    flow: np.ndarray = cv2.calcOpticalFlowFarneback(g1, g2, out, **params)  # type: ignore[arg-type]
+    return flow
+
+
+def _farneback(params: dict[str, Any]) -> FlowFn:
+    return partial(farneback, params=params)
+
+
+_DIS_PRESETS = {
+    "ultrafast": cv2.DISOPTICAL_FLOW_PRESET_ULTRAFAST,
+    "fast": cv2.DISOPTICAL_FLOW_PRESET_FAST,
+    "medium": cv2.DISOPTICAL_FLOW_PRESET_MEDIUM,
+}
+
+
+def _dis(params: dict[str, Any]) -> FlowFn:
+    dis = cv2.DISOpticalFlow.create(_DIS_PRESETS[params["preset"]])
+    for name, value in params.items():
+        if name != "preset":
+            getattr(dis, f"set{name}")(value)
+
+    def calc(g1: np.ndarray, g2: np.ndarray) -> np.ndarray:
+        # DIS rejects strided views such as crops and tiles.
+        g1, g2 = np.ascontiguousarray(g1), np.ascontiguousarray(g2)
+        flow: np.ndarray = dis.calc(g1, g2, None)  # type: ignore[call-overload]
+        return flow
+
+    return calc
+
+
+def _tvl1(params: dict[str, Any]) -> FlowFn:
+    optflow = getattr(cv2, "optflow", None)
+    if optflow is None:
+        raise RuntimeError("The 'tvl1' flow engine requires opencv-contrib-python.")
+    tvl1 = optflow.DualTVL1OpticalFlow_create(**params)
+
+    def calc(g1: np.ndarray, g2: np.ndarray) -> np.ndarray:
+        flow: np.ndarray = tvl1.calc(g1, g2, None)
+        return flow
+
+    return calc
+
+
+@dataclass(frozen=True)
+class EngineSpec:
+    """A registered flow engine: a factory plus its named parameter presets."""
+
+    factory: Callable[[dict[str, Any]], FlowFn]
+    presets: dict[str, dict[str, Any]]
+    default_preset: str
+
+
+ENGINES: dict[str, EngineSpec] = {
+    "farneback": EngineSpec(_farneback, {"thesis": FLOW_KWARGS}, "thesis"),
+    "dis": EngineSpec(
+        _dis,
+        {name: {"preset": name} for name in _DIS_PRESETS},
+        "medium",
+    ),
+    "tvl1": EngineSpec(
+        _tvl1,
+        {"default": {}, "fast": {"nscales": 3, "warps": 2}},
+        "default",
+    ),
+}
+
+
+def engine_params(engine: str, preset: str | None = None) -> dict[str, Any]:
+    """Return the parameter dict of ``engine``'s ``preset`` (default preset if ``None``)."""
+    if engine not in ENGINES:
+        raise ValueError(f"flow engine must be one of {tuple(ENGINES)}, got {engine!r}")
+    spec = ENGINES[engine]
+    preset = preset or spec.default_preset
+    if preset not in spec.presets:
+        raise ValueError(
+            f"preset for {engine!r} must be one of {tuple(spec.presets)}, got {preset!r}"
+        )
+    return spec.presets[preset]
+
+
+@cache
+def make_engine(
+    engine: str = DEFAULT_ENGINE, preset: str | None = None, tile: int | None = None
+) -> FlowFn:
+    """Build (once per process) the flow function for ``engine`` and ``preset``.
+
+    Engines that wrap stateful OpenCV objects (DIS, TV-L1) are created once
+    and reused for every frame pair; they are not thread-safe. With ``tile``
+    the engine runs through a :class:`TiledFlow` with that core tile size.
+    """
+    if tile is not None:
+        return TiledFlow(engine, preset, tile)
+    return ENGINES[engine].factory(engine_params(engine, preset))
+
+
+class WarmStartFlow:
+    """Sequential Farnebäck flow seeded with the previous pair's flow.
+
+    Call it on consecutive pairs ``(f0, f1), (f1, f2), ...``. The first pair,
+    and every ``check_every``-th pair after it, is computed from scratch with
+    :data:`FLOW_KWARGS`; every other pair starts from the previous flow and
+    uses the cheaper ``params``. At a check pair the warm-started flow is
+    computed as well, its endpoint error against the cold-start flow is
+    appended to :attr:`drift`, and the chain continues from the cold flow, so
+    drift cannot accumulate over more than ``check_every`` pairs.
+
+    Args:
+        params: Farnebäck keyword arguments for warm-started pairs; ``flags``
+            gets ``cv2.OPTFLOW_USE_INITIAL_FLOW`` added.
+        check_every: Cold-start check interval in pairs; ``0`` disables checks
+            after the first pair.
+    """
+
+    def __init__(
+        self,
+        params: dict[str, float | int] = WARM_START_KWARGS,
+        check_every: int = WARM_START_CHECK_EVERY,
+    ) -> None:
+        self.params: dict[str, Any] = {
+            **params,
+            "flags": int(params["flags"]) | cv2.OPTFLOW_USE_INITIAL_FLOW,
+        }
+        self.check_every = check_every
+        self.drift: list[float] = []
+        self._cold = make_engine("farneback")
+        self._prev: np.ndarray | None = None
+        self._n = 0
+
+    def _warm(self, g1: np.ndarray, g2: np.ndarray, init: np.ndarray) -> np.ndarray:
+        # The initial flow is refined in place, so hand OpenCV a copy.
+        return farneback(g1, g2, self.params, out=init.copy())
+
+    def __call__(self, g1: np.ndarray, g2: np.ndarray) -> np.ndarray:
+        if self._prev is None:
+            flow = self._cold(g1, g2)
+        elif self.check_every > 0 and self._n % self.check_every == 0:
+            flow = self._cold(g1, g2)
+            self.drift.append(endpoint_error(self._warm(g1, g2, self._prev), flow))
+        else:
+            flow = self._warm(g1, g2, self._prev)
+        self._prev = flow
+        self._n += 1
+        return flow
+
+
+def tile_halo(engine: str = DEFAULT_ENGINE, preset: str | None = None) -> int:
+    """Return the tile overlap in pixels needed for seamless tiled flow.
+
+    For Farnebäck this is the support of one estimate at the finest level
+    (half the averaging window plus the polynomial expansion neighbourhood),
+    scaled by the pyramid: a pixel at level ``k`` covers ``pyr_scale**-k``
+    input pixels. Other engines fall back to :data:`DEFAULT_TILE_HALO`.
+    """
+    params = engine_params(engine, preset)
+    if engine != "farneback":
+        return DEFAULT_TILE_HALO
+    support = int(params["winsize"]) // 2 + int(params["poly_n"])
+    return math.ceil(support / float(params["pyr_scale"]) ** (int(params["levels"]) - 1))
+
+
+def _feather(start: int, stop: int, n: int, core: tuple[int, int], band: int) -> np.ndarray:
+    """1-D blend weights of a tile spanning ``start:stop`` of an axis of length ``n``.
+
+    Weights are 1 over the core, ramp linearly to 0 over ``band`` pixels just
+    outside each interior core edge and stay 0 further out, where the tile's
+    own border starts to affect the flow. Frame edges are not feathered.
+    """
+    i = np.arange(start, stop, dtype=np.float32) + 0.5
+    w = np.ones(stop - start, dtype=np.float32)
+    if start > 0:
+        w = np.minimum(w, np.clip((i - core[0]) / band + 1, 0, 1))
+    if stop < n:
+        w = np.minimum(w, np.clip((core[1] - i) / band + 1, 0, 1))
+    return w
+
+
+class TiledFlow:
+    """Compute dense flow of large frames tile by tile on a thread pool.
+
+    The frame is split into ``tile``-sized cores, each extended by ``halo``
+    pixels of context on interior sides. Tiles are processed in parallel
+    (OpenCV releases the GIL) with one engine instance per thread, and the
+    tile flows are blended with weights that are 1 over each core and ramp
+    down over ``halo // 4`` pixels across the core edge, so neighbouring
+    tiles cross-fade instead of meeting at a hard seam.
+
+    Args:
+        engine: Engine name from :data:`ENGINES`.
+        preset: Engine preset; ``None`` picks the default.
+        tile: Core tile size in pixels.
+        halo: Overlap in pixels; ``None`` uses :func:`tile_halo`.
+        threads: Tile worker threads; ``None`` uses OpenCV's thread count, so
+            a process-pool worker stays within its ``cv2.setNumThreads`` budget.
+    """
+
+    def __init__(
+        self,
+        engine: str = DEFAULT_ENGINE,
+        preset: str | None = None,
+        tile: int = 1024,
+        halo: int | None = None,
+        threads: int | None = None,
+    ) -> None:
+        if tile < 1:
+            raise ValueError(f"tile must be >= 1, got {tile}")
+        self._params = engine_params(engine, preset)
+        self._factory = ENGINES[engine].factory
+        self.tile = tile
+        self.halo = tile_halo(engine, preset) if halo is None else halo
+        self.threads = threads or max(1, cv2.getNumThreads())
+        # Stateful engines (DIS, TV-L1) are not thread-safe: one per thread.
+        self._local = threading.local()
+
+    def _calc(self, g1: np.ndarray, g2: np.ndarray) -> np.ndarray:
+        calc: FlowFn | None = getattr(self._local, "calc", None)
+        if calc is None:
+            calc = self._local.calc = self._factory(self._params)
+        return calc(g1, g2)
+
+    def __call__(self, g1: np.ndarray, g2: np.ndarray) -> np.ndarray:
+        h, w = g1.shape
+        if h <= self.tile and w <= self.tile:
+            return self._calc(g1, g2)
+        band = max(1, self.halo // 4)
+        boxes = []
+        for y0 in range(0, h, self.tile):
+            for x0 in range(0, w, self.tile):
+                y1, x1 = min(y0 + self.tile, h), min(x0 + self.tile, w)
+                ys = slice(max(0, y0 - self.halo), min(h, y1 + self.halo))
+                xs = slice(max(0, x0 - self.halo), min(w, x1 + self.halo))
+                boxes.append((ys, xs, (y0, y1), (x0, x1)))
+
+        acc = np.zeros((h, w, 2), dtype=np.float32)
+        weight = np.zeros((h, w), dtype=np.float32)
+        with ThreadPoolExecutor(self.threads, thread_name_prefix="flow-tile") as pool:
+            flows = pool.map(lambda b: self._calc(g1[b[0], b[1]], g2[b[0], b[1]]), boxes)
+            for (ys, xs, core_y, core_x), flow in zip(boxes, flows, strict=True):
+                wy = _feather(ys.start, ys.stop, h, core_y, band)
+                wx = _feather(xs.start, xs.stop, w, core_x, band)
+                tw = wy[:, None] * wx[None, :]
+                acc[ys, xs] += flow * tw[..., None]
+                weight[ys, xs] += tw
+        acc /= weight[..., None]
+        return acc
+
+
+def synthetic_flow_pair(
+    h: int, w: int, rng: np.random.Generator, amplitude: float = 2.0
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Create two frames related by a known smooth flow field.
+
+    A blurred-noise texture is backward-warped with ``cv2.remap`` by a
+    sinusoidal displacement of up to ``amplitude`` pixels.
+
+    Returns:
+        ``(frame1, frame2, flow)`` with ``uint8`` frames and the ``(H, W, 2)``
+        ground-truth flow from ``frame1`` to ``frame2``.
+    """
+    texture = cv2.GaussianBlur(rng.normal(128, 60, size=(h, w)).astype(np.float32), (0, 0), 2.0)
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    u = amplitude * np.sin(2 * np.pi * yy / h) * np.cos(np.pi * xx / w)
+    v = amplitude * np.cos(2 * np.pi * xx / w) * np.sin(np.pi * yy / h)
+    # frame2(p) = frame1(p - flow(p)), i.e. content moves by +flow.
+    warped = cv2.remap(texture, xx - u, yy - v, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
+    frame1 = np.clip(texture, 0, 255).astype(np.uint8)
+    frame2 = np.clip(warped, 0, 255).astype(np.uint8)
+    return frame1, frame2, np.dstack([u, v]).astype(np.float32)
+
+
+def endpoint_error(flow: np.ndarray, truth: np.ndarray, margin: int = 0) -> float:
+    """Mean Euclidean distance between two flow fields, ignoring a border ``margin``."""
+    if margin:
+        flow = flow[margin:-margin, margin:-margin]
+        truth = truth[margin:-margin, margin:-margin]
+    return float(np.linalg.norm(flow - truth, axis=-1).mean())
+
+
+def benchmark_engines(
+    engines: Sequence[tuple[str, str | None]],
+    size: tuple[int, int] = (512, 512),
+    n_pairs: int = 5,
+    seed: int = 0,
+) -> list[dict[str, Any]]:
+    """Time each ``(engine, preset)`` on synthetic pairs with known flow.
+
+    Returns:
+        One row per engine with ``engine``, ``preset``, ``fps`` (frame pairs
+        per second, excluding engine construction) and ``epe`` (mean endpoint
+        error in pixels, ignoring a 16 px border).
+    """
+    rng = np.random.default_rng(seed)
+    pairs = [synthetic_flow_pair(*size, rng) for _ in range(n_pairs)]
+    rows: list[dict[str, Any]] = []
+    for engine, preset in engines:
+        calc = make_engine(engine, preset)
+        calc(pairs[0][0], pairs[0][1])  # warm-up: lazy allocations, thread pools
+        t0 = time.perf_counter()
+        flows = [calc(f1, f2) for f1, f2, _ in pairs]
+        elapsed = time.perf_counter() - t0
+        errors = [
+            endpoint_error(f, truth, margin=16)
+            for f, (_, _, truth) in zip(flows, pairs, strict=True)
+        ]
+        rows.append(
+            {
+                "engine": engine,
+                "preset": preset or ENGINES[engine].default_preset,
+                "fps": n_pairs / elapsed,
+                "epe": float(np.mean(errors)),
+            }
+        )
+    return rows
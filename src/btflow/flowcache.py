@@ -0,0 +1,134 @@
+"""Content-addressed on-disk cache of raw optical-flow fields.
+
+Optical flow is by far the most expensive step of ``btflow defmap``, yet it
+only depends on the two input frames, the colour channel, the crop and the
+flow parameters. :class:`FlowCache` stores the raw ``(H, W, 2)`` flow of a
+frame pair under a key derived from exactly those inputs, so reruns that only
+change ``sigma`` or the metric skip the flow computation entirely.
+
+Entries are plain ``.npy`` files (``float16`` by default, halving the size of
+the ``float32`` flow at ~1e-3 px resolution) in a two-level fan-out under the
+cache root. The cache is bounded by ``max_bytes`` with least-recently-used
+eviction based on file modification times, which are bumped on every hit.
+Writes go through a temporary file and ``os.replace``, so several processes
+can share one cache directory.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+# Bump when the stored layout or key derivation changes.
+_CACHE_VERSION = 1
+
+DEFAULT_MAX_BYTES = 20 * 2**30
+
+
+def file_digest(path: Path) -> str:
+    """Return the BLAKE2b hex digest of the file's contents."""
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, "blake2b").hexdigest()
+
+
+class FlowCache:
+    """Size-bounded LRU cache of flow fields keyed by input content.
+
+    Args:
+        root: Cache directory. Created if missing.
+        max_bytes: Upper bound on the total size of cached entries.
+        dtype: Storage dtype for flow fields (``float16`` or ``float32``).
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        dtype: type[np.floating[Any]] = np.float16,
+    ) -> None:
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self._size = sum(p.stat().st_size for p in self._entries())
+
+    def key(self, digest1: str, digest2: str, params: dict[str, Any]) -> str:
+        """Derive the cache key for a frame pair.
+
+        Args:
+            digest1: Content digest of the first frame (see :func:`file_digest`).
+            digest2: Content digest of the second frame.
+            params: Everything else the flow depends on (channel, crop, flow
+                parameters, ...). Must be JSON-serialisable.
+        """
+        payload = json.dumps(
+            [_CACHE_VERSION, self.dtype.str, digest1, digest2, params], sort_keys=True
+        )
+        return hashlib.blake2b(payload.encode(), digest_size=20).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.npy"
+
+    def _entries(self) -> list[Path]:
+        return list(self.root.glob("*/*.npy"))
+
+    def __contains__(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def get(self, key: str) -> np.ndarray | None:
+        """Return the cached ``float32`` flow for ``key``, or ``None`` on a miss."""
+        path = self._path(key)
+        try:
+            flow: np.ndarray = np.load(path)
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            # Evicted by another process, or a truncated file from a crashed writer.
+            return None
+        return flow.astype(np.float32)
+
+    def put(self, key: str, flow: np.ndarray) -> np.ndarray:
+        """Store ``flow`` under ``key`` and evict old entries if over budget.
+
+        Returns:
+            The stored flow as ``float32``, i.e. exactly what :meth:`get`
+            returns for ``key``. Callers should use it instead of ``flow`` so
+            that results do not depend on whether the cache was cold or warm.
+        """
+        stored = flow.astype(self.dtype)
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_name(f"{path.stem}.{os.getpid()}.tmp")
+        with tmp.open("wb") as f:
+            np.save(f, stored)
+        try:
+            replaced = path.stat().st_size
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp, path)
+        self._size += path.stat().st_size - replaced
+        if self._size > self.max_bytes:
+            self.evict()
+        return stored.astype(np.float32)
+
+    def evict(self) -> None:
+        """Delete least-recently-used entries until the cache fits ``max_bytes``."""
+        entries: list[tuple[float, int, Path]] = []
+        for p in self._entries():
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in entries:
+            if total <= self.max_bytes:
+                break
+            p.unlink(missing_ok=True)
+            total -= size
+        self._size = total
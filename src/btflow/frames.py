@@ -0,0 +1,156 @@
+"""Frame sources that decode every input frame exactly once.
+
+``FrameSource`` walks an ordered list of frame files and yields each one as a
+single-plane ``uint8`` array (grayscale or one colour channel, optionally
+cropped). Decoding runs ahead of the consumer on a background reader thread
+through a bounded queue, so PNG decoding overlaps with whatever the consumer
+does with the frames. OpenCV releases the GIL while decoding, so the overlap
+is real even though the reader is a thread rather than a process.
+
+Frames can be decoded at 1/2 or 1/4 resolution via OpenCV's
+``IMREAD_REDUCED_*`` flags, which average pixel blocks while decoding (and
+skip most of the work for JPEG input).
+"""
+
+from __future__ import annotations
+
+import queue
+import threading
+from collections.abc import Iterator, Sequence
+from pathlib import Path
+from types import TracebackType
+
+import cv2
+import numpy as np
+
+from .io import imread
+
+# Supported decode-time reduction factors and their OpenCV flags.
+DOWNSCALES = (1, 2, 4)
+_READ_FLAGS = {
+    (1, False): cv2.IMREAD_GRAYSCALE,
+    (2, False): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    (4, False): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    (1, True): cv2.IMREAD_COLOR,
+    (2, True): cv2.IMREAD_REDUCED_COLOR_2,
+    (4, True): cv2.IMREAD_REDUCED_COLOR_4,
+}
+
+
+def read_plane(
+    path: Path,
+    channel: int | None = None,
+    crop: tuple[int, int, int, int] | None = None,
+    downscale: int = 1,
+) -> np.ndarray:
+    """Decode one frame as a single 2-D plane.
+
+    Args:
+        path: Image file to decode.
+        channel: Colour channel index (0/1/2, BGR order) or ``None`` for grayscale.
+        crop: Optional ``(x0, y0, w, h)`` crop box in full-resolution pixels.
+        downscale: Decode at ``1/downscale`` resolution, one of :data:`DOWNSCALES`.
+            The crop box is scaled down accordingly.
+
+    Returns:
+        A ``(H, W)`` array. In channel mode only the cropped plane is copied
+        out of the decoded BGR image; the other two planes are never split out.
+    """
+    if downscale not in DOWNSCALES:
+        raise ValueError(f"downscale must be one of {DOWNSCALES}, got {downscale}")
+    img = imread(path, _READ_FLAGS[downscale, channel is not None])
+    if crop is not None:
+        x0, y0, w, h = (v // downscale for v in crop)
+        img = img[y0 : y0 + h, x0 : x0 + w]
+    if channel is not None:
+        img = np.ascontiguousarray(img[..., channel])
+    return img
+
+
+class FrameSource:
+    """Iterate over decoded frames with background prefetching.
+
+    Each path is decoded once, in order. Up to ``prefetch`` decoded frames are
+    buffered ahead of the consumer; the reader thread blocks when the buffer is
+    full, so memory stays bounded regardless of sequence length. Decoding
+    errors are re-raised in the consuming thread.
+
+    Use as a context manager so the reader thread is stopped even when the
+    consumer bails out early::
+
+        with FrameSource(paths, channel=1) as frames:
+            for img in frames:
+                ...
+    """
+
+    def __init__(
+        self,
+        paths: Sequence[Path],
+        channel: int | None = None,
+        crop: tuple[int, int, int, int] | None = None,
+        prefetch: int = 4,
+        downscale: int = 1,
+    ) -> None:
+        if prefetch < 1:
+            raise ValueError(f"prefetch must be >= 1, got {prefetch}")
+        self.paths = list(paths)
+        self.channel = channel
+        self.crop = crop
+        self.downscale = downscale
+        # ``None`` marks the end of the sequence; exceptions are forwarded as items.
+        self._queue: queue.Queue[np.ndarray | Exception | None] = queue.Queue(maxsize=prefetch)
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def _put(self, item: np.ndarray | Exception | None) -> bool:
+        # Poll so that close() can interrupt a reader blocked on a full queue.
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read_all(self) -> None:
+        try:
+            for path in self.paths:
+                if not self._put(read_plane(path, self.channel, self.crop, self.downscale)):
+                    return
+        except Exception as exc:  # forwarded to the consumer, not swallowed
+            self._put(exc)
+            return
+        self._put(None)
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        if self._thread is not None:
+            raise RuntimeError("FrameSource can only be iterated once")
+        self._thread = threading.Thread(target=self._read_all, name="frame-reader", daemon=True)
+        self._thread.start()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self) -> None:
+        """Stop the reader thread and drop any prefetched frames."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> FrameSource:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> None:
+        self.close()
@@ -3,7 +3,9 @@
 from __future__ import annotations
 
 import re
+import struct
 from pathlib import Path
+from typing import BinaryIO
 
 import cv2
 import numpy as np
@@ -13,6 +15,11 @@ from ._types import BBox
 # Matches filenames of the form ``..._t<digits>_z<digits>.<ext>``
 RAW_FRAME_PATTERN = re.compile(r".+?_t(\d+)_z(\d+)\.(png|tif|tiff|jpg|jpeg)$", re.IGNORECASE)
 
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# TIFF tag ids and the struct formats of the SHORT and LONG field types.
+_TIFF_WIDTH, _TIFF_LENGTH = 256, 257
+_TIFF_TYPES = {3: "H", 4: "I", 16: "Q"}
+
 
 def imread(path: Path, flags: int = cv2.IMREAD_COLOR) -> np.ndarray:
     """Read an image from disk, raising ``FileNotFoundError`` on failure.
@@ -27,6 +34,58 @@ def imread(path: Path, flags: int = cv2.IMREAD_COLOR) -> np.ndarray:
     return img
 
 
+def _tiff_size(f: BinaryIO, order: str, big: bool) -> tuple[int, int]:
+    """Read width and height from the first IFD of a (Big)TIFF file."""
+    if big:
+        f.seek(8)
+        (offset,) = struct.unpack(order + "Q", f.read(8))
+        count_fmt, entry_fmt, entry_size = "Q", "HHQ8s", 20
+    else:
+        f.seek(4)
+        (offset,) = struct.unpack(order + "I", f.read(4))
+        count_fmt, entry_fmt, entry_size = "H", "HHI4s", 12
+    f.seek(offset)
+    count_size = struct.calcsize(count_fmt)
+    (n_entries,) = struct.unpack(order + count_fmt, f.read(count_size))
+    entries = f.read(n_entries * entry_size)
+    size: dict[int, int] = {}
+    for i in range(n_entries):
+        tag, typ, _, value = struct.unpack_from(order + entry_fmt, entries, i * entry_size)
+        if tag in (_TIFF_WIDTH, _TIFF_LENGTH) and typ in _TIFF_TYPES:
+            fmt = order + _TIFF_TYPES[typ]
+            size[tag] = struct.unpack_from(fmt, value)[0]
+    if len(size) != 2:
+        raise ValueError("TIFF file has no ImageWidth/ImageLength tags")
+    return size[_TIFF_WIDTH], size[_TIFF_LENGTH]
+
+
+def image_size(path: Path) -> tuple[int, int]:
+    """Return the ``(width, height)`` of an image without decoding its pixels.
+
+    PNG sizes come from the ``IHDR`` chunk and TIFF sizes from the first
+    image file directory; other formats fall back to a full :func:`imread`.
+
+    Raises:
+        FileNotFoundError: If the file is missing or cannot be decoded.
+        ValueError: If a PNG or TIFF header is malformed.
+    """
+    with path.open("rb") as f:
+        head = f.read(24)
+        if head.startswith(_PNG_SIGNATURE):
+            if head[12:16] != b"IHDR":
+                raise ValueError(f"PNG file without IHDR chunk: {path}")
+            width, height = struct.unpack(">II", head[16:24])
+            return int(width), int(height)
+        if head[:4] in (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+"):
+            order = "<" if head[:2] == b"II" else ">"
+            try:
+                return _tiff_size(f, order, big=head[2:4] in (b"+\x00", b"\x00+"))
+            except (struct.error, ValueError) as exc:
+                raise ValueError(f"Malformed TIFF header in {path}: {exc}") from exc
+    h, w = imread(path, cv2.IMREAD_UNCHANGED).shape[:2]
+    return w, h
+
+
 def parse_frame_filename(name: str) -> tuple[int, int] | None:
     """Extract ``(t, z)`` indices from a raw frame filename, or ``None`` on no match."""
     m = RAW_FRAME_PATTERN.match(name)
@@ -1,9 +1,32 @@
-"""Intersection-over-Union helpers for axis-aligned bounding boxes."""
+"""Intersection-over-Union helpers for axis-aligned bounding boxes.
+
+:func:`calculate_iou` compares two boxes. :func:`calculate_iou_matrix` compares
+every box of one set with every box of another through NumPy broadcasting, and
+:func:`calculate_iou_batch` does the same for many frames at once, with
+frames of different box counts zero-padded by :func:`pad_boxes`.
+
+On dense frames almost no pairs overlap. :func:`sparse_iou` returns only the
+pairs with positive IoU. Above :data:`SWEEP_MIN_PAIRS` pairs it finds them with a
+sort-and-sweep index (:func:`candidate_pairs`) instead of the full matrix. All
+boxes are ``(x, y, width, height)``.
+"""
 
 from __future__ import annotations
 
+from collections.abc import Sequence
+
+import numpy as np
+
 from ._types import BBox
 
+# Frames per block in ``calculate_iou_batch`` are chosen so that the (F, N, M)
+# temporaries stay cache-sized.
+_BLOCK_ELEMENTS = 2**16
+
+# ``sparse_iou`` uses the sweep index once ``N * M`` exceeds this; measured with
+# ``scripts/bench_iou.py``.
+SWEEP_MIN_PAIRS = 5_000
+
 
 def calculate_iou(box1: BBox, box2: BBox) -> float:
     """Compute the Intersection-over-Union of two ``(x, y, w, h)`` boxes.
@@ -32,3 +55,160 @@ def calculate_iou(box1: BBox, box2: BBox) -> float:
     if union_area == 0:
         return 0.0
     return inter_area / union_area
+
+
+def _as_boxes(boxes: np.ndarray | Sequence[BBox]) -> np.ndarray:
+    arr = np.asarray(boxes, dtype=np.float64)
+    if arr.ndim == 1 and arr.size == 0:
+        arr = arr.reshape(0, 4)
+    if arr.shape[-1] != 4:
+        raise ValueError(f"expected boxes of shape (..., 4), got {arr.shape}")
+    return arr
+
+
+def _iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """IoU of ``(..., N, 4)`` against ``(..., M, 4)`` boxes, shape ``(..., N, M)``."""
+    # Corners and areas are per box; only the overlap needs the (N, M) broadcast.
+    ax0, ay0, aw, ah = (a[..., :, None, k] for k in range(4))
+    bx0, by0, bw, bh = (b[..., None, :, k] for k in range(4))
+    iw = np.minimum(ax0 + aw, bx0 + bw)
+    iw -= np.maximum(ax0, bx0)
+    ih = np.minimum(ay0 + ah, by0 + bh)
+    ih -= np.maximum(ay0, by0)
+    inter = np.maximum(iw, 0.0, out=iw)
+    inter *= np.maximum(ih, 0.0, out=ih)
+    union = (aw * ah) + (bw * bh)
+    union -= inter
+    iou: np.ndarray = np.divide(inter, union, out=np.zeros_like(inter), where=union != 0)
+    return iou
+
+
+def calculate_iou_matrix(
+    boxes_a: np.ndarray | Sequence[BBox], boxes_b: np.ndarray | Sequence[BBox]
+) -> np.ndarray:
+    """Compute the IoU of every box in ``boxes_a`` with every box in ``boxes_b``.
+
+    Args:
+        boxes_a: ``(N, 4)`` array (or sequence) of ``(x, y, width, height)`` boxes.
+        boxes_b: ``(M, 4)`` array (or sequence) of boxes.
+
+    Returns:
+        ``(N, M)`` ``float64`` array with ``iou[i, j] == calculate_iou(a[i], b[j])``;
+        pairs without a union (both boxes of zero area) are ``0.0``.
+    """
+    a, b = _as_boxes(boxes_a), _as_boxes(boxes_b)
+    if a.ndim != 2 or b.ndim != 2:
+        raise ValueError(f"expected (N, 4) and (M, 4) boxes, got {a.shape} and {b.shape}")
+    return _iou(a, b)
+
+
+def pad_boxes(frames: Sequence[np.ndarray | Sequence[BBox]]) -> tuple[np.ndarray, np.ndarray]:
+    """Stack per-frame box lists of different lengths into one padded array.
+
+    Missing boxes are filled with zeros; a zero-area box has IoU ``0.0`` with
+    every other box, so padding never produces a match.
+
+    Returns:
+        ``(boxes, counts)``: a ``(F, max_count, 4)`` ``float64`` array and the
+        ``(F,)`` number of real boxes per frame.
+    """
+    arrays = [_as_boxes(f).reshape(-1, 4) for f in frames]
+    counts = np.array([len(a) for a in arrays], dtype=np.intp)
+    boxes = np.zeros((len(arrays), int(counts.max(initial=0)), 4), dtype=np.float64)
+    for i, a in enumerate(arrays):
+        boxes[i, : len(a)] = a
+    return boxes, counts
+
+
+def calculate_iou_batch(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """Compute per-frame IoU matrices for a batch of frames.
+
+    One call replaces a Python loop over :func:`calculate_iou_matrix`, which
+    pays off when frames hold a few dozen boxes or fewer. With hundreds of
+    boxes per frame the per-call overhead is negligible and the padding to
+    the largest frame costs more than it saves.
+
+    Args:
+        boxes_a: ``(F, N, 4)`` boxes per frame, e.g. from :func:`pad_boxes`.
+        boxes_b: ``(F, M, 4)`` boxes per frame.
+
+    Returns:
+        ``(F, N, M)`` array whose ``[f]`` slice is
+        ``calculate_iou_matrix(boxes_a[f], boxes_b[f])``.
+    """
+    a, b = _as_boxes(boxes_a), _as_boxes(boxes_b)
+    if a.ndim != 3 or b.ndim != 3 or a.shape[0] != b.shape[0]:
+        raise ValueError(f"expected (F, N, 4) and (F, M, 4) boxes, got {a.shape} and {b.shape}")
+    n_frames, n, m = a.shape[0], a.shape[1], b.shape[1]
+    out = np.empty((n_frames, n, m), dtype=np.float64)
+    step = max(1, _BLOCK_ELEMENTS // max(1, n * m))
+    for f0 in range(0, n_frames, step):
+        out[f0 : f0 + step] = _iou(a[f0 : f0 + step], b[f0 : f0 + step])
+    return out
+
+
+def candidate_pairs(
+    boxes_a: np.ndarray | Sequence[BBox], boxes_b: np.ndarray | Sequence[BBox]
+) -> tuple[np.ndarray, np.ndarray]:
+    """Find the box pairs whose extents overlap with positive area.
+
+    Sort-and-sweep along ``x``: ``boxes_b`` are sorted by their left edge, and
+    two binary searches per box of ``boxes_a`` bound the ``b`` boxes that can
+    reach it (using the widest ``b`` box). Those candidates are then checked
+    exactly in both axes. Cost grows with the number of candidates rather
+    than with ``N * M``.
+
+    Returns:
+        ``(rows, cols)`` indices into ``boxes_a`` and ``boxes_b``, sorted by
+        ``rows`` and then by left edge of the ``b`` box. These are exactly the
+        pairs with ``calculate_iou > 0``.
+    """
+    a, b = _as_boxes(boxes_a), _as_boxes(boxes_b)
+    if a.ndim != 2 or b.ndim != 2:
+        raise ValueError(f"expected (N, 4) and (M, 4) boxes, got {a.shape} and {b.shape}")
+    if not len(a) or not len(b):
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    order = np.argsort(b[:, 0], kind="stable")
+    left = b[order, 0]
+    # ``b`` reaches past the left edge of ``a`` only if it starts within the widest width.
+    lo = np.searchsorted(left, a[:, 0] - b[:, 2].max(), side="right")
+    hi = np.searchsorted(left, a[:, 0] + a[:, 2], side="left")
+    counts = np.maximum(hi - lo, 0)
+    rows = np.repeat(np.arange(len(a)), counts)
+    starts = np.cumsum(counts) - counts
+    cols = order[np.repeat(lo - starts, counts) + np.arange(len(rows))]
+    pa, pb = a[rows], b[cols]
+    overlap = (
+        np.minimum(pa[:, 0] + pa[:, 2], pb[:, 0] + pb[:, 2]) > np.maximum(pa[:, 0], pb[:, 0])
+    ) & (np.minimum(pa[:, 1] + pa[:, 3], pb[:, 1] + pb[:, 3]) > np.maximum(pa[:, 1], pb[:, 1]))
+    return rows[overlap], cols[overlap]
+
+
+def sparse_iou(
+    boxes_a: np.ndarray | Sequence[BBox],
+    boxes_b: np.ndarray | Sequence[BBox],
+    method: str = "auto",
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Compute the IoU of only the box pairs that overlap.
+
+    Args:
+        boxes_a: ``(N, 4)`` boxes.
+        boxes_b: ``(M, 4)`` boxes.
+        method: ``"dense"`` evaluates :func:`calculate_iou_matrix`, ``"sweep"``
+            uses :func:`candidate_pairs`, and ``"auto"`` picks the sweep once
+            ``N * M`` exceeds :data:`SWEEP_MIN_PAIRS`.
+
+    Returns:
+        ``(rows, cols, ious)`` of all pairs with positive IoU, sorted by
+        ``rows`` (the order within a row depends on ``method``).
+    """
+    if method not in ("auto", "dense", "sweep"):
+        raise ValueError(f"method must be 'auto', 'dense' or 'sweep', got {method!r}")
+    a, b = _as_boxes(boxes_a), _as_boxes(boxes_b)
+    if method == "dense" or (method == "auto" and len(a) * len(b) <= SWEEP_MIN_PAIRS):
+        matrix = calculate_iou_matrix(a, b)
+        rows, cols = np.nonzero(matrix)
+        return rows, cols, matrix[rows, cols]
+    rows, cols = candidate_pairs(a, b)
+    ious = _iou(a[rows, None, :], b[cols, None, :])[:, 0, 0]
+    return rows, cols, ious
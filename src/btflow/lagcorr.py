@@ -10,101 +10,399 @@ from __future__ import annotations
 
 import argparse
 import re
+from collections.abc import Sequence
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from multiprocessing import get_context
 from pathlib import Path
 
+import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from scipy.stats import pearsonr
+from scipy.stats import beta
+
+from .defmap import METRICS as DEFMAP_METRICS
+from .integral import IntegralStack
+from .stackio import ChunkedStack, open_stack
 
 DEFAULT_LAGS: tuple[int, ...] = tuple(range(-10, 11))
 DEFAULT_SCALES_DIV: tuple[float, ...] = (1.5, 2.0, 2.5)
 DEFAULT_SCALES_MAG: tuple[float, ...] = (1.0, 1.5, 2.0)
+METRICS: tuple[str, ...] = ("div", "mag")
+ROI_MODES: tuple[str, ...] = ("exact", "fast", "box")
+
+# Upper bound on gathered window elements held at once by the fast ROI path.
+_GATHER_ELEMENTS = 2**22
+# Detections sampled per batch before their rows are folded into LagStats.
+_BATCH_DETECTIONS = 4096
 
 _FRAME_PAT = re.compile(r"frame_(\d+)\.txt$")
+# Metric suffix of ``build_defmap_stacks`` output names, e.g. ``defmap_stack_Z1_div``.
+_METRIC_SUFFIX = re.compile(rf"_({'|'.join(DEFMAP_METRICS)})$")
+_LABEL_COLUMNS = ("cls", "x_c", "y_c", "w", "h", "conf")
+
+
+def _load_detections(label_dir: Path) -> np.ndarray:
+    """Parse every ``frame_*.txt`` label file into one array.
+
+    Returns:
+        A ``(N, 6)`` float array with columns ``frame, x_c, y_c, w, h, conf``,
+        in file order. A missing confidence column reads as ``NaN``.
+    """
+    parts: list[np.ndarray] = []
+    for txt in sorted(label_dir.glob("frame_*.txt")):
+        m = _FRAME_PAT.search(txt.name)
+        if not m:
+            continue
+        try:
+            df = pd.read_csv(txt, sep=" ", header=None, names=_LABEL_COLUMNS)
+        except pd.errors.EmptyDataError:
+            continue
+        det = np.empty((len(df), 6))
+        det[:, 0] = int(m.group(1))
+        det[:, 1:] = df[list(_LABEL_COLUMNS[1:])].to_numpy(dtype=float)
+        parts.append(det)
+    return np.concatenate(parts) if parts else np.empty((0, 6))
+
+
+def _confident(detections: np.ndarray, conf_min: float) -> np.ndarray:
+    """Drop detections with confidence ``<= conf_min``; those without one (``NaN``) are kept."""
+    kept: np.ndarray = detections[~(detections[:, 5] <= conf_min)]
+    return kept
+
+
+@lru_cache(maxsize=4096)
+def _roi_kernel(roi_r: int, h_p: int, w_p: int) -> np.ndarray:
+    """Normalised Gaussian weights (``sigma = roi_r / 1.5``) centred on an ``(h_p, w_p)`` patch."""
+    y_grid, x_grid = np.mgrid[0:h_p, 0:w_p]
+    cy, cx = (h_p - 1) / 2, (w_p - 1) / 2
+    sigma = roi_r / 1.5
+    kernel: np.ndarray = np.exp(-((x_grid - cx) ** 2 + (y_grid - cy) ** 2) / (2 * sigma**2))
+    kernel /= kernel.sum()
+    kernel.flags.writeable = False
+    return kernel
+
+
+def _sample_windows(
+    defmaps: np.ndarray | ChunkedStack,
+    frames: np.ndarray,
+    xs: np.ndarray,
+    ys: np.ndarray,
+    roi: np.ndarray,
+    lag_arr: np.ndarray,
+    todo: np.ndarray,
+    values: np.ndarray,
+    valid: np.ndarray,
+) -> None:
+    """Fill ``values[s, i, lag]`` for the ``todo[i, s]`` ROIs by reading each window directly.
+
+    For each detection, one window covering its largest ROI is read for all
+    valid lags at once; every scale is a sub-window of it, reduced over all
+    lags with a single ``einsum``.
+    """
+    n, h, w = defmaps.shape
+    for i in np.flatnonzero(todo.any(axis=1)):
+        t, x, y = int(frames[i]), int(xs[i]), int(ys[i])
+        t_def = t + lag_arr
+        in_stack = (t_def >= 1) & (t_def <= n)
+        if not in_stack.any():
+            continue
+        r_max = int(roi[i][todo[i]].max())
+        idx = t_def[in_stack] - 1
+        t0 = int(idx.min())
+        wy0, wx0 = max(0, y - r_max), max(0, x - r_max)
+        window = np.asarray(
+            defmaps[t0 : int(idx.max()) + 1, wy0 : y + r_max + 1, wx0 : x + r_max + 1]
+        )[idx - t0]
+        for s in np.flatnonzero(todo[i]):
+            roi_r = int(roi[i, s])
+            y0, x0 = max(0, y - roi_r), max(0, x - roi_r)
+            patch = window[
+                :, y0 - wy0 : min(h, y + roi_r + 1) - wy0, x0 - wx0 : min(w, x + roi_r + 1) - wx0
+            ]
+            kernel = _roi_kernel(roi_r, patch.shape[1], patch.shape[2])
+            values[s, i, in_stack] = np.einsum("lij,ij->l", patch, kernel)
+            valid[s, i, in_stack] = True
+
+
+def _roi_samples(
+    frames: np.ndarray, lag_arr: np.ndarray, todo: np.ndarray, n: int
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Flatten the ``todo[i, s]`` ROIs over all lags that land inside an ``n``-frame stack.
+
+    Returns:
+        ``(scale, detection, lag, frame)`` index arrays, with 0-based frames.
+    """
+    s_idx, i_idx = np.nonzero(todo.T)
+    s_all = np.repeat(s_idx, len(lag_arr))
+    i_all = np.repeat(i_idx, len(lag_arr))
+    l_all = np.tile(np.arange(len(lag_arr)), len(s_idx))
+    t_all = frames[i_all] + lag_arr[l_all] - 1
+    keep = (t_all >= 0) & (t_all < n)
+    return s_all[keep], i_all[keep], l_all[keep], t_all[keep]
+
+
+def _sample_blurred(
+    defmaps: np.ndarray | ChunkedStack,
+    frames: np.ndarray,
+    xs: np.ndarray,
+    ys: np.ndarray,
+    roi: np.ndarray,
+    lag_arr: np.ndarray,
+    todo: np.ndarray,
+    values: np.ndarray,
+    valid: np.ndarray,
+) -> None:
+    """Fill ``values[s, i, lag]`` for the ``todo[i, s]`` interior ROIs, streaming frame by frame.
+
+    An ROI that lies entirely inside the frame is the frame convolved with
+    its separable kernel ``g gᵀ``, evaluated at the detection. Each frame is
+    read once, and the samples on it are grouped by radius: a group that is
+    dense enough to amortise a full-frame blur reads its values from the
+    blurred frame with one fancy index; sparser groups contract the gathered
+    windows with ``g`` along both axes instead. Memory stays at a few frames
+    regardless of stack length or the number of scales.
+    """
+    _, h, w = defmaps.shape
+    s_all, i_all, l_all, t_all = _roi_samples(frames, lag_arr, todo, len(defmaps))
+    r_all = roi[i_all, s_all]
+
+    order = np.lexsort((r_all, t_all))
+    t_sorted = t_all[order]
+    t_starts = np.flatnonzero(np.diff(t_sorted, prepend=-1))
+    for t_sel in np.split(order, t_starts[1:]):
+        if not len(t_sel):
+            continue
+        frame = np.asarray(defmaps[int(t_all[t_sel[0]])], dtype=np.float64)
+        r_starts = np.flatnonzero(np.diff(r_all[t_sel], prepend=-1))
+        for sel in np.split(t_sel, r_starts[1:]):
+            r = int(r_all[sel[0]])
+            g = np.exp(-(np.arange(-r, r + 1) ** 2) / (2 * (r / 1.5) ** 2))
+            g /= g.sum()
+            y, x = ys[i_all[sel]], xs[i_all[sel]]
+            # A blurred frame costs about as much as gathering H·W / (8·(2r+1)) windows.
+            if 8 * len(sel) * (2 * r + 1) >= h * w:
+                sampled = cv2.sepFilter2D(frame, cv2.CV_64F, g, g)[y, x]
+            else:
+                windows = np.lib.stride_tricks.sliding_window_view(frame, (2 * r + 1, 2 * r + 1))
+                step = max(1, _GATHER_ELEMENTS // (2 * r + 1) ** 2)
+                sampled = np.concatenate(
+                    [
+                        windows[y[k : k + step] - r, x[k : k + step] - r] @ g @ g
+                        for k in range(0, len(sel), step)
+                    ]
+                )
+            values[s_all[sel], i_all[sel], l_all[sel]] = sampled
+            valid[s_all[sel], i_all[sel], l_all[sel]] = True
 
 
 def _collect_rows(
-    defmaps: np.ndarray,
-    label_dir: Path,
+    defmaps: np.ndarray | ChunkedStack,
+    detections: np.ndarray,
     scales: tuple[float, ...],
     lags: tuple[int, ...],
     conf_min: float,
     use_abs: bool,
+    roi_mode: str = "exact",
+    integral: IntegralStack | None = None,
 ) -> pd.DataFrame:
-    n, h, w = defmaps.shape
-    rows: list[dict[str, float | int]] = []
-
-    for scale in scales:
-        for txt in sorted(label_dir.glob("frame_*.txt")):
-            m = _FRAME_PAT.search(txt.name)
-            if not m:
-                continue
-            t = int(m.group(1))
-            df = pd.read_csv(
-                txt, sep=" ", header=None, names=["cls", "x_c", "y_c", "w", "h", "conf"]
-            )
-            for _, r in df.iterrows():
-                x = int(r.x_c * w)
-                y = int(r.y_c * h)
-                if not (0 <= x < w and 0 <= y < h):
-                    continue
-                bb_w = int(r.w * w)
-                bb_h = int(r.h * h)
-                roi_r = int(max(bb_w, bb_h) * scale)
-                if roi_r <= 0:
-                    continue
-
-                for lag in lags:
-                    t_def = t + lag
-                    if t_def < 1 or t_def > n:
-                        continue
-                    y0 = max(0, y - roi_r)
-                    y1 = min(h, y + roi_r + 1)
-                    x0 = max(0, x - roi_r)
-                    x1 = min(w, x + roi_r + 1)
-                    patch = defmaps[t_def - 1, y0:y1, x0:x1]
-                    if patch.size == 0:
-                        continue
-
-                    h_p, w_p = patch.shape
-                    y_grid, x_grid = np.mgrid[0:h_p, 0:w_p]
-                    cy, cx = (h_p - 1) / 2, (w_p - 1) / 2
-                    sigma = roi_r / 1.5
-                    kernel = np.exp(-((x_grid - cx) ** 2 + (y_grid - cy) ** 2) / (2 * sigma**2))
-                    kernel /= kernel.sum()
-                    val = float((patch * kernel).sum())
-                    if use_abs:
-                        val = abs(val)
-                    if r.conf <= conf_min:
-                        continue
-                    rows.append(
-                        {
-                            "frame": t,
-                            "lag": lag,
-                            "conf": float(r.conf),
-                            "value": val,
-                            "scale": scale,
-                        }
-                    )
-
-    return pd.DataFrame(rows)
-
-
-def _correlation_table(tbl: pd.DataFrame, lags: tuple[int, ...]) -> pd.DataFrame:
-    rows_corr: list[dict[str, float | int | str]] = []
-    for lag in lags:
-        sub = tbl[tbl.lag == lag]
-        if len(sub) < 2:
-            print(f"lag {lag}: too few points")
-            continue
-        r, p = pearsonr(sub["value"], sub["conf"])
-        rows_corr.append({"lag": lag, "r": r, "p": p, "method": "Pearson"})
-    return pd.DataFrame(rows_corr).set_index("lag").reindex(list(lags))
+    """Gaussian-weighted ROI means of ``defmaps`` around every detection, per lag and scale.
+
+    ``detections`` comes from :func:`_load_detections` and is filtered by
+    ``conf_min`` (see :func:`_confident`) before any stack access. In ``"exact"`` mode every ROI window is read and weighted
+    directly (:func:`_sample_windows`). In ``"fast"`` mode ROIs inside the
+    frame are read from blurred frames (:func:`_sample_blurred`), whose cost
+    does not grow with the number of detections; ROIs clipped by the frame
+    border keep the patch-centred, renormalised kernel of the exact path.
+    In ``"box"`` mode the ROI is the unweighted ``(2r + 1)²`` box, clipped to
+    the frame; means and variances come from ``integral`` (built in memory
+    from ``defmaps`` when omitted) and the table gains a ``var`` column.
+    Rows are ordered by scale, then detection (label file and line order),
+    then lag.
+    """
+    if roi_mode not in ROI_MODES:
+        raise ValueError(f"roi_mode must be one of {ROI_MODES}, got {roi_mode!r}")
+    _, h, w = defmaps.shape
+    det = _confident(detections, conf_min)
+    frames = det[:, 0].astype(int)
+    xs = np.trunc(det[:, 1] * w).astype(int)
+    ys = np.trunc(det[:, 2] * h).astype(int)
+    inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+    det, frames, xs, ys = det[inside], frames[inside], xs[inside], ys[inside]
+
+    lag_arr = np.asarray(lags, dtype=int)
+    scale_arr = np.asarray(scales, dtype=float)
+    box = np.maximum(np.trunc(det[:, 3] * w), np.trunc(det[:, 4] * h))
+    roi = np.trunc(box[:, None] * scale_arr[None, :]).astype(int)
+
+    values = np.zeros((len(scale_arr), len(det), len(lag_arr)))
+    valid = np.zeros(values.shape, dtype=bool)
+    todo = roi > 0
+    var: np.ndarray | None = None
+    if roi_mode == "box":
+        sat = integral if integral is not None else IntegralStack.build(defmaps)
+        s_all, i_all, l_all, t_all = _roi_samples(frames, lag_arr, todo, len(defmaps))
+        var = np.zeros(values.shape)
+        values[s_all, i_all, l_all], var[s_all, i_all, l_all] = sat.box_stats(
+            t_all, xs[i_all], ys[i_all], roi[i_all, s_all]
+        )
+        valid[s_all, i_all, l_all] = True
+        todo[:] = False
+    elif roi_mode == "fast":
+        interior = (
+            (ys[:, None] >= roi)
+            & (ys[:, None] + roi < h)
+            & (xs[:, None] >= roi)
+            & (xs[:, None] + roi < w)
+        )
+        _sample_blurred(defmaps, frames, xs, ys, roi, lag_arr, todo & interior, values, valid)
+        todo &= ~interior
+    _sample_windows(defmaps, frames, xs, ys, roi, lag_arr, todo, values, valid)
+
+    if use_abs:
+        np.abs(values, out=values)
+    s_idx, d_idx, l_idx = np.nonzero(valid)
+    columns = {
+        "frame": frames[d_idx],
+        "lag": lag_arr[l_idx],
+        "conf": det[d_idx, 5],
+        "value": values[valid],
+        "scale": scale_arr[s_idx],
+    }
+    if var is not None:
+        columns["var"] = var[valid]
+    return pd.DataFrame(columns)
+
+
+class LagStats:
+    """Streaming per-(lag, scale) statistics of ROI value vs. detection confidence.
+
+    Keeps, for every lag and ROI scale, the count, the means of value and
+    confidence, and the sums of squared deviations and of cross-deviations.
+    Batches are merged with the pairwise update of Chan et al. (the batch
+    form of Welford's algorithm), so means, SEMs and Pearson correlations are
+    available without keeping the rows and stay accurate for large means.
+
+    Args:
+        lags: Lags that rows may carry.
+        scales: ROI scales that rows may carry.
+    """
+
+    def __init__(self, lags: tuple[int, ...], scales: tuple[float, ...]) -> None:
+        self.lags = np.unique(np.asarray(lags, dtype=int))
+        self.scales = np.unique(np.asarray(scales, dtype=float))
+        shape = (len(self.lags), len(self.scales))
+        # Per group: count, means of value and conf, and co-moments
+        # sum((v - mv)^2), sum((c - mc)^2), sum((v - mv)(c - mc)).
+        self._acc = np.zeros((6, *shape))
+        self.frames: set[int] = set()
+
+    @staticmethod
+    def _merge(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        """Combine two accumulator arrays of the same groups."""
+        na, nb = a[0], b[0]
+        n = na + nb
+        with np.errstate(invalid="ignore", divide="ignore"):
+            wb = np.where(n > 0, nb / n, 0.0)
+        dv, dc = b[1] - a[1], b[2] - a[2]
+        cross = na * wb
+        return np.stack(
+            [
+                n,
+                a[1] + dv * wb,
+                a[2] + dc * wb,
+                a[3] + b[3] + dv * dv * cross,
+                a[4] + b[4] + dc * dc * cross,
+                a[5] + b[5] + dv * dc * cross,
+            ]
+        )
+
+    def update(self, rows: pd.DataFrame) -> None:
+        """Fold a batch of rows (``frame, lag, conf, value, scale``) into the statistics."""
+        if rows.empty:
+            return
+        group = np.searchsorted(self.lags, rows["lag"].to_numpy()) * len(
+            self.scales
+        ) + np.searchsorted(self.scales, rows["scale"].to_numpy())
+        v = rows["value"].to_numpy(dtype=float)
+        c = rows["conf"].to_numpy(dtype=float)
+        size = self._acc[0].size
+        n = np.bincount(group, minlength=size).astype(float)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mv = np.bincount(group, v, size) / n
+            mc = np.bincount(group, c, size) / n
+        dv, dc = v - mv[group], c - mc[group]
+        batch = np.stack(
+            [
+                n,
+                np.nan_to_num(mv),
+                np.nan_to_num(mc),
+                np.bincount(group, dv * dv, size),
+                np.bincount(group, dc * dc, size),
+                np.bincount(group, dv * dc, size),
+            ]
+        ).reshape(self._acc.shape)
+        self._acc = self._merge(self._acc, batch)
+        self.frames.update(np.unique(rows["frame"].to_numpy()).tolist())
+
+    def _by_lag(self) -> np.ndarray:
+        """Accumulators pooled over scales, shape ``(6, n_lags)``."""
+        pooled = self._acc[:, :, 0]
+        for k in range(1, len(self.scales)):
+            pooled = self._merge(pooled, self._acc[:, :, k])
+        return pooled
+
+    def curve(self, by_scale: bool) -> pd.DataFrame:
+        """Mean and SEM of the ROI value per lag (and scale), for lags with rows.
+
+        Returns:
+            Columns ``lag``, ``scale`` (only with ``by_scale``), ``n``,
+            ``mean`` and ``sem``.
+        """
+        if by_scale:
+            acc = self._acc.reshape(6, -1)
+            keys = {
+                "lag": np.repeat(self.lags, len(self.scales)),
+                "scale": np.tile(self.scales, len(self.lags)),
+            }
+        else:
+            acc = self._by_lag()
+            keys = {"lag": self.lags}
+        n = acc[0]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sem = np.sqrt(acc[3] / (n - 1) / n)
+        sem[n < 2] = np.nan
+        df = pd.DataFrame({**keys, "n": n.astype(int), "mean": acc[1], "sem": sem})
+        return df[df["n"] > 0].reset_index(drop=True)
+
+    def correlation(self, lags: tuple[int, ...]) -> pd.DataFrame:
+        """Pearson correlation of value and confidence per lag, pooled over scales.
+
+        Matches ``scipy.stats.pearsonr`` on the pooled rows; lags with fewer
+        than two rows get ``NaN``.
+        """
+        n, _, _, m2v, m2c, cov = self._by_lag()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            r = np.clip(cov / np.sqrt(m2v * m2c), -1.0, 1.0)
+        p = np.full_like(r, np.nan)
+        for k, (n_k, r_k) in enumerate(zip(n, r, strict=True)):
+            if n_k < 2:
+                print(f"lag {self.lags[k]}: too few points")
+                r[k] = np.nan
+            elif n_k == 2:
+                p[k] = 1.0 if np.isfinite(r_k) else np.nan
+            elif np.isfinite(r_k):
+                half = n_k / 2 - 1
+                p[k] = 2 * beta(half, half, loc=-1, scale=2).sf(abs(r_k))
+        df = pd.DataFrame(
+            {"lag": self.lags, "r": r, "p": p, "method": ["Pearson" if k >= 2 else None for k in n]}
+        )
+        return df.set_index("lag").reindex(list(lags))
 
 
 def _plot_curve(
-    tbl: pd.DataFrame,
+    stats: LagStats,
     corr_df: pd.DataFrame,
     lags: tuple[int, ...],
     metric_label: str,
@@ -114,25 +412,22 @@ def _plot_curve(
 ) -> None:
     fig, ax = plt.subplots(figsize=(7, 4))
     if group_by_scale:
-        for scale, sub_df in tbl.groupby("scale"):
-            avg = sub_df.groupby("lag")["value"].mean()
-            sem = sub_df.groupby("lag")["value"].sem()
+        for scale, sub_df in stats.curve(by_scale=True).groupby("scale"):
             ax.errorbar(
-                avg.index,
-                avg.values,
-                yerr=sem.values,
+                sub_df["lag"],
+                sub_df["mean"],
+                yerr=sub_df["sem"],
                 fmt="-o",
                 label=f"ROI {scale}x",
                 capsize=3,
             )
         ax.legend(loc="upper left", frameon=True, fancybox=True, edgecolor="gray")
     else:
-        avg = tbl.groupby("lag")["value"].mean()
-        sem = tbl.groupby("lag")["value"].sem()
+        avg = stats.curve(by_scale=False)
         ax.errorbar(
-            avg.index,
-            avg.values,
-            yerr=sem.values,
+            avg["lag"],
+            avg["mean"],
+            yerr=avg["sem"],
             fmt="-o",
             color="black",
             capsize=3,
@@ -145,7 +440,7 @@ def _plot_curve(
     ax.set_ylabel(f"Mean {metric_label}")
     ax.set_xticks(list(lags))
 
-    n_events = tbl["frame"].nunique()
+    n_events = len(stats.frames)
     min_p = corr_df["p"].min()
     p_str = f"{min_p:.1e}" if min_p < 0.001 else f"{min_p:.3f}"
     ax.text(
@@ -193,61 +488,298 @@ def _plot_significance(
     plt.close(fig)
 
 
+FIGURES: tuple[str, ...] = ("curve", "curve_avg", "significant")
+
+
+def _stack_tag(defmap_path: Path) -> str:
+    m_layer = re.search(r"_Z(\d+)", defmap_path.stem)
+    return f"Z{m_layer.group(1)}" if m_layer else defmap_path.stem
+
+
+def _stack_metric(defmap_path: Path, metric: str | None) -> str:
+    """Return ``metric``, or the metric named by the stack's metric suffix.
+
+    Stacks without a DefMap metric suffix are taken to be ``div``.
+
+    Raises:
+        ValueError: If the suffix names a DefMap metric other than those in
+            :data:`METRICS` and no ``metric`` is given.
+    """
+    if metric is not None:
+        return metric
+    m_metric = _METRIC_SUFFIX.search(defmap_path.stem)
+    if m_metric is None:
+        return "div"
+    if m_metric.group(1) not in METRICS:
+        raise ValueError(
+            f"{defmap_path} is a {m_metric.group(1)} stack; lag correlation supports "
+            f"{' and '.join(METRICS)} only (pass --metric to analyse it as one of them)"
+        )
+    return m_metric.group(1)
+
+
+def _analyse_stack(
+    defmap_path: Path,
+    detections: np.ndarray,
+    out_dir: Path,
+    metric: str,
+    conf_min: float,
+    lags: tuple[int, ...],
+    scales: tuple[float, ...],
+    use_abs: bool,
+    roi_mode: str,
+    write_table: bool = True,
+    sat_dir: Path | None = None,
+) -> tuple[Path, LagStats, pd.DataFrame]:
+    """Sample one stack into :class:`LagStats` and write its correlation stats.
+
+    Detections are processed in batches of :data:`_BATCH_DETECTIONS`; each
+    batch of rows is folded into the accumulators and, with ``write_table``,
+    appended to the row CSV, so memory does not grow with the number of
+    detections. The CSV is therefore ordered by batch first, and only within
+    a batch by scale, then detection, then lag.
+
+    Returns:
+        ``(csv, stats, correlation_stats)`` where ``csv`` is the row table, or
+        the correlation stats CSV without ``write_table``.
+    """
+    z_tag = _stack_tag(defmap_path)
+    defmaps = open_stack(defmap_path, mmap_mode="r")
+    print(f"Stack: {defmap_path.name} {defmaps.shape}")
+
+    integral = None
+    if roi_mode == "box":
+        integral = (
+            IntegralStack.for_stack(defmap_path, sat_dir)
+            if sat_dir is not None
+            else IntegralStack.build(defmaps)
+        )
+    stats = LagStats(lags, scales)
+    csv_path = out_dir / f"lag_corr_table_{metric}_{z_tag}_all.csv"
+    n_rows = 0
+    detections = _confident(detections, conf_min)
+    for start in range(0, max(len(detections), 1), _BATCH_DETECTIONS):
+        rows = _collect_rows(
+            defmaps,
+            detections[start : start + _BATCH_DETECTIONS],
+            scales,
+            lags,
+            conf_min,
+            use_abs,
+            roi_mode,
+            integral,
+        )
+        stats.update(rows)
+        if write_table:
+            rows.to_csv(csv_path, mode="a" if start else "w", header=not start, index=False)
+        n_rows += len(rows)
+    if write_table:
+        print(f"-> Table: {csv_path}  (#rows = {n_rows})")
+
+    corr_df = stats.correlation(lags)
+    stats_csv = out_dir / f"lag_corr_stats_{metric}_{z_tag}_all.csv"
+    corr_df.to_csv(stats_csv)
+    print(f"Saved correlation stats: {stats_csv}  (#rows = {n_rows})")
+    return csv_path if write_table else stats_csv, stats, corr_df
+
+
+def _render_figure(
+    figure: str,
+    stats: LagStats,
+    corr_df: pd.DataFrame,
+    lags: tuple[int, ...],
+    metric: str,
+    z_tag: str,
+    out_dir: Path,
+) -> Path:
+    """Render one of :data:`FIGURES` for an analysed stack and return its path."""
+    metric_label = "Divergence" if metric == "div" else "Magnitude"
+    if figure == "significant":
+        path = out_dir / f"lag_corr_significant_{metric}_{z_tag}_all.png"
+        _plot_significance(corr_df, lags, metric_label, path)
+    else:
+        suffix = "_avg" if figure == "curve_avg" else ""
+        path = out_dir / f"lag_{metric}_curve{suffix}_{z_tag}_all.png"
+        _plot_curve(
+            stats, corr_df, lags, metric_label, z_tag, path, group_by_scale=figure == "curve"
+        )
+    print(f"Saved {figure} plot: {path}")
+    return path
+
+
+def _resolve_options(
+    metric: str, scales: tuple[float, ...] | None, use_abs: bool | None
+) -> tuple[tuple[float, ...], bool]:
+    if metric not in METRICS:
+        raise ValueError(f"metric must be 'div' or 'mag', got {metric!r}")
+    if scales is None:
+        scales = DEFAULT_SCALES_DIV if metric == "div" else DEFAULT_SCALES_MAG
+    if use_abs is None:
+        use_abs = metric == "mag"
+    return scales, use_abs
+
+
 def run_lagcorr(
     defmap_path: Path,
     label_dir: Path,
     out_dir: Path,
-    metric: str = "div",
+    metric: str | None = None,
     conf_min: float = 0.5,
     lags: tuple[int, ...] = DEFAULT_LAGS,
     scales: tuple[float, ...] | None = None,
     use_abs: bool | None = None,
+    roi_mode: str = "exact",
+    detections: np.ndarray | None = None,
+    write_table: bool = True,
+    sat_dir: Path | None = None,
 ) -> Path:
     """Run lag correlation analysis for a single DefMap stack.
 
-    Returns the path to the row-level CSV.
+    ``defmap_path`` is a ``.npy`` stack, memory-mapped so that only the pages
+    under the ROIs are read, or a chunked ``.dmz`` stack (see
+    :mod:`btflow.stackio`), of which only the chunks under the ROIs are decoded.
+    ``roi_mode="fast"`` samples ROIs that lie inside the frame from blurred
+    frames instead (same values up to rounding); its cost is bounded by the
+    number of distinct ROI radii per frame rather than by detections times
+    scales, which makes sweeps over many ``scales`` affordable.
+    ``roi_mode="box"`` uses unweighted box ROIs answered from the stack's
+    summed-area tables (:class:`~btflow.integral.IntegralStack`) and adds a
+    ``var`` column with the box variance. The tables are built in memory
+    unless ``sat_dir`` is given; then they are cached there as memmaps and
+    reused by later runs (:meth:`~btflow.integral.IntegralStack.for_stack`).
+    ``detections`` takes labels already parsed from ``label_dir`` (see
+    :func:`run_lagcorr_stacks`).
+
+    ``metric`` defaults to the ``_div``/``_mag`` suffix of the stack's file
+    name (``div`` if there is none; other DefMap metrics raise) and, like the stack's ``Z`` layer, is part
+    of every output name, e.g. ``lag_corr_stats_div_Z1_all.csv``.
+
+    Statistics and figures come from streaming :class:`LagStats`
+    accumulators; the row-level CSV (``lag_corr_table_*``) is only written
+    with ``write_table``, and memory does not grow with the number of
+    detections either way. Its rows come in batches of detections, each
+    ordered by scale, then detection, then lag. Label rows without a
+    confidence column are kept; ``conf_min`` only drops known low confidences.
+
+    Returns the path to the row-level CSV, or to the correlation stats CSV
+    without ``write_table``.
     """
-    if metric not in {"div", "mag"}:
-        raise ValueError(f"metric must be 'div' or 'mag', got {metric!r}")
-    if scales is None:
-        scales = DEFAULT_SCALES_DIV if metric == "div" else DEFAULT_SCALES_MAG
-    if use_abs is None:
-        use_abs = metric == "mag"
-
+    metric = _stack_metric(defmap_path, metric)
+    scales, use_abs = _resolve_options(metric, scales, use_abs)
     out_dir.mkdir(parents=True, exist_ok=True)
-    tag = defmap_path.stem
-    m_layer = re.search(r"_Z(\d+)", tag)
-    z_tag = f"Z{m_layer.group(1)}" if m_layer else tag
-
-    defmaps = np.load(defmap_path)
-    print(f"Stack: {defmaps.shape}")
-    print(f"Labels: {label_dir}")
-
-    tbl = _collect_rows(defmaps, label_dir, scales, lags, conf_min, use_abs)
-    csv_path = out_dir / f"lag_corr_table_{z_tag}_all.csv"
-    tbl.to_csv(csv_path, index=False)
-    print(f"-> Table: {csv_path}  (#rows = {len(tbl)})")
-
-    corr_df = _correlation_table(tbl, lags)
-    metric_label = "Divergence" if metric == "div" else "Magnitude"
-
-    curve_path = out_dir / f"lag_{metric}_curve_{z_tag}_all.png"
-    _plot_curve(tbl, corr_df, lags, metric_label, z_tag, curve_path, group_by_scale=True)
-    print(f"Saved per-scale curve: {curve_path}")
-
-    avg_path = out_dir / f"lag_{metric}_curve_avg_{z_tag}_all.png"
-    _plot_curve(tbl, corr_df, lags, metric_label, z_tag, avg_path, group_by_scale=False)
-    print(f"Saved averaged curve: {avg_path}")
-
-    stats_csv = out_dir / f"lag_corr_stats_{z_tag}_all.csv"
-    corr_df.to_csv(stats_csv)
-    print(f"Saved correlation stats: {stats_csv}")
+    if detections is None:
+        print(f"Labels: {label_dir}")
+        detections = _load_detections(label_dir)
+    csv_path, stats, corr_df = _analyse_stack(
+        defmap_path,
+        detections,
+        out_dir,
+        metric,
+        conf_min,
+        lags,
+        scales,
+        use_abs,
+        roi_mode,
+        write_table,
+        sat_dir,
+    )
+    for figure in FIGURES:
+        _render_figure(figure, stats, corr_df, lags, metric, _stack_tag(defmap_path), out_dir)
+    return csv_path
 
-    sig_path = out_dir / f"lag_corr_significant_{metric}_{z_tag}_all.png"
-    _plot_significance(corr_df, lags, metric_label, sig_path)
-    print(f"Saved significance plot: {sig_path}")
 
-    return csv_path
+def run_lagcorr_stacks(
+    defmap_paths: Sequence[Path],
+    label_dir: Path,
+    out_dir: Path,
+    workers: int = 1,
+    metric: str | None = None,
+    conf_min: float = 0.5,
+    lags: tuple[int, ...] = DEFAULT_LAGS,
+    scales: tuple[float, ...] | None = None,
+    use_abs: bool | None = None,
+    roi_mode: str = "exact",
+    write_table: bool = True,
+    sat_dir: Path | None = None,
+) -> list[Path]:
+    """Run :func:`run_lagcorr` for several stacks, sharing one parse of the labels.
+
+    With ``workers > 1`` every stack is analysed in its own task on a process
+    pool, and each of its :data:`FIGURES` is rendered as a separate task as
+    soon as the stack's statistics are ready, so the 300-dpi figure saves
+    overlap with the analysis of the remaining stacks.
+
+    Unless ``metric`` is given, each stack's metric (and with it the default
+    ``scales`` and ``use_abs``) comes from its file name, so the div and mag
+    stacks of every z-slice can be analysed in one call. Stacks that would
+    write the same outputs (same metric and ``Z`` layer) are rejected before
+    any work starts.
+
+    Returns:
+        The CSV returned by :func:`run_lagcorr` for every stack, in the order
+        of ``defmap_paths``.
+    """
+    if workers < 1:
+        raise ValueError(f"workers must be >= 1, got {workers}")
+    runs: dict[Path, tuple[str, float, tuple[int, ...], tuple[float, ...], bool, str]] = {}
+    outputs: dict[tuple[str, str], Path] = {}
+    for path in defmap_paths:
+        stack_metric = _stack_metric(path, metric)
+        key = (stack_metric, _stack_tag(path))
+        if key in outputs:
+            raise ValueError(
+                f"{outputs[key]} and {path} would both write the {stack_metric} "
+                f"{key[1]} outputs; analyse them into different output directories"
+            )
+        outputs[key] = path
+        stack_scales, stack_abs = _resolve_options(stack_metric, scales, use_abs)
+        runs[path] = (stack_metric, conf_min, lags, stack_scales, stack_abs, roi_mode)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    print(f"Labels: {label_dir}")
+    detections = _load_detections(label_dir)
+    if workers == 1:
+        return [
+            run_lagcorr(
+                path,
+                label_dir,
+                out_dir,
+                *runs[path],
+                detections=detections,
+                write_table=write_table,
+                sat_dir=sat_dir,
+            )
+            for path in defmap_paths
+        ]
+
+    csv_paths: dict[Path, Path] = {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+        analyses = {
+            pool.submit(
+                _analyse_stack, path, detections, out_dir, *runs[path], write_table, sat_dir
+            ): path
+            for path in defmap_paths
+        }
+        renders: list[Future[Path]] = []
+        for fut in as_completed(analyses):
+            path = analyses[fut]
+            csv_paths[path], stats, corr_df = fut.result()
+            stack_metric = runs[path][0]
+            renders += [
+                pool.submit(
+                    _render_figure,
+                    figure,
+                    stats,
+                    corr_df,
+                    lags,
+                    stack_metric,
+                    _stack_tag(path),
+                    out_dir,
+                )
+                for figure in FIGURES
+            ]
+        for render in renders:
+            render.result()
+    return [csv_paths[path] for path in defmap_paths]
 
 
 def register(subparsers: argparse._SubParsersAction[argparse.ArgumentParser]) -> None:
@@ -260,7 +792,7 @@ def register(subparsers: argparse._SubParsersAction[argparse.ArgumentParser]) ->
         required=True,
         nargs="+",
         type=Path,
-        help="One or more .npy files with DefMap stacks.",
+        help="One or more DefMap stacks (.npy or chunked .dmz).",
     )
     p.add_argument(
         "--labels",
@@ -276,9 +808,12 @@ def register(subparsers: argparse._SubParsersAction[argparse.ArgumentParser]) ->
     )
     p.add_argument(
         "--metric",
-        choices=["div", "mag"],
-        default="div",
-        help="Which DefMap metric the stacks represent (default: div).",
+        choices=METRICS,
+        default=None,
+        help=(
+            "Which DefMap metric the stacks represent (default: taken from each stack's "
+            "_div/_mag file suffix, else div)."
+        ),
     )
     p.add_argument(
         "--conf-min",
@@ -286,16 +821,71 @@ def register(subparsers: argparse._SubParsersAction[argparse.ArgumentParser]) ->
         default=0.5,
         help="Minimum YOLO confidence (default: 0.5).",
     )
+    p.add_argument(
+        "--scales",
+        type=_scales_arg,
+        default=None,
+        help=(
+            "Comma-separated ROI scales relative to the box size "
+            f"(default: {','.join(map(str, DEFAULT_SCALES_DIV))} for div, "
+            f"{','.join(map(str, DEFAULT_SCALES_MAG))} for mag)."
+        ),
+    )
+    p.add_argument(
+        "--roi-mode",
+        choices=ROI_MODES,
+        default="exact",
+        help=(
+            "'exact' weights every ROI window directly; 'fast' samples interior ROIs from "
+            "blurred frames, for sweeps over many --scales; 'box' takes unweighted box "
+            "means and variances from summed-area tables (default: exact)."
+        ),
+    )
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes; >1 analyses stacks and renders figures in parallel (default: 1).",
+    )
+    p.add_argument(
+        "--sat-cache",
+        type=Path,
+        default=None,
+        metavar="DIR",
+        help=(
+            "With --roi-mode box, keep the summed-area tables (4x the stack size) as "
+            "memmaps in DIR and reuse them in later runs instead of building them in memory."
+        ),
+    )
+    p.add_argument(
+        "--no-table",
+        action="store_true",
+        help="Skip the row-level lag_corr_table CSV; stats and plots are computed on the fly.",
+    )
     p.set_defaults(_handler=_handle)
 
 
+def _scales_arg(value: str) -> tuple[float, ...]:
+    try:
+        scales = tuple(float(v) for v in value.split(",") if v.strip())
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(f"invalid scale list {value!r}") from exc
+    if not scales or any(s <= 0 for s in scales):
+        raise argparse.ArgumentTypeError(f"scales must be positive, got {value!r}")
+    return scales
+
+
 def _handle(args: argparse.Namespace) -> int:
-    for defmap_path in args.defmap:
-        run_lagcorr(
-            defmap_path=defmap_path,
-            label_dir=args.labels,
-            out_dir=args.out_dir,
-            metric=args.metric,
-            conf_min=args.conf_min,
-        )
+    run_lagcorr_stacks(
+        args.defmap,
+        args.labels,
+        args.out_dir,
+        workers=args.workers,
+        metric=args.metric,
+        conf_min=args.conf_min,
+        scales=args.scales,
+        roi_mode=args.roi_mode,
+        write_table=not args.no_table,
+        sat_dir=args.sat_cache,
+    )
     return 0
@@ -4,13 +4,162 @@ from __future__ import annotations
 
 import argparse
 import csv
+import json
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 
 import cv2
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 from ._types import BBox
-from .io import load_yolo_labels
-from .iou import calculate_iou
+from .checkpoint import manifest_path
+from .io import image_size, load_yolo_labels
+from .iou import sparse_iou
+
+ASSIGNMENTS: tuple[str, ...] = ("greedy", "optimal", "first")
+
+
+def assign_pairs(
+    rows: np.ndarray,
+    cols: np.ndarray,
+    ious: np.ndarray,
+    iou_threshold: float,
+    method: str = "greedy",
+) -> np.ndarray:
+    """Pick one-to-one green/red matches from a sparse list of scored pairs.
+
+    ``rows``, ``cols`` and ``ious`` describe candidate pairs (green index,
+    red index, IoU), e.g. from :func:`btflow.iou.sparse_iou`; pairs that are
+    not listed count as IoU ``0``. Only pairs above ``iou_threshold`` are
+    eligible.
+
+    - ``"greedy"``: repeatedly take the highest remaining IoU and retire both
+      boxes (ties go to the lower green, then red index). One-to-one.
+    - ``"optimal"``: the one-to-one matching with the largest total IoU
+      (``scipy.optimize.linear_sum_assignment``, per connected group of
+      overlapping boxes).
+    - ``"first"``: each green box takes the eligible red box with the lowest
+      index; a red box may be claimed several times. This is the original
+      thesis behaviour, kept to reproduce earlier CSVs.
+
+    Returns:
+        Indices into the pair arrays of the accepted matches, sorted by green
+        index.
+    """
+    if method not in ASSIGNMENTS:
+        raise ValueError(f"method must be one of {ASSIGNMENTS}, got {method!r}")
+    idx = np.flatnonzero(ious > iou_threshold)
+    if not idx.size:
+        return idx
+    rows, cols, ious = rows[idx], cols[idx], ious[idx]
+
+    chosen: np.ndarray
+    if method == "first":
+        by_pair = np.lexsort((cols, rows))
+        _, first = np.unique(rows[by_pair], return_index=True)
+        chosen = idx[by_pair[first]]
+        return chosen
+
+    if method == "optimal":
+        chosen = idx[_optimal_pairs(rows, cols, ious)]
+        return chosen
+
+    # Greedy in rounds: a pair that is the best of both its green and its red
+    # box is taken by the sequential highest-first greedy no matter what
+    # happens elsewhere, so all such pairs can be accepted at once. Ranks give
+    # a strict order, so ties cannot make two pairs claim the same box.
+    rank = np.empty(len(idx), dtype=np.intp)
+    rank[np.lexsort((-cols, -rows, ious))] = np.arange(len(idx))
+    best_row = np.full(int(rows.max()) + 1, -1, dtype=np.intp)
+    best_col = np.full(int(cols.max()) + 1, -1, dtype=np.intp)
+    live = np.arange(len(idx))
+    accepted = []
+    while live.size:
+        best_row[rows[live]] = -1
+        best_col[cols[live]] = -1
+        np.maximum.at(best_row, rows[live], rank[live])
+        np.maximum.at(best_col, cols[live], rank[live])
+        r = rank[live]
+        take = live[(best_row[rows[live]] == r) & (best_col[cols[live]] == r)]
+        accepted.append(take)
+        done_rows = np.zeros_like(best_row, dtype=bool)
+        done_cols = np.zeros_like(best_col, dtype=bool)
+        done_rows[rows[take]] = True
+        done_cols[cols[take]] = True
+        live = live[~(done_rows[rows[live]] | done_cols[cols[live]])]
+    keep = np.concatenate(accepted)
+    chosen = idx[keep[np.argsort(rows[keep])]]
+    return chosen
+
+
+def _optimal_pairs(rows: np.ndarray, cols: np.ndarray, ious: np.ndarray) -> np.ndarray:
+    """Maximum-total-IoU matching, solved separately per connected component."""
+    n = int(rows.max()) + 1
+    graph = coo_matrix((np.ones(len(rows)), (rows, n + cols)), shape=(n + cols.max() + 1,) * 2)
+    _, labels = connected_components(graph, directed=False)
+    component = labels[rows]
+    sizes = np.bincount(component)
+    # Components made of a single pair need no solver.
+    keep = [np.flatnonzero(sizes[component] == 1)]
+    by_component = np.argsort(component, kind="stable")
+    bounds = np.cumsum(sizes)
+    for c in np.flatnonzero(sizes > 1):
+        members = by_component[bounds[c] - sizes[c] : bounds[c]]
+        r, r_idx = np.unique(rows[members], return_inverse=True)
+        c_, c_idx = np.unique(cols[members], return_inverse=True)
+        weights = np.zeros((len(r), len(c_)))
+        weights[r_idx, c_idx] = ious[members]
+        slot = np.full(weights.shape, -1, dtype=np.intp)
+        slot[r_idx, c_idx] = members
+        i, j = linear_sum_assignment(weights, maximize=True)
+        chosen = slot[i, j]
+        keep.append(chosen[chosen >= 0])
+    matched = np.concatenate(keep)
+    return matched[np.argsort(rows[matched])]
+
+
+def assign_boxes(
+    ious: np.ndarray, iou_threshold: float, method: str = "greedy"
+) -> tuple[np.ndarray, np.ndarray]:
+    """Pick green/red box pairs from a dense ``(N, M)`` IoU matrix.
+
+    See :func:`assign_pairs` for the methods.
+
+    Returns:
+        ``(rows, cols)`` index arrays of the matched pairs, sorted by ``rows``.
+    """
+    rows, cols = np.nonzero(ious > iou_threshold)
+    keep = assign_pairs(rows, cols, ious[rows, cols], iou_threshold, method)
+    return rows[keep], cols[keep]
+
+
+def _file_signature(path: Path) -> list[int] | None:
+    """Return ``[mtime_ns, size]`` of ``path``, or ``None`` if it does not exist."""
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _annotate(
+    image_path: Path, out_path: Path, green_boxes: list[BBox], red_boxes: list[BBox]
+) -> None:
+    """Draw green and red boxes onto a frame and save it to ``out_path``."""
+    img = cv2.imread(str(image_path))
+    if img is None:
+        print(f"Image unreadable: {image_path}")
+        return
+    for gx, gy, gw, gh in green_boxes:
+        cv2.rectangle(img, (gx, gy), (gx + gw, gy + gh), (0, 255, 0), 2)
+    for rx, ry, rw, rh in red_boxes:
+        cv2.rectangle(img, (rx, ry), (rx + rw, ry + rh), (0, 0, 255), 2)
+    cv2.imwrite(str(out_path), img)
 
 
 def match_labels(
@@ -21,14 +170,33 @@ def match_labels(
     iou_threshold: float = 0.5,
     green_layer: str = "Z2",
     red_layer: str = "Z3",
+    assignment: str = "greedy",
+    annotate: bool = True,
+    threads: int = 4,
+    incremental: bool = False,
 ) -> Path:
     """Link YOLO detections from two z-layers by IoU and write annotated frames.
 
     Bounding boxes from ``label_dir_green`` are matched 1:1 against boxes from
-    ``label_dir_red`` whenever IoU exceeds ``iou_threshold``. The annotated PNG
+    ``label_dir_red`` whenever IoU exceeds ``iou_threshold``, using the
+    ``assignment`` strategy of :func:`assign_boxes`. The annotated PNG
     (green=layer 1, red=layer 2 boxes) and a cumulative CSV of matches are
     written to ``output_dir``.
 
+    Image sizes are read from the file headers (:func:`~btflow.io.image_size`),
+    so frames are only decoded to draw the annotations. Drawing and PNG
+    encoding run on a thread pool while the next frames are matched.
+
+    By default every frame is processed and its rows are appended to the CSV.
+    With ``incremental`` a sidecar manifest (``matched_boxes.manifest.json``)
+    records the match parameters, the CSV and, per frame, the modification
+    time and size of the image and both label files. Frames whose files are
+    unchanged are skipped. New frames are appended to the CSV. If a recorded
+    frame changed or disappeared, or the CSV no longer matches the manifest,
+    the CSV is rewritten atomically: unchanged rows are kept and the
+    re-matched rows replace the stale ones. Changing the match parameters
+    re-matches every frame.
+
     Args:
         image_dir: Source PNG frames whose filenames contain ``green_layer``.
         label_dir_green: YOLO label .txt files for the green (first) z-layer.
@@ -37,34 +205,86 @@ def match_labels(
         iou_threshold: Minimum IoU for a green/red pair to be considered a match.
         green_layer: Layer tag present in input filenames (default ``"Z2"``).
         red_layer: Layer tag substituted into red label filenames (default ``"Z3"``).
+        assignment: ``"greedy"`` (highest IoU first), ``"optimal"`` (maximum
+            total IoU) or ``"first"`` (first red box above the threshold, not
+            one-to-one).
+        annotate: Write annotated PNGs; ``False`` writes only the CSV and never
+            decodes an image.
+        threads: Number of threads decoding, drawing and encoding annotated
+            frames.
+        incremental: Skip unchanged frames and keep one set of rows per frame
+            (see above).
 
     Returns:
         Path to the cumulative CSV.
     """
+    if assignment not in ASSIGNMENTS:
+        raise ValueError(f"assignment must be one of {ASSIGNMENTS}, got {assignment!r}")
     output_dir.mkdir(parents=True, exist_ok=True)
     csv_path = output_dir / "matched_boxes.csv"
-    write_header = not csv_path.exists()
 
-    with csv_path.open("a", newline="") as csvfile:
+    def label_paths(image_path: Path) -> tuple[Path, Path]:
+        green = label_dir_green / image_path.with_suffix(".txt").name
+        red = label_dir_red / image_path.name.replace(green_layer, red_layer).replace(
+            ".png", ".txt"
+        )
+        return green, red
+
+    frames = [p for p in sorted(image_dir.iterdir()) if p.suffix.lower() == ".png"]
+    m_path = manifest_path(csv_path)
+    meta = {
+        "iou_threshold": iou_threshold,
+        "green_layer": green_layer,
+        "red_layer": red_layer,
+        "assignment": assignment,
+    }
+    signatures: dict[str, list[list[int] | None]] = {}
+    kept: set[str] = set()
+    rewrite = False
+    if incremental:
+        signatures = {p.name: [_file_signature(f) for f in (p, *label_paths(p))] for p in frames}
+        record = json.loads(m_path.read_text()) if m_path.exists() else {}
+        # Round-trip ``meta`` through JSON so it compares equal to the stored copy.
+        same_meta = record.get("meta") == json.loads(json.dumps(meta))
+        recorded = record.get("frames", {}) if same_meta else {}
+        kept = {name for name, sig in signatures.items() if recorded.get(name) == sig}
+        frames = [p for p in frames if p.name not in kept]
+        # Appending is only safe if the CSV holds exactly the recorded frames' rows.
+        rewrite = (
+            not same_meta or set(recorded) != kept or record.get("csv") != _file_signature(csv_path)
+        )
+        print(f"Incremental: {len(kept)} frames unchanged, {len(frames)} to match.")
+
+    out_path = csv_path.with_name(csv_path.name + ".tmp") if rewrite else csv_path
+    write_header = rewrite or not csv_path.exists()
+    processed: list[str] = []
+
+    # At most ``max_pending`` annotated frames are queued or in flight.
+    max_pending = 4 * threads
+    pending: deque[Future[None]] = deque()
+    with (
+        out_path.open("w" if rewrite else "a", newline="") as csvfile,
+        ThreadPoolExecutor(max_workers=threads, thread_name_prefix="annotate") as pool,
+    ):
         writer = csv.DictWriter(csvfile, fieldnames=["filename", "green_box", "red_box", "iou"])
         if write_header:
             writer.writeheader()
+        if rewrite and kept:
+            with csv_path.open(newline="") as old_csv:
+                reader = csv.reader(old_csv)
+                next(reader, None)  # header
+                csv.writer(csvfile).writerows(r for r in reader if r[0] in kept)
 
-        for image_path in sorted(image_dir.iterdir()):
-            if image_path.suffix.lower() != ".png":
-                continue
+        for image_path in frames:
             print(f"Processing image: {image_path.name}")
 
-            img = cv2.imread(str(image_path))
-            if img is None:
+            try:
+                w_img, h_img = image_size(image_path)
+            except (OSError, ValueError):
                 print(f"Image unreadable: {image_path}")
                 continue
-            h_img, w_img = img.shape[:2]
 
-            label_path_green = label_dir_green / image_path.with_suffix(".txt").name
-            label_path_red = label_dir_red / (
-                image_path.name.replace(green_layer, red_layer).replace(".png", ".txt")
-            )
+            label_path_green, label_path_red = label_paths(image_path)
 
             green_boxes: list[BBox] = load_yolo_labels(label_path_green, w_img, h_img)
             if not label_path_green.exists():
@@ -73,26 +293,41 @@ def match_labels(
             if not label_path_red.exists():
                 print(f"No red labels found: {label_path_red}")
 
-            for gx, gy, gw, gh in green_boxes:
-                for rx, ry, rw, rh in red_boxes:
-                    iou = calculate_iou((gx, gy, gw, gh), (rx, ry, rw, rh))
-                    if iou > iou_threshold:
-                        writer.writerow(
-                            {
-                                "filename": image_path.name,
-                                "green_box": (gx, gy, gw, gh),
-                                "red_box": (rx, ry, rw, rh),
-                                "iou": iou,
-                            }
-                        )
-                        break
-                cv2.rectangle(img, (gx, gy), (gx + gw, gy + gh), (0, 255, 0), 2)
-
-            for rx, ry, rw, rh in red_boxes:
-                cv2.rectangle(img, (rx, ry), (rx + rw, ry + rh), (0, 0, 255), 2)
-
-            cv2.imwrite(str(output_dir / image_path.name), img)
+            rows, cols, ious = sparse_iou(green_boxes, red_boxes)
+            keep = assign_pairs(rows, cols, ious, iou_threshold, assignment)
+            writer.writerows(
+                {
+                    "filename": image_path.name,
+                    "green_box": green_boxes[i],
+                    "red_box": red_boxes[j],
+                    "iou": iou,
+                }
+                for i, j, iou in zip(
+                    rows[keep].tolist(), cols[keep].tolist(), ious[keep].tolist(), strict=True
+                )
+            )
+
+            processed.append(image_path.name)
+
+            if annotate:
+                if len(pending) >= max_pending:
+                    pending.popleft().result()
+                pending.append(
+                    pool.submit(
+                        _annotate, image_path, output_dir / image_path.name, green_boxes, red_boxes
+                    )
+                )
+
+        while pending:
+            pending.popleft().result()
 
+    if rewrite:
+        os.replace(out_path, csv_path)
+    if incremental:
+        done = {name: signatures[name] for name in sorted(kept.union(processed))}
+        tmp = m_path.with_name(m_path.name + ".tmp")
+        tmp.write_text(json.dumps({"meta": meta, "csv": _file_signature(csv_path), "frames": done}))
+        os.replace(tmp, m_path)
     return csv_path
 
 
@@ -108,6 +343,36 @@ def register(subparsers: argparse._SubParsersAction[argparse.ArgumentParser]) ->
     p.add_argument("--iou-threshold", type=float, default=0.5)
     p.add_argument("--green-layer", default="Z2")
     p.add_argument("--red-layer", default="Z3")
+    p.add_argument(
+        "--assignment",
+        choices=ASSIGNMENTS,
+        default="greedy",
+        help=(
+            "How green boxes are paired with red boxes above the threshold: 'greedy' takes "
+            "the highest IoU first, 'optimal' maximises the total IoU (both one-to-one); "
+            "'first' takes the first red box per green box, as in the original analysis "
+            "(default: greedy)."
+        ),
+    )
+    p.add_argument(
+        "--no-annotate",
+        action="store_true",
+        help="Only write matched_boxes.csv; frames are never decoded or re-encoded.",
+    )
+    p.add_argument(
+        "--threads",
+        type=int,
+        default=4,
+        help="Threads drawing and encoding annotated frames (default: 4).",
+    )
+    p.add_argument(
+        "--incremental",
+        action="store_true",
+        help=(
+            "Record processed frames in a sidecar manifest; skip unchanged frames and "
+            "replace the rows of changed ones instead of appending duplicates."
+        ),
+    )
     p.set_defaults(_handler=_handle)
 
 
@@ -120,5 +385,9 @@ def _handle(args: argparse.Namespace) -> int:
         iou_threshold=args.iou_threshold,
         green_layer=args.green_layer,
         red_layer=args.red_layer,
+        assignment=args.assignment,
+        annotate=not args.no_annotate,
+        threads=args.threads,
+        incremental=args.incremental,
     )
     return 0
@@ -0,0 +1,81 @@
+"""Render saved DefMap stacks to colour-mapped MP4 previews."""
+
+from __future__ import annotations
+
+import argparse
+import re
+from pathlib import Path
+
+from ..defmap import CLIP_RANGES, CMAP, METRICS
+from ..preview import DEFAULT_FPS, render_stack_video
+from ..stackio import open_stack
+
+_STACK_METRIC = re.compile(r"_(" + "|".join(METRICS) + r")$")
+
+
+def render_defmap_video(
+    stack_path: Path,
+    out_path: Path | None = None,
+    metric: str | None = None,
+    fps: float = DEFAULT_FPS,
+) -> Path:
+    """Render a saved ``defmap_stack_Z{z}_{metric}`` stack to MP4 without recomputing it.
+
+    Args:
+        stack_path: Saved ``(T, H, W)`` DefMap stack, ``.npy`` (opened as a
+            memmap) or chunked ``.dmz``.
+        out_path: Destination video. Defaults to ``stack_path`` with ``.mp4``.
+        metric: Selects the colour range; inferred from the file name if ``None``.
+        fps: Frame rate of the video.
+
+    Returns:
+        The path of the written video.
+    """
+    if metric is None:
+        m = _STACK_METRIC.search(stack_path.stem)
+        if m is None:
+            raise ValueError(f"Cannot infer metric from {stack_path.name}; pass it explicitly.")
+        metric = m.group(1)
+    out_path = out_path or stack_path.with_suffix(".mp4")
+    vmin, vmax = CLIP_RANGES[metric]
+    stack = open_stack(stack_path, mmap_mode="r")
+    n = render_stack_video(stack, out_path, vmin, vmax, CMAP, fps)
+    print(f"Video {stack_path.name} -> {out_path}  frames={n}")
+    return out_path
+
+
+def register(subparsers: argparse._SubParsersAction[argparse.ArgumentParser]) -> None:
+    p = subparsers.add_parser(
+        "defmap-video",
+        help="Render existing DefMap .npy stacks to MP4 previews.",
+        description=(
+            "Render saved defmap_stack_Z{z}_{metric}.npy files to colour-mapped MP4 "
+            "videos without recomputing optical flow."
+        ),
+    )
+    p.add_argument(
+        "--stack",
+        required=True,
+        nargs="+",
+        type=Path,
+        help="One or more DefMap .npy stacks; each becomes <stack>.mp4 next to it.",
+    )
+    p.add_argument(
+        "--metric",
+        choices=list(METRICS),
+        default=None,
+        help="Colour range to use; inferred from the '_<metric>.npy' file name if omitted.",
+    )
+    p.add_argument(
+        "--fps",
+        type=float,
+        default=DEFAULT_FPS,
+        help=f"Frame rate of the videos (default: {DEFAULT_FPS:g}).",
+    )
+    p.set_defaults(_handler=_handle)
+
+
+def _handle(args: argparse.Namespace) -> int:
+    for stack_path in args.stack:
+        render_defmap_video(stack_path, metric=args.metric, fps=args.fps)
+    return 0
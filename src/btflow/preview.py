@@ -0,0 +1,218 @@
+"""Fast colour-mapped previews of DefMaps.
+
+Rendering a matplotlib figure per frame costs more than the optical flow it
+visualises. This module instead maps values through a precomputed 256-entry
+lookup table of the matplotlib colormap (clipped to the metric's colour range,
+with the same binning as ``imshow``) and encodes the result with OpenCV on
+background threads. Previews are written at the DefMap's native resolution
+without axes or padding, either as one PNG per frame
+(:class:`PngPreviewWriter`) or as a single MP4 per stack
+(:class:`VideoPreviewWriter`, :func:`render_stack_video`).
+"""
+
+from __future__ import annotations
+
+import queue
+import threading
+from collections.abc import Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from types import TracebackType
+
+import cv2
+import matplotlib
+import numpy as np
+
+LUT_SIZE = 256
+MP4_FOURCC = "mp4v"
+DEFAULT_FPS = 10.0
+
+
+@lru_cache(maxsize=8)
+def colormap_lut(cmap: str) -> np.ndarray:
+    """Return a ``(256, 1, 3)`` BGR ``uint8`` lookup table for a matplotlib colormap."""
+    rgba = matplotlib.colormaps[cmap](np.linspace(0.0, 1.0, LUT_SIZE))
+    # Truncate like ``Colormap.__call__(..., bytes=True)`` so colours match matplotlib.
+    bgr = (rgba[:, 2::-1] * 255).astype(np.uint8)
+    return bgr.reshape(LUT_SIZE, 1, 3)
+
+
+def colorize(data: np.ndarray, vmin: float, vmax: float, cmap: str) -> np.ndarray:
+    """Map a 2-D array to a BGR ``uint8`` image.
+
+    Values are clipped to ``[vmin, vmax]`` and binned into :data:`LUT_SIZE`
+    colours exactly like ``plt.imshow(data, cmap=cmap, vmin=vmin, vmax=vmax)``.
+    """
+    scaled = (np.asarray(data, dtype=np.float32) - vmin) * (LUT_SIZE / (vmax - vmin))
+    np.clip(scaled, 0, LUT_SIZE - 1, out=scaled)
+    index = scaled.astype(np.uint8)
+    img: np.ndarray = cv2.applyColorMap(index, colormap_lut(cmap))
+    return img
+
+
+class PngPreviewWriter:
+    """Colour-map and encode PNG previews on background threads.
+
+    ``submit`` returns as soon as a slot is free; at most ``max_pending``
+    frames are queued or in flight, so a slow disk throttles the producer
+    instead of growing memory. Errors raised by a writer thread surface from
+    :meth:`close` (or the ``with`` block exit).
+
+    Args:
+        cmap: Matplotlib colormap name.
+        threads: Number of encoder threads.
+        max_pending: Bound on queued plus in-flight frames.
+    """
+
+    def __init__(self, cmap: str, threads: int = 2, max_pending: int = 8) -> None:
+        self.cmap = cmap
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="png-writer")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures: list[Future[None]] = []
+
+    def _write(self, data: np.ndarray, path: Path, vmin: float, vmax: float) -> None:
+        try:
+            if not cv2.imwrite(str(path), colorize(data, vmin, vmax, self.cmap)):
+                raise OSError(f"Could not write preview: {path}")
+        finally:
+            self._slots.release()
+
+    def submit(self, data: np.ndarray, path: Path, vmin: float, vmax: float) -> None:
+        """Queue ``data`` to be written to ``path``; ``data`` must not be mutated afterwards."""
+        self._slots.acquire()
+        self._futures.append(self._pool.submit(self._write, data, path, vmin, vmax))
+        # Drop finished futures so long runs do not accumulate them.
+        if len(self._futures) > 64:
+            pending = []
+            for f in self._futures:
+                if f.done():
+                    f.result()
+                else:
+                    pending.append(f)
+            self._futures = pending
+
+    def close(self) -> None:
+        """Wait for all queued previews and re-raise the first writer error."""
+        self._pool.shutdown(wait=True)
+        futures, self._futures = self._futures, []
+        for f in futures:
+            f.result()
+
+    def __enter__(self) -> PngPreviewWriter:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> None:
+        self.close()
+
+
+class VideoPreviewWriter:
+    """Stream colour-mapped frames into an MP4 file on a dedicated thread.
+
+    Frames are colour-mapped and encoded in submission order by one encoder
+    thread fed through a bounded queue, so the producer only blocks when the
+    encoder falls ``max_pending`` frames behind. The video size is taken from
+    the first frame. Errors raised by the encoder surface from :meth:`close`.
+
+    Args:
+        path: Output ``.mp4`` path.
+        cmap: Matplotlib colormap name.
+        vmin: Lower end of the colour range.
+        vmax: Upper end of the colour range.
+        fps: Frame rate of the output video.
+        max_pending: Bound on frames queued ahead of the encoder.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        cmap: str,
+        vmin: float,
+        vmax: float,
+        fps: float = DEFAULT_FPS,
+        max_pending: int = 16,
+    ) -> None:
+        self.path = path
+        self.cmap = cmap
+        self.vmin = vmin
+        self.vmax = vmax
+        self.fps = fps
+        self.frames_written = 0
+        # ``None`` tells the encoder thread to finish the file.
+        self._queue: queue.Queue[np.ndarray | None] = queue.Queue(maxsize=max_pending)
+        self._error: Exception | None = None
+        self._thread = threading.Thread(target=self._encode, name="mp4-writer", daemon=True)
+        self._thread.start()
+
+    def _encode(self) -> None:
+        writer: cv2.VideoWriter | None = None
+        try:
+            while (data := self._queue.get()) is not None:
+                if self._error is not None:
+                    continue  # keep draining so the producer never blocks
+                img = colorize(data, self.vmin, self.vmax, self.cmap)
+                if writer is None:
+                    h, w = img.shape[:2]
+                    fourcc = cv2.VideoWriter.fourcc(*MP4_FOURCC)
+                    writer = cv2.VideoWriter(str(self.path), fourcc, self.fps, (w, h))
+                    if not writer.isOpened():
+                        raise OSError(f"Could not open video for writing: {self.path}")
+                writer.write(img)
+                self.frames_written += 1
+        except Exception as exc:  # re-raised from close()
+            self._error = exc
+            while self._queue.get() is not None:
+                pass
+        finally:
+            if writer is not None:
+                writer.release()
+
+    def write(self, data: np.ndarray) -> None:
+        """Append one 2-D frame; ``data`` must not be mutated afterwards."""
+        self._queue.put(data)
+
+    def close(self) -> None:
+        """Finish the video and re-raise any encoder error."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self) -> VideoPreviewWriter:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> None:
+        self.close()
+
+
+def render_stack_video(
+    stack: Iterable[np.ndarray],
+    out_path: Path,
+    vmin: float,
+    vmax: float,
+    cmap: str = "coolwarm",
+    fps: float = DEFAULT_FPS,
+) -> int:
+    """Render a ``(T, H, W)`` DefMap stack to an MP4 file.
+
+    ``stack`` may be a memmap or a :class:`~btflow.stackio.ChunkedStack`;
+    frames are read one at a time.
+
+    Returns:
+        Number of frames written.
+    """
+    with VideoPreviewWriter(out_path, cmap, vmin, vmax, fps) as writer:
+        for frame in stack:
+            writer.write(np.array(frame))
+    return writer.frames_written
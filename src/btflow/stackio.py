@@ -0,0 +1,304 @@
+"""Chunked, compressed DefMap stacks with lazy random access.
+
+Uncompressed ``float32`` ``.npy`` stacks dominate storage and copy time, yet
+consumers such as ``btflow lagcorr`` only read small ROI patches. The
+``.dmz`` format stores a ``(T, H, W)`` stack as a grid of ``(t, y, x)``
+chunks, each quantised and compressed independently, in a single indexed file:
+
+- ``MAGIC`` (8 bytes), then the little-endian ``uint64`` offset of the header;
+- the compressed chunks, back to back;
+- a JSON header with shape, chunk shape, quantisation, codec, free-form
+  ``meta`` (metric, sigma, crop, flow parameters, ...) and one
+  ``[offset, nbytes]`` index entry per chunk in C order.
+
+Quantisation is either ``float16`` (~3 significant digits) or ``int16``
+with a per-stack scale chosen from the data's largest magnitude. Chunks are
+byte-shuffled before ``zlib`` compression, which groups the similar high bytes
+of neighbouring values. :class:`ChunkedStack` decodes only the chunks an index
+expression touches and keeps recently used chunks in a small LRU cache.
+
+:func:`grow_npy` lengthens an existing ``.npy`` stack in place, for stacks
+that are appended to while an acquisition is running.
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import mmap
+import os
+import struct
+import zlib
+from collections import OrderedDict
+from collections.abc import Iterator, Mapping
+from itertools import product
+from pathlib import Path
+from types import TracebackType
+from typing import Any, Literal
+
+import numpy as np
+
+MAGIC = b"BTFDMZ1\n"
+SUFFIX = ".dmz"
+QUANTIZE = ("float16", "int16")
+DEFAULT_CHUNKS = (8, 256, 256)
+
+_INT16_MAX = 32767
+
+
+def _shuffle(raw: np.ndarray) -> bytes:
+    """Byte-transpose a 2-byte array so equal-significance bytes are adjacent."""
+    return raw.view(np.uint8).reshape(-1, raw.itemsize).T.tobytes()
+
+
+def _unshuffle(data: bytes, dtype: np.dtype[Any], shape: tuple[int, ...]) -> np.ndarray:
+    planes = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(planes.T).view(dtype).reshape(shape)
+
+
+def save_chunked(
+    path: Path,
+    stack: np.ndarray,
+    chunks: tuple[int, int, int] = DEFAULT_CHUNKS,
+    quantize: str = "float16",
+    meta: Mapping[str, Any] | None = None,
+    level: int = 6,
+) -> Path:
+    """Write a ``(T, H, W)`` stack in the chunked ``.dmz`` format.
+
+    ``stack`` may be a memmap; it is read one chunk row of ``chunks[0]``
+    frames at a time.
+
+    Args:
+        path: Output file, conventionally ending in :data:`SUFFIX`.
+        stack: Stack to store.
+        chunks: Chunk shape ``(t, y, x)``; clipped to the stack shape.
+        quantize: ``"float16"`` or ``"int16"`` (scaled by the stack's largest
+            absolute value).
+        meta: JSON-serialisable metadata stored in the header.
+        level: ``zlib`` compression level.
+
+    Returns:
+        ``path``.
+    """
+    if quantize not in QUANTIZE:
+        raise ValueError(f"quantize must be one of {QUANTIZE}, got {quantize!r}")
+    if stack.ndim != 3:
+        raise ValueError(f"expected a (T, H, W) stack, got shape {stack.shape}")
+    shape = tuple(int(n) for n in stack.shape)
+    ct, cy, cx = (max(1, min(c, n)) for c, n in zip(chunks, shape, strict=True))
+
+    scale = 1.0
+    if quantize == "int16":
+        peak = max(
+            (float(np.abs(stack[t : t + ct]).max()) for t in range(0, shape[0], ct)), default=0
+        )
+        scale = peak / _INT16_MAX if peak > 0 else 1.0
+
+    index: list[list[int]] = []
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("wb") as f:
+        f.write(MAGIC + struct.pack("<Q", 0))
+        for t0 in range(0, shape[0], ct):
+            slab = np.asarray(stack[t0 : t0 + ct], dtype=np.float32)
+            if quantize == "int16":
+                slab = np.clip(np.rint(slab / scale), -_INT16_MAX, _INT16_MAX)
+            q = slab.astype(quantize)
+            for y0, x0 in product(range(0, shape[1], cy), range(0, shape[2], cx)):
+                data = zlib.compress(_shuffle(q[:, y0 : y0 + cy, x0 : x0 + cx].copy()), level)
+                index.append([f.tell(), len(data)])
+                f.write(data)
+        header_offset = f.tell()
+        header = {
+            "shape": shape,
+            "chunks": (ct, cy, cx),
+            "dtype": quantize,
+            "scale": scale,
+            "codec": "zlib",
+            "shuffle": True,
+            "meta": dict(meta or {}),
+            "index": index,
+        }
+        f.write(json.dumps(header).encode())
+        f.seek(len(MAGIC))
+        f.write(struct.pack("<Q", header_offset))
+    tmp.replace(path)
+    return path
+
+
+def grow_npy(path: Path, length: int) -> None:
+    """Grow the first axis of a C-ordered ``.npy`` file to ``length`` in place.
+
+    The data region is extended with ``truncate`` (new rows read as zeros) and
+    the header is rewritten in place; NumPy pads headers so that the first
+    axis can grow without moving the data. Files written without that padding
+    are copied once into a new file instead.
+    """
+    with path.open("r+b") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        data_offset = f.tell()
+        if fortran_order or not shape or length < shape[0]:
+            raise ValueError(f"Cannot grow {path} with shape {shape} to length {length}")
+        new_shape = (length, *shape[1:])
+        header = repr(
+            {
+                "descr": np.lib.format.dtype_to_descr(dtype),
+                "fortran_order": False,
+                "shape": new_shape,
+            }
+        )
+        # Magic string, two version bytes and the header-length field.
+        prefix = np.lib.format.MAGIC_LEN + (2 if version == (1, 0) else 4)
+        room = data_offset - prefix - 1
+        if len(header) <= room:
+            f.truncate(data_offset + math.prod(new_shape) * dtype.itemsize)
+            f.seek(prefix)
+            f.write((header.ljust(room) + "\n").encode("latin1"))
+            return
+
+    old = np.load(path, mmap_mode="r")
+    tmp = path.with_name(path.name + ".tmp")
+    new = np.lib.format.open_memmap(tmp, mode="w+", dtype=old.dtype, shape=new_shape)
+    new[: len(old)] = old
+    new.flush()
+    del new, old
+    os.replace(tmp, path)
+
+
+def _axis_range(key: int | slice, n: int) -> tuple[int, int, slice | int]:
+    """Map one index to the covering ``[start, stop)`` and the index into that window."""
+    if isinstance(key, slice):
+        start, stop, step = key.indices(n)
+        if step < 0:
+            return 0, n, key
+        stop = max(start, stop)
+        return start, stop, slice(0, stop - start, step)
+    i = int(key)
+    if not -n <= i < n:
+        raise IndexError(f"index {key} is out of bounds for axis with size {n}")
+    i %= n
+    return i, i + 1, 0
+
+
+class ChunkedStack:
+    """Read-only, lazily decoded view of a ``.dmz`` stack.
+
+    Supports ``len``, iteration over frames, ``np.asarray`` and basic indexing
+    with integers and slices on the three axes (``stack[t, y0:y1, x0:x1]``);
+    results are ``float32`` arrays. Only the chunks an index touches are
+    decompressed.
+
+    Args:
+        path: A file written by :func:`save_chunked`.
+        cache_chunks: Number of decoded chunks kept in the LRU cache.
+    """
+
+    def __init__(self, path: Path, cache_chunks: int = 64) -> None:
+        self.path = path
+        with path.open("rb") as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._buf[: len(MAGIC)] != MAGIC:
+            self._buf.close()
+            raise ValueError(f"{path} is not a chunked DefMap stack")
+        (header_offset,) = struct.unpack_from("<Q", self._buf, len(MAGIC))
+        header = json.loads(self._buf[header_offset:])
+        t, h, w = header["shape"]
+        self.shape = (int(t), int(h), int(w))
+        ct, cy, cx = header["chunks"]
+        self.chunks = (int(ct), int(cy), int(cx))
+        self.quantize: str = header["dtype"]
+        self.scale = float(header["scale"])
+        self.meta: dict[str, Any] = header["meta"]
+        self._index: list[list[int]] = header["index"]
+        self._grid = tuple(-(-n // c) for n, c in zip(self.shape, self.chunks, strict=True))
+        self._cache: OrderedDict[tuple[int, int, int], np.ndarray] = OrderedDict()
+        self._cache_chunks = cache_chunks
+        self.dtype = np.dtype(np.float32)
+        self.ndim = 3
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def _chunk(self, ti: int, yi: int, xi: int) -> np.ndarray:
+        key = (ti, yi, xi)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        offset, nbytes = self._index[(ti * self._grid[1] + yi) * self._grid[2] + xi]
+        shape = tuple(
+            min(c, n - i * c) for i, c, n in zip(key, self.chunks, self.shape, strict=True)
+        )
+        raw = zlib.decompress(self._buf[offset : offset + nbytes])
+        chunk = _unshuffle(raw, np.dtype(self.quantize), shape).astype(np.float32)
+        if self.quantize == "int16":
+            chunk *= self.scale
+        self._cache[key] = chunk
+        if len(self._cache) > self._cache_chunks:
+            self._cache.popitem(last=False)
+        return chunk
+
+    def __getitem__(self, key: Any) -> np.ndarray:
+        keys = key if isinstance(key, tuple) else (key,)
+        if len(keys) > 3:
+            raise IndexError(f"too many indices for a 3-D stack: {key!r}")
+        keys = keys + (slice(None),) * (3 - len(keys))
+        ranges = [_axis_range(k, n) for k, n in zip(keys, self.shape, strict=True)]
+        (t0, t1, _), (y0, y1, _), (x0, x1, _) = ranges
+        out = np.empty((t1 - t0, y1 - y0, x1 - x0), dtype=np.float32)
+        ct, cy, cx = self.chunks
+        for ti, yi, xi in product(
+            range(t0 // ct, -(-t1 // ct)),
+            range(y0 // cy, -(-y1 // cy)),
+            range(x0 // cx, -(-x1 // cx)),
+        ):
+            chunk = self._chunk(ti, yi, xi)
+            # Overlap of the chunk with the requested window, in stack coordinates.
+            ts, te = max(t0, ti * ct), min(t1, (ti + 1) * ct)
+            ys, ye = max(y0, yi * cy), min(y1, (yi + 1) * cy)
+            xs, xe = max(x0, xi * cx), min(x1, (xi + 1) * cx)
+            out[ts - t0 : te - t0, ys - y0 : ye - y0, xs - x0 : xe - x0] = chunk[
+                ts - ti * ct : te - ti * ct,
+                ys - yi * cy : ye - yi * cy,
+                xs - xi * cx : xe - xi * cx,
+            ]
+        result: np.ndarray = out[tuple(sel for _, _, sel in ranges)]
+        return result
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        for t in range(len(self)):
+            yield self[t]
+
+    def __array__(self, dtype: Any = None, copy: bool | None = None) -> np.ndarray:
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+    def close(self) -> None:
+        """Release the file mapping."""
+        self._cache.clear()
+        self._buf.close()
+
+    def __enter__(self) -> ChunkedStack:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> None:
+        self.close()
+
+
+def open_stack(path: Path, mmap_mode: Literal["r"] | None = None) -> np.ndarray | ChunkedStack:
+    """Open a DefMap stack saved as ``.npy`` or in the chunked ``.dmz`` format.
+
+    ``mmap_mode`` applies to ``.npy`` files; chunked stacks are always lazy.
+    """
+    if path.suffix == SUFFIX:
+        return ChunkedStack(path)
+    stack: np.ndarray = np.load(path, mmap_mode=mmap_mode)
+    return stack
@@ -14,6 +14,7 @@ SUBCOMMANDS = [
     "confidence-kde",
     "heatmap",
     "iou-boxplot",
+    "defmap-video",
 ]
 
 
@@ -2,12 +2,30 @@
 
 from __future__ import annotations
 
+import json
+import shutil
 from pathlib import Path
 
+import cv2
 import numpy as np
 import pytest
 
-from btflow.defmap import build_defmap_stack
+from btflow import defmap, flow
+from btflow.defmap import (
+    METRICS,
+    MetricKernel,
+    _shard_ranges,
+    build_defmap_stack,
+    build_defmap_stacks,
+    derive_metrics,
+    parse_metrics,
+    watch_defmap_stacks,
+)
+from btflow.stackio import ChunkedStack
+
+
+def test_flow_kwargs_still_importable_from_defmap() -> None:
+    assert defmap.FLOW_KWARGS is flow.FLOW_KWARGS
 
 
 def test_div_stack_shape_and_files(synthetic_zstack_dir: Path, tmp_path: Path) -> None:
@@ -29,7 +47,7 @@ def test_mag_stack_is_nonnegative(synthetic_zstack_dir: Path, tmp_path: Path) ->
 
 
 def test_invalid_metric_raises(tmp_path: Path) -> None:
-    with pytest.raises(ValueError, match="metric must be 'div' or 'mag'"):
+    with pytest.raises(ValueError, match="metric must be one of"):
         build_defmap_stack(tmp_path, tmp_path, metric="bogus")
 
 
@@ -43,3 +61,364 @@ def test_div_stack_detects_rightward_motion(synthetic_zstack_dir: Path, tmp_path
     # The blob crosses the central area; total signed divergence should be
     # very close to zero (mass is conserved by translation).
     assert abs(stack[0].mean()) < 0.5
+
+
+def test_parallel_workers_match_serial(synthetic_zstack_dir: Path, tmp_path: Path) -> None:
+    serial = build_defmap_stack(synthetic_zstack_dir, tmp_path / "serial", metric="div")
+    parallel = build_defmap_stack(synthetic_zstack_dir, tmp_path / "pool", metric="div", workers=2)
+    assert sorted(parallel) == sorted(serial)
+    for z, stack in serial.items():
+        np.testing.assert_array_equal(parallel[z], stack)
+        assert (tmp_path / "pool" / f"defmap_stack_Z{z}_div.npy").is_file()
+
+
+def test_shard_ranges_cover_all_pairs() -> None:
+    assert _shard_ranges(10, 3) == [(0, 4), (4, 8), (8, 10)]
+    assert _shard_ranges(2, 8) == [(0, 1), (1, 2)]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_out_of_core_returns_memmaps_matching_in_ram(
+    synthetic_zstack_dir: Path, tmp_path: Path, workers: int
+) -> None:
+    in_ram = build_defmap_stack(synthetic_zstack_dir, tmp_path / "ram", metric="mag")
+    lazy = build_defmap_stack(
+        synthetic_zstack_dir, tmp_path / "mm", metric="mag", workers=workers, out_of_core=True
+    )
+    for z, stack in in_ram.items():
+        assert isinstance(lazy[z], np.memmap)
+        np.testing.assert_array_equal(lazy[z], stack)
+        np.testing.assert_array_equal(
+            np.load(tmp_path / "mm" / f"defmap_stack_Z{z}_mag.npy"), stack
+        )
+
+
+def test_resume_skips_pairs_recorded_in_manifest(
+    synthetic_zstack_dir: Path, tmp_path: Path
+) -> None:
+    out = tmp_path / "resume"
+    reference = build_defmap_stack(synthetic_zstack_dir, out, metric="div", resume=True)
+    stack_path = out / "defmap_stack_Z1_div.npy"
+    manifest = out / "defmap_stack_Z1_div.manifest.json"
+    record = json.loads(manifest.read_text())
+    assert record["done"] == [0, 1, 2, 3]
+
+    # Simulate a run pre-empted after pairs 0 and 1: pair 0 carries a marker that
+    # must survive (it is done), pair 2 is garbage that must be recomputed.
+    expected = np.array(reference[1])
+    partial = np.load(stack_path, mmap_mode="r+")
+    partial[0] = 123.0
+    partial[2:] = np.nan
+    partial.flush()
+    del partial
+    record["done"] = [0, 1]
+    manifest.write_text(json.dumps(record))
+
+    resumed = build_defmap_stack(synthetic_zstack_dir, out, metric="div", resume=True)
+    assert (resumed[1][0] == 123.0).all()
+    np.testing.assert_array_equal(resumed[1][1:], expected[1:])
+    assert json.loads(manifest.read_text())["done"] == [0, 1, 2, 3]
+
+
+def test_resume_rejects_manifest_with_other_parameters(
+    synthetic_zstack_dir: Path, tmp_path: Path
+) -> None:
+    out = tmp_path / "resume"
+    build_defmap_stack(synthetic_zstack_dir, out, metric="div", resume=True)
+    with pytest.raises(ValueError, match="different parameters"):
+        build_defmap_stack(synthetic_zstack_dir, out, metric="div", sigma=3.0, resume=True)
+
+
+def _copy_frames(src: Path, dst: Path, times: range) -> None:
+    dst.mkdir(exist_ok=True)
+    for t in times:
+        for f in src.glob(f"*_t{t:04d}_z*.png"):
+            shutil.copy(f, dst / f.name)
+
+
+@pytest.mark.parametrize("manifest", [True, False])
+def test_append_computes_only_new_pairs(
+    synthetic_zstack_dir: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch, manifest: bool
+) -> None:
+    full = build_defmap_stacks(synthetic_zstack_dir, tmp_path / "full", metrics="div,mag")
+    rgb = tmp_path / "growing"
+    out = tmp_path / "append"
+    _copy_frames(synthetic_zstack_dir, rgb, range(1, 4))
+    build_defmap_stacks(rgb, out, metrics="div,mag", resume=manifest)
+    # A z-slice whose newest frame has not arrived yet holds back that time point.
+    _copy_frames(synthetic_zstack_dir, rgb, range(4, 6))
+    (rgb / "frame_t0005_z0002.png").unlink()
+
+    computed: list[tuple[int, int, int]] = []
+    compute_shard = defmap._compute_shard
+    monkeypatch.setattr(
+        defmap,
+        "_compute_shard",
+        lambda z, frames, start, stop, *a, **kw: (
+            computed.append((z, start, stop)),
+            compute_shard(z, frames, start, stop, *a, **kw),
+        )[1],
+    )
+    grown = build_defmap_stacks(rgb, out, metrics="div,mag", append=True)
+    assert computed == [(1, 2, 3), (2, 2, 3), (3, 2, 3)]
+    for metric in ("div", "mag"):
+        for z in (1, 2, 3):
+            assert grown[metric][z].shape == (3, 32, 32)
+            np.testing.assert_array_equal(grown[metric][z], full[metric][z][:3])
+
+    with pytest.raises(ValueError, match="append requires"):
+        build_defmap_stacks(rgb, out, append=True, save_mp4=True)
+
+
+def test_watch_appends_frames_as_they_arrive(
+    synthetic_zstack_dir: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    full = build_defmap_stack(synthetic_zstack_dir, tmp_path / "full", metric="div")
+    rgb = tmp_path / "growing"
+    out = tmp_path / "watch"
+    _copy_frames(synthetic_zstack_dir, rgb, range(1, 2))
+    arrivals = iter([range(2, 3), range(3, 3), range(3, 6)])
+    monkeypatch.setattr(
+        defmap.time, "sleep", lambda _: _copy_frames(synthetic_zstack_dir, rgb, next(arrivals))
+    )
+    assert watch_defmap_stacks(rgb, out, interval=0, max_polls=4, metrics="div") == 5
+    np.testing.assert_array_equal(np.load(out / "defmap_stack_Z3_div.npy"), full[3])
+    record = json.loads((out / "defmap_stack_Z3_div.manifest.json").read_text())
+    assert record["done"] == [0, 1, 2, 3]
+
+
+def test_multi_metric_single_pass_matches_separate_runs(
+    synthetic_zstack_dir: Path, tmp_path: Path
+) -> None:
+    out = tmp_path / "multi"
+    stacks = build_defmap_stacks(synthetic_zstack_dir, out, metrics="div,mag,curl,shear")
+    assert list(stacks) == ["div", "mag", "curl", "shear"]
+    for metric in ("div", "mag"):
+        single = build_defmap_stack(synthetic_zstack_dir, tmp_path / metric, metric=metric)
+        for z, stack in single.items():
+            np.testing.assert_array_equal(stacks[metric][z], stack)
+    for z in (1, 2, 3):
+        for metric in ("curl", "shear"):
+            assert (out / f"defmap_stack_Z{z}_{metric}.npy").is_file()
+        assert (stacks["shear"][z] >= 0).all()
+
+
+def test_derive_metrics_on_analytic_fields() -> None:
+    yy, xx = np.mgrid[0:16, 0:16].astype(np.float32)
+    # Pure rotation: no divergence or shear, constant vorticity 2.
+    rot = derive_metrics(-yy, xx, METRICS)
+    np.testing.assert_allclose(rot["div"], 0.0, atol=1e-6)
+    np.testing.assert_allclose(rot["curl"], 2.0, atol=1e-6)
+    np.testing.assert_allclose(rot["shear"], 0.0, atol=1e-6)
+    # Anisotropic stretch: div = a + b, shear = |a - b|.
+    stretch = derive_metrics(0.5 * xx, 0.1 * yy, ("div", "shear", "curl"))
+    np.testing.assert_allclose(stretch["div"], 0.6, atol=1e-6)
+    np.testing.assert_allclose(stretch["shear"], 0.4, atol=1e-6)
+    np.testing.assert_allclose(stretch["curl"], 0.0, atol=1e-6)
+
+    # A half-resolution grid in full-resolution pixels: spacing 2.
+    coarse = derive_metrics(xx, 0 * yy, ("div",), spacing=2.0)
+    np.testing.assert_allclose(coarse["div"], 0.5, atol=1e-6)
+
+
+@pytest.mark.parametrize(
+    ("sigma", "scale", "upsample_to"), [(0.0, 1, None), (1.5, 1, None), (1.5, 2, (45, 62))]
+)
+def test_metric_kernel_matches_np_gradient_path(
+    rng: np.random.Generator, sigma: float, scale: int, upsample_to: tuple[int, int] | None
+) -> None:
+    flow = rng.normal(0, 2, size=(23, 31, 2)).astype(np.float32)
+    kernel = MetricKernel((23, 31), METRICS, sigma, scale, upsample_to)
+    out = {m: np.full(upsample_to or (23, 31), np.nan, dtype=np.float32) for m in METRICS}
+    got = kernel(flow, out)
+    assert all(got[m] is out[m] for m in METRICS)
+
+    # Reference: the straightforward blur + ``np.gradient`` implementation.
+    vx, vy = flow[..., 0] * scale, flow[..., 1] * scale
+    if sigma > 0:
+        vx = cv2.GaussianBlur(vx, (0, 0), sigmaX=sigma / scale)
+        vy = cv2.GaussianBlur(vy, (0, 0), sigmaX=sigma / scale)
+    expected = derive_metrics(vx, vy, METRICS, spacing=scale)
+    for metric in METRICS:
+        ref = expected[metric]
+        if upsample_to is not None:
+            ref = cv2.resize(ref, upsample_to[::-1], interpolation=cv2.INTER_LINEAR)
+        np.testing.assert_allclose(out[metric], ref, rtol=1e-6, atol=1e-6)
+    # Without destinations the kernel reuses its own buffers across calls.
+    first = kernel(flow)["div"]
+    assert kernel(flow * 2)["div"] is first
+
+
+def test_parse_metrics() -> None:
+    assert parse_metrics("div, mag,div") == ("div", "mag")
+    assert parse_metrics(["curl"]) == ("curl",)
+    with pytest.raises(ValueError, match="metric must be one of"):
+        parse_metrics("div,bogus")
+
+
+def test_flow_cache_serves_reruns_without_decoding(
+    synthetic_zstack_dir: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    cache = tmp_path / "flow_cache"
+    first = build_defmap_stack(synthetic_zstack_dir, tmp_path / "a", flow_cache=cache)
+    assert len(list(cache.glob("*/*.npy"))) == 3 * 4
+    # Cold-cache runs already use the float16-rounded flow.
+    np.testing.assert_allclose(
+        first[1], build_defmap_stack(synthetic_zstack_dir, tmp_path / "ref")[1], atol=1e-3
+    )
+
+    def no_flow(*args: object) -> None:
+        raise AssertionError("optical flow recomputed despite a warm cache")
+
+    monkeypatch.setattr(defmap, "_compute_flow", no_flow)
+    monkeypatch.setattr(defmap, "FrameSource", no_flow)
+    warm = build_defmap_stack(synthetic_zstack_dir, tmp_path / "warm", flow_cache=cache)
+    for z, stack in first.items():
+        np.testing.assert_array_equal(warm[z], stack)
+    rerun = build_defmap_stack(
+        synthetic_zstack_dir, tmp_path / "b", metric="mag", sigma=0.5, flow_cache=cache
+    )
+    assert rerun[1].shape == (4, 32, 32)
+    assert np.isfinite(rerun[1]).all()
+
+
+def test_evicted_cache_entries_are_recomputed_with_warm_start(
+    synthetic_zstack_dir: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    cache = tmp_path / "flow_cache"
+    first = build_defmap_stack(
+        synthetic_zstack_dir, tmp_path / "a", flow_cache=cache, warm_start=True
+    )
+
+    def cold_flow(*args: object) -> None:
+        raise AssertionError("cold optical flow computed in warm-start mode")
+
+    # Every entry passes the membership check but is gone by the time it is read.
+    monkeypatch.setattr(defmap.FlowCache, "get", lambda self, key: None)
+    monkeypatch.setattr(defmap, "_compute_flow", cold_flow)
+    again = build_defmap_stack(
+        synthetic_zstack_dir, tmp_path / "b", flow_cache=cache, warm_start=True
+    )
+    for z, stack in first.items():
+        np.testing.assert_allclose(again[z], stack, atol=0.05)
+
+
+def test_save_png_writes_one_preview_per_pair(synthetic_zstack_dir: Path, tmp_path: Path) -> None:
+    out = tmp_path / "png"
+    build_defmap_stack(synthetic_zstack_dir, out, metric="div", save_png=True)
+    previews = sorted(out.glob("defmap_Z1_*.png"))
+    assert [p.name for p in previews] == [f"defmap_Z1_{i:03d}.png" for i in range(1, 5)]
+    img = cv2.imread(str(previews[0]))
+    assert img is not None and img.shape == (32, 32, 3)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_save_mp4_writes_one_video_per_stack(
+    synthetic_zstack_dir: Path, tmp_path: Path, workers: int
+) -> None:
+    out = tmp_path / "mp4"
+    build_defmap_stacks(
+        synthetic_zstack_dir, out, metrics="div,mag", save_mp4=True, workers=workers
+    )
+    for z in (1, 2, 3):
+        for metric in ("div", "mag"):
+            cap = cv2.VideoCapture(str(out / f"defmap_stack_Z{z}_{metric}.mp4"))
+            assert int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) == 4
+            cap.release()
+
+
+def test_flow_engine_changes_flow_and_is_recorded(
+    synthetic_zstack_dir: Path, tmp_path: Path
+) -> None:
+    farneback = build_defmap_stack(synthetic_zstack_dir, tmp_path / "fb", metric="mag")
+    out = tmp_path / "dis"
+    dis = build_defmap_stack(
+        synthetic_zstack_dir, out, metric="mag", flow_engine="dis", flow_preset="fast", resume=True
+    )
+    assert dis[1].shape == farneback[1].shape
+    assert not np.array_equal(dis[1], farneback[1])
+    meta = json.loads((out / "defmap_stack_Z1_mag.manifest.json").read_text())["meta"]
+    assert meta["engine"] == "dis" and meta["flow"] == {"preset": "fast"}
+    with pytest.raises(ValueError, match="preset for 'dis'"):
+        build_defmap_stack(synthetic_zstack_dir, out, flow_engine="dis", flow_preset="thesis")
+
+
+def test_warm_start_stays_close_to_cold_start(synthetic_zstack_dir: Path, tmp_path: Path) -> None:
+    cold = build_defmap_stack(synthetic_zstack_dir, tmp_path / "cold", metric="mag")
+    warm = build_defmap_stack(
+        synthetic_zstack_dir, tmp_path / "warm", metric="mag", warm_start=True
+    )
+    for z, stack in cold.items():
+        np.testing.assert_array_equal(warm[z][0], stack[0])  # first pair starts cold
+        assert np.abs(warm[z] - stack).mean() < 0.1
+    with pytest.raises(ValueError, match="requires the 'farneback'"):
+        build_defmap_stack(synthetic_zstack_dir, tmp_path / "x", flow_engine="dis", warm_start=True)
+
+
+def test_flow_tile_matches_untiled(synthetic_zstack_dir: Path, tmp_path: Path) -> None:
+    full = build_defmap_stack(synthetic_zstack_dir, tmp_path / "full", metric="div")
+    tiled = build_defmap_stack(synthetic_zstack_dir, tmp_path / "tiled", metric="div", flow_tile=16)
+    for z, stack in full.items():
+        np.testing.assert_allclose(tiled[z], stack, atol=1e-3)
+
+
+def test_downscale_rescales_to_full_resolution_units(
+    synthetic_zstack_dir: Path, tmp_path: Path
+) -> None:
+    full = build_defmap_stacks(synthetic_zstack_dir, tmp_path / "full", metrics="div,mag")
+    half = build_defmap_stacks(
+        synthetic_zstack_dir, tmp_path / "half", metrics="div,mag", downscale=2
+    )
+    up = build_defmap_stacks(
+        synthetic_zstack_dir, tmp_path / "up", metrics="mag", downscale=2, upsample=True
+    )
+    assert half["mag"][1].shape == (4, 16, 16)
+    assert up["mag"][1].shape == (4, 32, 32)
+    # The blob moves one full-resolution pixel per frame at either resolution.
+    peak = (slice(None), slice(12, 20), slice(8, 24))
+    half_peak = (slice(None), slice(6, 10), slice(4, 12))
+    assert abs(half["mag"][1][half_peak].max() - full["mag"][1][peak].max()) < 0.2
+    np.testing.assert_allclose(half["div"][1].mean(), full["div"][1].mean(), atol=0.05)
+    with pytest.raises(ValueError, match="downscale must be one of"):
+        build_defmap_stack(synthetic_zstack_dir, tmp_path / "x", downscale=3)
+
+
+@pytest.mark.parametrize("out_of_core", [False, True])
+def test_chunked_stack_format(
+    synthetic_zstack_dir: Path, tmp_path: Path, out_of_core: bool
+) -> None:
+    out = tmp_path / "chunked"
+    chunked = build_defmap_stack(
+        synthetic_zstack_dir,
+        out,
+        metric="div",
+        sigma=1.0,
+        stack_format="chunked",
+        out_of_core=out_of_core,
+        resume=out_of_core,
+    )
+    assert sorted(p.name for p in out.iterdir()) == [
+        f"defmap_stack_Z{z}_div.dmz" for z in (1, 2, 3)
+    ]
+    reader = chunked[1]
+    assert isinstance(reader, ChunkedStack)
+    assert reader.meta["metric"] == "div" and reader.meta["sigma"] == 1.0
+    reference = build_defmap_stack(synthetic_zstack_dir, tmp_path / "npy", metric="div", sigma=1.0)
+    assert reader.shape == reference[1].shape
+    np.testing.assert_allclose(np.asarray(reader), reference[1], atol=2e-3)
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"out_of_core": True}, {"resume": True}])
+def test_chunked_run_keeps_existing_npy_stacks(
+    synthetic_zstack_dir: Path, tmp_path: Path, kwargs: dict[str, bool]
+) -> None:
+    out = tmp_path / "out"
+    npy = build_defmap_stacks(synthetic_zstack_dir, out, metrics="div")
+    before = {z: np.array(stack) for z, stack in npy["div"].items()}
+
+    build_defmap_stacks(synthetic_zstack_dir, out, metrics="div", stack_format="chunked", **kwargs)
+
+    for z, stack in before.items():
+        np.testing.assert_array_equal(np.load(out / f"defmap_stack_Z{z}_div.npy"), stack)
+        assert (out / f"defmap_stack_Z{z}_div.dmz").exists()
+    assert not list(out.glob("*.partial*"))
@@ -0,0 +1,99 @@
+"""Tests for btflow.flow."""
+
+from __future__ import annotations
+
+from itertools import pairwise
+
+import cv2
+import numpy as np
+import pytest
+
+from btflow.flow import (
+    ENGINES,
+    FLOW_KWARGS,
+    TiledFlow,
+    WarmStartFlow,
+    benchmark_engines,
+    endpoint_error,
+    engine_params,
+    make_engine,
+    synthetic_flow_pair,
+    tile_halo,
+)
+
+
+def test_engine_params_defaults_and_errors() -> None:
+    assert engine_params("farneback") == FLOW_KWARGS
+    assert engine_params("dis") == {"preset": "medium"}
+    with pytest.raises(ValueError, match="flow engine must be one of"):
+        engine_params("horn-schunck")
+    with pytest.raises(ValueError, match="preset for 'dis' must be one of"):
+        engine_params("dis", "thesis")
+
+
+def test_farneback_engine_matches_opencv_call(rng: np.random.Generator) -> None:
+    f1, f2, _ = synthetic_flow_pair(64, 64, rng)
+    expected = cv2.calcOpticalFlowFarneback(f1, f2, None, **FLOW_KWARGS)  # type: ignore[call-overload]
+    np.testing.assert_array_equal(make_engine("farneback")(f1, f2), expected)
+
+
+@pytest.mark.parametrize("engine", ["farneback", "dis"])
+def test_engines_recover_synthetic_flow(rng: np.random.Generator, engine: str) -> None:
+    f1, f2, truth = synthetic_flow_pair(128, 128, rng)
+    flow = make_engine(engine)(f1, f2)
+    assert flow.shape == (128, 128, 2) and flow.dtype == np.float32
+    assert endpoint_error(flow, truth, margin=16) < 0.3
+    # Sanity check of the metric itself: zero flow is off by the mean displacement.
+    assert endpoint_error(np.zeros_like(truth), truth, margin=16) > 0.5
+
+
+def test_tvl1_requires_contrib_build() -> None:
+    if hasattr(cv2, "optflow"):
+        pytest.skip("opencv-contrib-python is installed")
+    with pytest.raises(RuntimeError, match="opencv-contrib-python"):
+        make_engine("tvl1")
+
+
+def test_benchmark_reports_fps_and_epe() -> None:
+    rows = benchmark_engines([("farneback", None), ("dis", "ultrafast")], size=(64, 64), n_pairs=2)
+    assert [(r["engine"], r["preset"]) for r in rows] == [
+        ("farneback", "thesis"),
+        ("dis", "ultrafast"),
+    ]
+    assert all(r["fps"] > 0 and np.isfinite(r["epe"]) for r in rows)
+    assert set(ENGINES) >= {r["engine"] for r in rows}
+
+
+def test_warm_start_tracks_cold_start_and_reports_drift(rng: np.random.Generator) -> None:
+    f1, f2, truth = synthetic_flow_pair(128, 128, rng)
+    # Continue the sequence with the same flow field applied over and over.
+    yy, xx = np.mgrid[0:128, 0:128].astype(np.float32)
+    map_x, map_y = xx - truth[..., 0], yy - truth[..., 1]
+    frames = [f1, f2]
+    for _ in range(3):
+        frames.append(cv2.remap(frames[-1], map_x, map_y, cv2.INTER_LINEAR))
+
+    warm = WarmStartFlow(check_every=2)
+    cold = make_engine("farneback")
+    for g1, g2 in pairwise(frames):
+        assert endpoint_error(warm(g1, g2), cold(g1, g2), margin=16) < 0.1
+    # Pair 0 starts cold; pair 2 is the only drift check among pairs 0..3.
+    assert len(warm.drift) == 1 and warm.drift[0] < 0.1
+
+
+@pytest.mark.parametrize("tile", [96, 128, 200])
+def test_tiled_flow_seam_error_against_untiled(rng: np.random.Generator, tile: int) -> None:
+    f1, f2, _ = synthetic_flow_pair(400, 400, rng, amplitude=3.0)
+    full = make_engine("farneback")(f1, f2)
+    tiled = TiledFlow("farneback", tile=tile, threads=2)(f1, f2)
+    seam = np.linalg.norm(tiled - full, axis=-1)
+    assert seam.mean() < 1e-3
+    assert seam.max() < 0.05
+
+
+def test_tiled_flow_halo_and_other_engines(rng: np.random.Generator) -> None:
+    assert tile_halo("farneback") == 48  # (15 // 2 + 5) / 0.5**2
+    f1, f2, truth = synthetic_flow_pair(160, 160, rng)
+    flow = TiledFlow("dis", "fast", tile=64, threads=2)(f1, f2)
+    assert flow.shape == (160, 160, 2) and np.isfinite(flow).all()
+    assert endpoint_error(flow, truth, margin=16) < 0.5
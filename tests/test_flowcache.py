@@ -0,0 +1,65 @@
+"""Unit tests for the on-disk optical-flow cache."""
+
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+import numpy as np
+
+from btflow.flowcache import FlowCache, file_digest
+
+
+def test_put_get_round_trip_in_float16(tmp_path: Path, rng: np.random.Generator) -> None:
+    cache = FlowCache(tmp_path / "cache")
+    flow = rng.normal(0, 2, size=(8, 8, 2)).astype(np.float32)
+    key = cache.key("a", "b", {"channel": None})
+    assert key not in cache
+    assert cache.get(key) is None
+    stored = cache.put(key, flow)
+    assert key in cache
+    restored = cache.get(key)
+    assert restored is not None and restored.dtype == np.float32
+    np.testing.assert_allclose(restored, flow, atol=1e-2)
+    np.testing.assert_array_equal(stored, restored)
+
+
+def test_key_depends_on_frames_and_params(tmp_path: Path) -> None:
+    cache = FlowCache(tmp_path)
+    base = cache.key("a", "b", {"channel": None, "crop": None})
+    assert cache.key("a", "b", {"crop": None, "channel": None}) == base
+    assert cache.key("b", "a", {"channel": None, "crop": None}) != base
+    assert cache.key("a", "b", {"channel": 1, "crop": None}) != base
+
+
+def test_file_digest_tracks_content(tmp_path: Path) -> None:
+    f = tmp_path / "frame.png"
+    f.write_bytes(b"one")
+    first = file_digest(f)
+    f.write_bytes(b"two")
+    assert file_digest(f) != first
+
+
+def test_lru_eviction_keeps_recently_used_entries(tmp_path: Path) -> None:
+    flow = np.zeros((16, 16, 2), dtype=np.float32)
+    entry_bytes = FlowCache(tmp_path / "probe").dtype.itemsize * flow.size + 128
+    cache = FlowCache(tmp_path / "cache", max_bytes=2 * entry_bytes)
+    keys = [cache.key(str(i), "x", {}) for i in range(3)]
+    cache.put(keys[0], flow)
+    cache.put(keys[1], flow)
+    # Age both entries, then touch the first so the second is least recently used.
+    for k in keys[:2]:
+        os.utime(cache._path(k), (1, 1))
+    assert cache.get(keys[0]) is not None
+    cache.put(keys[2], flow)
+    assert keys[0] in cache
+    assert keys[1] not in cache
+    assert keys[2] in cache
+
+
+def test_overwriting_a_key_counts_its_size_once(tmp_path: Path) -> None:
+    cache = FlowCache(tmp_path / "cache")
+    key = cache.key("a", "b", {})
+    for _ in range(3):
+        cache.put(key, np.zeros((16, 16, 2), dtype=np.float32))
+    assert cache._size == cache._path(key).stat().st_size
@@ -0,0 +1,58 @@
+"""Unit tests for the prefetching frame source."""
+
+from __future__ import annotations
+
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+from btflow.frames import FrameSource, read_plane
+
+
+def test_frame_source_yields_every_frame_in_order(synthetic_zstack_dir: Path) -> None:
+    paths = sorted(synthetic_zstack_dir.glob("*_z0001.png"))
+    with FrameSource(paths, prefetch=2) as source:
+        frames = list(source)
+    assert len(frames) == len(paths) == 5
+    for path, frame in zip(paths, frames, strict=True):
+        np.testing.assert_array_equal(frame, cv2.imread(str(path), cv2.IMREAD_GRAYSCALE))
+
+
+def test_read_plane_channel_and_crop_match_split(synthetic_rgb_dir: Path) -> None:
+    path = sorted(synthetic_rgb_dir.glob("*.png"))[0]
+    plane = read_plane(path, channel=1, crop=(2, 4, 10, 8))
+    expected = cv2.split(cv2.imread(str(path)))[1][4:12, 2:12]
+    assert plane.flags.c_contiguous
+    np.testing.assert_array_equal(plane, expected)
+
+
+def test_read_plane_downscale_scales_image_and_crop(synthetic_rgb_dir: Path) -> None:
+    path = sorted(synthetic_rgb_dir.glob("*.png"))[0]
+    full = read_plane(path, channel=2)
+    half = read_plane(path, channel=2, crop=(4, 8, 16, 12), downscale=2)
+    assert half.shape == (6, 8)
+    # IMREAD_REDUCED_* averages 2x2 blocks of the full-resolution plane.
+    blocks = full.reshape(16, 2, 16, 2).mean(axis=(1, 3))[4:10, 2:10]
+    np.testing.assert_allclose(half, blocks, atol=1)
+    assert read_plane(path, downscale=4).shape == (8, 8)
+    with pytest.raises(ValueError, match="downscale must be one of"):
+        read_plane(path, downscale=3)
+
+
+def test_frame_source_forwards_read_errors(tmp_path: Path) -> None:
+    with (
+        FrameSource([tmp_path / "missing.png"]) as source,
+        pytest.raises(FileNotFoundError, match="Could not read image"),
+    ):
+        list(source)
+
+
+def test_frame_source_close_stops_reader_early(synthetic_zstack_dir: Path) -> None:
+    paths = sorted(synthetic_zstack_dir.glob("*.png"))
+    source = FrameSource(paths, prefetch=1)
+    first = next(iter(source))
+    source.close()
+    assert first.shape == (32, 32)
+    assert source._thread is not None and not source._thread.is_alive()
@@ -0,0 +1,71 @@
+"""Unit tests for the summed-area-table index over DefMap stacks."""
+
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from btflow.integral import IntegralStack
+from btflow.stackio import save_chunked
+
+
+@pytest.fixture
+def stack(rng: np.random.Generator) -> np.ndarray:
+    return rng.normal(1.0, 2.0, size=(5, 23, 31)).astype(np.float32)
+
+
+def test_box_stats_match_direct_computation(
+    stack: np.ndarray, rng: np.random.Generator, tmp_path: Path
+) -> None:
+    t = rng.integers(0, 5, 200)
+    x = rng.integers(0, 31, 200)
+    y = rng.integers(0, 23, 200)
+    r = rng.integers(0, 12, 200)
+    for integral in (IntegralStack.build(stack), IntegralStack.build(stack, tmp_path / "s.sat")):
+        mean, var = integral.box_stats(t, x, y, r)
+        for k in range(200):
+            box = stack[
+                t[k], max(0, y[k] - r[k]) : y[k] + r[k] + 1, max(0, x[k] - r[k]) : x[k] + r[k] + 1
+            ].astype(np.float64)
+            assert mean[k] == pytest.approx(box.mean(), abs=1e-12)
+            assert var[k] == pytest.approx(box.var(), abs=1e-9)
+
+    # Scalars broadcast against arrays; boxes entirely off-frame are NaN.
+    mean, _ = IntegralStack.load(tmp_path / "s.sat").box_stats(2, np.array([5, 40]), 5, 1)
+    assert mean[0] == pytest.approx(stack[2, 4:7, 4:7].mean(dtype=np.float64), abs=1e-12)
+    assert np.isnan(mean[1])
+
+
+def test_for_stack_caches_tables_in_sat_dir(stack: np.ndarray, tmp_path: Path) -> None:
+    data, cache = tmp_path / "data", tmp_path / "cache"
+    data.mkdir()
+    npy = data / "defmap_stack_Z1_div.npy"
+    np.save(npy, stack)
+    first = IntegralStack.for_stack(npy, cache)
+    assert sorted(p.name for p in data.iterdir()) == [npy.name]
+    (sat,) = cache.glob("defmap_stack_Z1_div-*.sat")
+    assert first.shape == stack.shape
+    built = sat.stat().st_mtime_ns
+    IntegralStack.for_stack(npy, cache)
+    assert sat.stat().st_mtime_ns == built
+
+    # A rewritten stack invalidates its tables.
+    np.save(npy, stack * 2)
+    os.utime(sat, ns=(built - 10**9, built - 10**9))
+    mean, _ = IntegralStack.for_stack(npy, cache).box_stats(0, 3, 3, 0)
+    assert mean == pytest.approx(2 * stack[0, 3, 3])
+
+    # A stack of the same name elsewhere gets its own tables.
+    other = tmp_path / "other" / npy.name
+    other.parent.mkdir()
+    np.save(other, stack * 3)
+    mean, _ = IntegralStack.for_stack(other, cache).box_stats(0, 3, 3, 0)
+    assert mean == pytest.approx(3 * stack[0, 3, 3])
+    assert len(list(cache.glob("*.sat"))) == 2
+
+    dmz = save_chunked(data / "c.dmz", stack, quantize="int16")
+    mean, _ = IntegralStack.for_stack(dmz, cache).box_stats(4, 30, 22, 2)
+    assert mean == pytest.approx(stack[4, 20:, 28:].mean(dtype=np.float64), abs=1e-3)
@@ -2,11 +2,14 @@
 
 from __future__ import annotations
 
+import struct
 from pathlib import Path
 
+import cv2
+import numpy as np
 import pytest
 
-from btflow.io import group_frames_by_z_t, load_yolo_labels, parse_frame_filename
+from btflow.io import group_frames_by_z_t, image_size, load_yolo_labels, parse_frame_filename
 
 
 @pytest.mark.parametrize(
@@ -39,3 +42,43 @@ def test_load_yolo_labels_pixel_conversion(tmp_path: Path) -> None:
 
 def test_load_yolo_labels_returns_empty_when_missing(tmp_path: Path) -> None:
     assert load_yolo_labels(tmp_path / "missing.txt", 10, 10) == []
+
+
+@pytest.mark.parametrize("ext", ["png", "tif", "jpg"])
+def test_image_size_matches_decoded_shape(tmp_path: Path, ext: str) -> None:
+    path = tmp_path / f"frame.{ext}"
+    cv2.imwrite(str(path), np.zeros((37, 53, 3), dtype=np.uint8))
+    assert image_size(path) == (53, 37)
+
+
+@pytest.mark.parametrize(
+    "order, big, typ",
+    [("<", False, 3), (">", False, 4), ("<", True, 16), (">", True, 3)],
+)
+def test_image_size_reads_tiff_tags(tmp_path: Path, order: str, big: bool, typ: int) -> None:
+    # Minimal headers: one IFD with an unrelated tag, ImageWidth and ImageLength.
+    magic = (b"II" if order == "<" else b"MM") + struct.pack(order + "H", 43 if big else 42)
+    value_fmt = {3: "H", 4: "I", 16: "Q"}[typ]
+    slot = 8 if big else 4
+    entries = b""
+    for tag, value in ((254, 0), (256, 70000 if typ != 3 else 640), (257, 480)):
+        field = struct.pack(order + value_fmt, value).ljust(slot, b"\0")
+        head = struct.pack(order + ("HHQ" if big else "HHI"), tag, typ, 1)
+        entries += head + field
+    if big:
+        data = magic + struct.pack(order + "HHQ", 8, 0, 16) + struct.pack(order + "Q", 3)
+    else:
+        data = magic + struct.pack(order + "I", 8) + struct.pack(order + "H", 3)
+    path = tmp_path / "frame.tif"
+    path.write_bytes(data + entries)
+
+    assert image_size(path) == (70000 if typ != 3 else 640, 480)
+
+
+def test_image_size_errors(tmp_path: Path) -> None:
+    with pytest.raises(FileNotFoundError):
+        image_size(tmp_path / "missing.png")
+    broken = tmp_path / "broken.tif"
+    broken.write_bytes(b"II*\x00" + struct.pack("<I", 8))
+    with pytest.raises(ValueError, match="TIFF"):
+        image_size(broken)
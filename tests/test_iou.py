@@ -4,9 +4,17 @@ from __future__ import annotations
 
 import math
 
+import numpy as np
 import pytest
 
-from btflow.iou import calculate_iou
+from btflow.iou import (
+    calculate_iou,
+    calculate_iou_batch,
+    calculate_iou_matrix,
+    candidate_pairs,
+    pad_boxes,
+    sparse_iou,
+)
 
 
 def test_identical_boxes_iou_is_one() -> None:
@@ -32,3 +40,71 @@ def test_iou_is_symmetric() -> None:
     a = (3, 7, 12, 9)
     b = (5, 6, 10, 11)
     assert calculate_iou(a, b) == pytest.approx(calculate_iou(b, a))
+
+
+def _random_boxes(rng: np.random.Generator, n: int) -> np.ndarray:
+    # Small coordinates so that overlaps, shared edges and zero-size boxes all occur.
+    xy = rng.integers(0, 20, size=(n, 2))
+    wh = rng.integers(0, 8, size=(n, 2))
+    return np.concatenate([xy, wh], axis=1)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_iou_matrix_matches_scalar_function(seed: int) -> None:
+    rng = np.random.default_rng(seed)
+    a, b = _random_boxes(rng, 40), _random_boxes(rng, 30)
+    expected = [[calculate_iou(tuple(p), tuple(q)) for q in b] for p in a]
+
+    ious = calculate_iou_matrix(a, b)
+
+    assert ious.shape == (40, 30)
+    np.testing.assert_array_equal(ious, expected)
+    assert np.all((ious >= 0) & (ious <= 1))
+    np.testing.assert_array_equal(calculate_iou_matrix(b, a), ious.T)
+
+
+def test_iou_matrix_handles_empty_and_zero_area_boxes() -> None:
+    assert calculate_iou_matrix([], [(0, 0, 5, 5)]).shape == (0, 1)
+    assert calculate_iou_matrix([(0, 0, 0, 0)], [(0, 0, 0, 0), (0, 0, 2, 2)]).tolist() == [
+        [0.0, 0.0]
+    ]
+    with pytest.raises(ValueError, match="boxes"):
+        calculate_iou_matrix(np.zeros((3, 3)), np.zeros((2, 4)))
+
+
+def test_iou_batch_matches_per_frame_matrices(rng: np.random.Generator) -> None:
+    frames_a = [_random_boxes(rng, n) for n in (3, 0, 7, 5)]
+    frames_b = [_random_boxes(rng, n) for n in (4, 2, 0, 6)]
+    boxes_a, counts_a = pad_boxes(frames_a)
+    boxes_b, counts_b = pad_boxes(frames_b)
+
+    ious = calculate_iou_batch(boxes_a, boxes_b)
+
+    assert ious.shape == (4, 7, 6)
+    assert counts_a.tolist() == [3, 0, 7, 5]
+    assert counts_b.tolist() == [4, 2, 0, 6]
+    for f, (a, b) in enumerate(zip(frames_a, frames_b, strict=True)):
+        np.testing.assert_array_equal(ious[f, : len(a), : len(b)], calculate_iou_matrix(a, b))
+        # Padding never overlaps anything.
+        assert not ious[f, len(a) :].any()
+        assert not ious[f, :, len(b) :].any()
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_sweep_finds_exactly_the_overlapping_pairs(seed: int) -> None:
+    rng = np.random.default_rng(seed)
+    a, b = _random_boxes(rng, 60), _random_boxes(rng, 45)
+    matrix = calculate_iou_matrix(a, b)
+
+    rows, cols = candidate_pairs(a, b)
+    sweep = sparse_iou(a, b, "sweep")
+    dense = sparse_iou(a, b, "dense")
+
+    assert sorted(zip(rows.tolist(), cols.tolist(), strict=True)) == list(
+        zip(*np.nonzero(matrix), strict=True)
+    )
+    for r, c, iou in (sweep, dense):
+        assert np.all(np.diff(r) >= 0)
+        np.testing.assert_array_equal(iou, matrix[r, c])
+        assert len(r) == np.count_nonzero(matrix)
+    assert [x.size for x in candidate_pairs(a[:0], b)] == [0, 0]
@@ -4,9 +4,20 @@ from __future__ import annotations
 
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import pytest
+from scipy.stats import pearsonr
 
-from btflow.lagcorr import run_lagcorr
+from btflow.lagcorr import (
+    DEFAULT_SCALES_MAG,
+    LagStats,
+    _collect_rows,
+    _load_detections,
+    run_lagcorr,
+    run_lagcorr_stacks,
+)
+from btflow.stackio import save_chunked
 
 
 def test_lagcorr_produces_expected_artifacts(
@@ -25,7 +36,257 @@ def test_lagcorr_produces_expected_artifacts(
     assert csv_path.exists()
     df = pd.read_csv(csv_path)
     assert set(df.columns) >= {"frame", "lag", "conf", "value", "scale"}
-    assert (out / "lag_corr_stats_Z1_all.csv").exists()
+    assert (out / "lag_corr_stats_div_Z1_all.csv").exists()
     assert (out / "lag_div_curve_Z1_all.png").exists()
     assert (out / "lag_div_curve_avg_Z1_all.png").exists()
     assert (out / "lag_corr_significant_div_Z1_all.png").exists()
+
+
+def test_labels_without_confidence_are_kept(synthetic_defmap_stack: Path, tmp_path: Path) -> None:
+    labels = tmp_path / "labels"
+    labels.mkdir()
+    (labels / "frame_001.txt").write_text("0 0.5 0.5 0.2 0.2\n")
+    (labels / "frame_002.txt").write_text("0 0.5 0.5 0.2 0.2 0.3\n")
+    (labels / "frame_003.txt").write_text("0 0.5 0.5 0.2 0.2 0.9\n")
+
+    df = pd.read_csv(run_lagcorr(synthetic_defmap_stack, labels, tmp_path / "out", conf_min=0.5))
+
+    assert set(df["frame"]) == {1, 3}
+    assert df.loc[df["frame"] == 1, "conf"].isna().all()
+
+
+def test_lagcorr_accepts_chunked_stacks(
+    synthetic_defmap_stack: Path,
+    synthetic_yolo_labels: Path,
+    tmp_path: Path,
+) -> None:
+    chunked = save_chunked(
+        synthetic_defmap_stack.with_suffix(".dmz"),
+        np.load(synthetic_defmap_stack),
+        chunks=(2, 8, 8),
+        quantize="int16",
+    )
+    tables = [
+        pd.read_csv(
+            run_lagcorr(path, synthetic_yolo_labels, tmp_path / path.suffix[1:], conf_min=0.0)
+        )
+        for path in (synthetic_defmap_stack, chunked)
+    ]
+    assert len(tables[0]) == len(tables[1]) > 0
+    np.testing.assert_allclose(tables[1]["value"], tables[0]["value"], atol=1e-3)
+
+
+@pytest.mark.parametrize("roi_mode", ["exact", "fast"])
+def test_collect_rows_matches_per_detection_reference(
+    tmp_path: Path, rng: np.random.Generator, roi_mode: str
+) -> None:
+    stack = rng.normal(size=(6, 20, 24)).astype(np.float32)
+    labels = tmp_path / "labels"
+    labels.mkdir()
+    # Edge-clipped ROIs, a zero-size box, a low-confidence and an off-frame detection.
+    (labels / "frame_002.txt").write_text(
+        "0 0.02 0.5 0.2 0.1 0.9\n0 0.5 0.5 0.0 0.0 0.9\n0 0.5 0.5 0.2 0.2 0.1\n"
+    )
+    (labels / "frame_004.txt").write_text("0 0.9 0.95 0.1 0.3 0.8\n0 1.2 0.5 0.1 0.1 0.9\n")
+    (labels / "frame_005.txt").write_text("")
+    # Interior detections; in fast mode the larger ROIs are dense enough to be
+    # read from a blurred frame, the smaller ones are gathered.
+    interior = [(0.41 + 0.05 * k, 0.61 - 0.025 * k, 0.6 + 0.04 * k) for k in range(8)]
+    (labels / "frame_003.txt").write_text(
+        "".join(f"0 {x} {y} 0.1 0.1 {c}\n" for x, y, c in interior)
+    )
+    scales, lags = (1.0, 2.0), (-3, 0, 2)
+
+    expected = []
+    for scale in scales:
+        for t, x_c, y_c, bw, bh, conf in [
+            (2, 0.02, 0.5, 0.2, 0.1, 0.9),
+            *((3, x, y, 0.1, 0.1, c) for x, y, c in interior),
+            (4, 0.9, 0.95, 0.1, 0.3, 0.8),
+        ]:
+            x, y = int(x_c * 24), int(y_c * 20)
+            r = int(max(int(bw * 24), int(bh * 20)) * scale)
+            for lag in lags:
+                if not 1 <= t + lag <= 6:
+                    continue
+                patch = stack[t + lag - 1, max(0, y - r) : y + r + 1, max(0, x - r) : x + r + 1]
+                yy, xx = np.mgrid[0 : patch.shape[0], 0 : patch.shape[1]]
+                cy, cx = (patch.shape[0] - 1) / 2, (patch.shape[1] - 1) / 2
+                k = np.exp(-((xx - cx) ** 2 + (yy - cy) ** 2) / (2 * (r / 1.5) ** 2))
+                value = abs(float((patch * k).sum() / k.sum()))
+                expected.append((t, lag, conf, value, scale))
+
+    table = _collect_rows(
+        stack, _load_detections(labels), scales, lags, 0.5, use_abs=True, roi_mode=roi_mode
+    )
+    assert list(table.columns) == ["frame", "lag", "conf", "value", "scale"]
+    assert len(table) == len(expected)
+    np.testing.assert_allclose(table.to_numpy(), np.array(expected), rtol=1e-9)
+
+
+@pytest.mark.parametrize("sat_cache", [False, True])
+def test_box_roi_mode_uses_summed_area_tables(
+    synthetic_defmap_stack: Path, synthetic_yolo_labels: Path, tmp_path: Path, sat_cache: bool
+) -> None:
+    sat_dir = tmp_path / "sat" if sat_cache else None
+    csv_path = run_lagcorr(
+        synthetic_defmap_stack,
+        synthetic_yolo_labels,
+        tmp_path / "box",
+        conf_min=0.0,
+        scales=(0.5, 1.0),
+        roi_mode="box",
+        sat_dir=sat_dir,
+    )
+    # Nothing is written next to the input stack; tables only go to the cache.
+    assert not list(synthetic_defmap_stack.parent.glob("*.sat"))
+    assert len(list((tmp_path / "sat").glob("*.sat"))) == int(sat_cache)
+    table = pd.read_csv(csv_path)
+    stack = np.load(synthetic_defmap_stack).astype(np.float64)
+    # Detections sit at (16, 16) with 6-px boxes in every frame.
+    row = table[(table.frame == 3) & (table.lag == -1) & (table.scale == 1.0)].iloc[0]
+    box = stack[1, 10:23, 10:23]
+    assert row["value"] == pytest.approx(box.mean())
+    assert row["var"] == pytest.approx(box.var())
+
+
+def test_stacks_in_process_pool_match_serial_runs(
+    synthetic_defmap_stack: Path, synthetic_yolo_labels: Path, tmp_path: Path
+) -> None:
+    z2 = synthetic_defmap_stack.with_name("defmap_stack_Z2_div.npy")
+    np.save(z2, -np.load(synthetic_defmap_stack))
+    stacks = [z2, synthetic_defmap_stack]
+    serial = [
+        run_lagcorr(p, synthetic_yolo_labels, tmp_path / "serial", conf_min=0.0) for p in stacks
+    ]
+    pooled = run_lagcorr_stacks(
+        stacks, synthetic_yolo_labels, tmp_path / "pool", workers=2, conf_min=0.0
+    )
+    assert [p.name for p in pooled] == [p.name for p in serial]
+    for a, b in zip(serial, pooled, strict=True):
+        pd.testing.assert_frame_equal(pd.read_csv(a), pd.read_csv(b))
+    assert sorted(p.name for p in (tmp_path / "pool").iterdir()) == sorted(
+        p.name for p in (tmp_path / "serial").iterdir()
+    )
+
+
+def test_div_and_mag_stacks_of_one_layer_get_separate_outputs(
+    synthetic_defmap_stack: Path, synthetic_yolo_labels: Path, tmp_path: Path
+) -> None:
+    mag = synthetic_defmap_stack.with_name("defmap_stack_Z1_mag.npy")
+    np.save(mag, np.abs(np.load(synthetic_defmap_stack)))
+    stacks = [synthetic_defmap_stack, mag]
+
+    pooled = run_lagcorr_stacks(
+        stacks, synthetic_yolo_labels, tmp_path / "pool", workers=2, conf_min=0.0
+    )
+    serial_mag = run_lagcorr(mag, synthetic_yolo_labels, tmp_path / "serial", conf_min=0.0)
+
+    assert [p.name for p in pooled] == [
+        "lag_corr_table_div_Z1_all.csv",
+        "lag_corr_table_mag_Z1_all.csv",
+    ]
+    # The metric, and with it the default scales, comes from the file name.
+    pd.testing.assert_frame_equal(pd.read_csv(pooled[1]), pd.read_csv(serial_mag))
+    assert set(pd.read_csv(pooled[1])["scale"]) == set(DEFAULT_SCALES_MAG)
+    out = tmp_path / "pool"
+    for metric in ("div", "mag"):
+        assert (out / f"lag_corr_stats_{metric}_Z1_all.csv").exists()
+        assert (out / f"lag_{metric}_curve_Z1_all.png").exists()
+        assert (out / f"lag_corr_significant_{metric}_Z1_all.png").exists()
+
+    copy = tmp_path / "copy" / synthetic_defmap_stack.name
+    copy.parent.mkdir()
+    copy.write_bytes(synthetic_defmap_stack.read_bytes())
+    with pytest.raises(ValueError, match="would both write"):
+        run_lagcorr_stacks([synthetic_defmap_stack, copy], synthetic_yolo_labels, tmp_path / "dup")
+    assert not (tmp_path / "dup").exists()
+
+
+def test_curl_stack_is_not_analysed_as_div(
+    synthetic_defmap_stack: Path, synthetic_yolo_labels: Path, tmp_path: Path
+) -> None:
+    curl = synthetic_defmap_stack.with_name("defmap_stack_Z1_curl.npy")
+    np.save(curl, np.load(synthetic_defmap_stack))
+
+    with pytest.raises(ValueError, match="curl stack"):
+        run_lagcorr_stacks([curl], synthetic_yolo_labels, tmp_path / "curl")
+    with pytest.raises(ValueError, match="curl stack"):
+        run_lagcorr(curl, synthetic_yolo_labels, tmp_path / "curl")
+    assert not (tmp_path / "curl").exists()
+
+    # An explicit metric overrides the suffix.
+    (table,) = run_lagcorr_stacks(
+        [curl], synthetic_yolo_labels, tmp_path / "div", metric="div", conf_min=0.0
+    )
+    assert table.name == "lag_corr_table_div_Z1_all.csv"
+
+
+def test_lag_stats_match_materialised_table(rng: np.random.Generator) -> None:
+    n = 500
+    rows = pd.DataFrame(
+        {
+            "frame": rng.integers(1, 40, n),
+            "lag": rng.choice([-1, 0, 1], n),
+            "conf": rng.uniform(0.5, 1.0, n),
+            "value": 1e4 + rng.normal(size=n),
+            "scale": rng.choice([1.0, 2.0], n),
+        }
+    )
+    rows["value"] += 0.5 * rows["conf"]
+    # Lag 3 has two rows and lag 5 a single one.
+    rows = pd.concat(
+        [
+            rows,
+            pd.DataFrame(
+                {
+                    "frame": [1, 2, 3],
+                    "lag": [3, 3, 5],
+                    "conf": [0.6, 0.9, 0.7],
+                    "value": [1.0, 2.0, 3.0],
+                    "scale": [1.0, 2.0, 1.0],
+                }
+            ),
+        ],
+        ignore_index=True,
+    )
+    lags, scales = (-1, 0, 1, 3, 5, 7), (1.0, 2.0)
+    stats = LagStats(lags, scales)
+    for part in np.array_split(np.arange(len(rows)), 6):
+        stats.update(rows.iloc[part])
+
+    corr = stats.correlation(lags)
+    for lag in (-1, 0, 1, 3):
+        sub = rows[rows.lag == lag]
+        r, p = pearsonr(sub["value"], sub["conf"])
+        assert corr.loc[lag, "r"] == pytest.approx(r, abs=1e-9)
+        assert corr.loc[lag, "p"] == pytest.approx(p, rel=1e-6)
+    assert corr.loc[[5, 7], "r"].isna().all()
+
+    curve = stats.curve(by_scale=True).set_index(["lag", "scale"])
+    grouped = rows.groupby(["lag", "scale"])["value"]
+    np.testing.assert_allclose(curve["mean"], grouped.mean(), rtol=1e-12)
+    np.testing.assert_allclose(curve["sem"], grouped.sem(), rtol=1e-6)
+    avg = stats.curve(by_scale=False).set_index("lag")
+    np.testing.assert_allclose(avg["mean"], rows.groupby("lag")["value"].mean(), rtol=1e-12)
+    assert len(stats.frames) == rows["frame"].nunique()
+
+
+def test_lagcorr_without_row_table(
+    synthetic_defmap_stack: Path, synthetic_yolo_labels: Path, tmp_path: Path
+) -> None:
+    with_table = run_lagcorr(
+        synthetic_defmap_stack, synthetic_yolo_labels, tmp_path / "a", conf_min=0.0
+    )
+    stats_csv = run_lagcorr(
+        synthetic_defmap_stack,
+        synthetic_yolo_labels,
+        tmp_path / "b",
+        conf_min=0.0,
+        write_table=False,
+    )
+    assert stats_csv.name == "lag_corr_stats_div_Z1_all.csv"
+    assert not list((tmp_path / "b").glob("lag_corr_table_*"))
+    pd.testing.assert_frame_equal(
+        pd.read_csv(stats_csv), pd.read_csv(with_table.with_name(stats_csv.name))
+    )
@@ -7,8 +7,10 @@ from pathlib import Path
 import cv2
 import numpy as np
 import pandas as pd
+import pytest
 
-from btflow.match_labels import match_labels
+from btflow.iou import calculate_iou_matrix, sparse_iou
+from btflow.match_labels import assign_boxes, assign_pairs, match_labels
 
 
 def test_match_labels_writes_csv_with_iou_column(tmp_path: Path) -> None:
@@ -38,3 +40,177 @@ def test_match_labels_writes_csv_with_iou_column(tmp_path: Path) -> None:
     assert len(df) == 1
     assert df.iloc[0]["iou"] > 0.99
     assert (out / "frame_Z2_001.png").exists()
+
+
+def _sequential_greedy(ious: np.ndarray, threshold: float) -> list[tuple[int, int]]:
+    pairs = sorted(
+        ((-ious[i, j], i, j) for i, j in zip(*np.nonzero(ious > threshold), strict=True))
+    )
+    used_rows: set[int] = set()
+    used_cols: set[int] = set()
+    matches = []
+    for _, i, j in pairs:
+        if i not in used_rows and j not in used_cols:
+            used_rows.add(i)
+            used_cols.add(j)
+            matches.append((int(i), int(j)))
+    return sorted(matches)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_greedy_assignment_matches_sequential_reference(seed: int) -> None:
+    rng = np.random.default_rng(seed)
+    # Rounded values produce ties, which must still resolve one-to-one.
+    ious = np.round(rng.uniform(0, 1, size=(30, 25)), 1)
+
+    rows, cols = assign_boxes(ious, 0.3, "greedy")
+
+    assert list(zip(rows.tolist(), cols.tolist(), strict=True)) == _sequential_greedy(ious, 0.3)
+    assert len(set(cols.tolist())) == len(cols)
+
+
+def test_assignment_methods() -> None:
+    # Green 0 overlaps both reds; green 1 only red 0.
+    ious = np.array([[0.9, 0.8], [0.85, 0.1]])
+
+    first = assign_boxes(ious, 0.5, "first")
+    greedy = assign_boxes(ious, 0.5, "greedy")
+    optimal = assign_boxes(ious, 0.5, "optimal")
+
+    assert [c.tolist() for c in first] == [[0, 1], [0, 0]]  # red 0 claimed twice
+    assert [c.tolist() for c in greedy] == [[0], [0]]
+    assert [c.tolist() for c in optimal] == [[0, 1], [1, 0]]
+    assert [c.tolist() for c in assign_boxes(np.zeros((0, 3)), 0.5)] == [[], []]
+    with pytest.raises(ValueError, match="method"):
+        assign_boxes(ious, 0.5, "hungarian")
+
+
+@pytest.mark.parametrize("method", ["greedy", "optimal", "first"])
+def test_sparse_assignment_matches_dense(method: str, rng: np.random.Generator) -> None:
+    # A dense field of small boxes with jittered copies: many separate clusters.
+    xy = rng.integers(0, 400, size=(300, 2))
+    green = np.concatenate([xy, rng.integers(5, 20, size=(300, 2))], axis=1)
+    red = green[rng.permutation(300)] + rng.integers(-4, 5, size=(300, 4))
+    matrix = calculate_iou_matrix(green, red)
+
+    rows, cols, ious = sparse_iou(green, red, "sweep")
+    keep = assign_pairs(rows, cols, ious, 0.2, method)
+    dense_rows, dense_cols = assign_boxes(matrix, 0.2, method)
+
+    assert np.all(np.diff(rows[keep]) > 0)
+    if method == "optimal":
+        # Equal total IoU; ties may be broken differently.
+        assert ious[keep].sum() == pytest.approx(matrix[dense_rows, dense_cols].sum())
+        assert len(set(cols[keep].tolist())) == len(keep)
+    else:
+        assert rows[keep].tolist() == dense_rows.tolist()
+        assert cols[keep].tolist() == dense_cols.tolist()
+
+
+def test_match_labels_assignment_is_one_to_one(tmp_path: Path) -> None:
+    img_dir, green_dir, red_dir = (tmp_path / d for d in ("images", "green", "red"))
+    for d in (img_dir, green_dir, red_dir):
+        d.mkdir()
+    cv2.imwrite(str(img_dir / "frame_Z2_001.png"), np.zeros((100, 100, 3), dtype=np.uint8))
+    # Two green boxes both overlap the single red box.
+    (green_dir / "frame_Z2_001.txt").write_text("0 0.5 0.5 0.2 0.2 0.9\n0 0.52 0.5 0.2 0.2 0.9\n")
+    (red_dir / "frame_Z3_001.txt").write_text("0 0.51 0.5 0.2 0.2 0.9\n")
+
+    counts = {}
+    for assignment in ("first", "greedy"):
+        csv_path = match_labels(
+            image_dir=img_dir,
+            label_dir_green=green_dir,
+            label_dir_red=red_dir,
+            output_dir=tmp_path / assignment,
+            assignment=assignment,
+        )
+        counts[assignment] = len(pd.read_csv(csv_path))
+
+    assert counts == {"first": 2, "greedy": 1}
+
+
+def test_match_labels_without_annotation_never_decodes(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    img_dir, green_dir, red_dir = (tmp_path / d for d in ("images", "green", "red"))
+    for d in (img_dir, green_dir, red_dir):
+        d.mkdir()
+    for i in range(3):
+        cv2.imwrite(str(img_dir / f"frame_Z2_00{i}.png"), np.zeros((60, 80, 3), dtype=np.uint8))
+        (green_dir / f"frame_Z2_00{i}.txt").write_text("0 0.5 0.5 0.2 0.2 0.9\n")
+        (red_dir / f"frame_Z3_00{i}.txt").write_text("0 0.5 0.5 0.2 0.2 0.9\n")
+    annotated = match_labels(img_dir, green_dir, red_dir, tmp_path / "annotated")
+
+    def no_decode(*args: object) -> None:
+        raise AssertionError("image decoded")
+
+    monkeypatch.setattr(cv2, "imread", no_decode)
+    csv_only = match_labels(img_dir, green_dir, red_dir, tmp_path / "csv", annotate=False)
+
+    pd.testing.assert_frame_equal(pd.read_csv(csv_only), pd.read_csv(annotated))
+    assert len(pd.read_csv(csv_only)) == 3
+    assert sorted(p.name for p in (tmp_path / "csv").iterdir()) == ["matched_boxes.csv"]
+    assert len(list((tmp_path / "annotated").glob("*.png"))) == 3
+
+
+def test_incremental_runs_replace_changed_frames(
+    tmp_path: Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    img_dir, green_dir, red_dir = (tmp_path / d for d in ("images", "green", "red"))
+    for d in (img_dir, green_dir, red_dir):
+        d.mkdir()
+
+    def add_frame(i: int, n_boxes: int = 1) -> None:
+        cv2.imwrite(str(img_dir / f"frame_Z2_00{i}.png"), np.zeros((60, 80, 3), dtype=np.uint8))
+        lines = "".join(f"0 {0.2 + 0.3 * k} 0.5 0.1 0.1 0.9\n" for k in range(n_boxes))
+        (green_dir / f"frame_Z2_00{i}.txt").write_text(lines)
+        (red_dir / f"frame_Z3_00{i}.txt").write_text(lines)
+
+    def run() -> pd.DataFrame:
+        capsys.readouterr()
+        csv_path = match_labels(
+            img_dir, green_dir, red_dir, tmp_path / "out", annotate=False, incremental=True
+        )
+        return pd.read_csv(csv_path)
+
+    def processed() -> list[str]:
+        return [line for line in capsys.readouterr().out.splitlines() if "Processing" in line]
+
+    for i in range(3):
+        add_frame(i)
+    # Rows from an earlier non-incremental run are not duplicated.
+    match_labels(img_dir, green_dir, red_dir, tmp_path / "out", annotate=False)
+    assert len(run()) == 3
+    assert len(processed()) == 3
+
+    assert len(run()) == 3
+    assert processed() == []
+
+    add_frame(3)
+    assert len(run()) == 4
+    assert processed() == ["Processing image: frame_Z2_003.png"]
+
+    add_frame(1, n_boxes=3)
+    (img_dir / "frame_Z2_000.png").unlink()
+    df = run()
+    assert processed() == ["Processing image: frame_Z2_001.png"]
+    assert df["filename"].value_counts().to_dict() == {
+        "frame_Z2_001.png": 3,
+        "frame_Z2_002.png": 1,
+        "frame_Z2_003.png": 1,
+    }
+
+    # New match parameters re-match everything.
+    capsys.readouterr()
+    match_labels(
+        img_dir,
+        green_dir,
+        red_dir,
+        tmp_path / "out",
+        annotate=False,
+        incremental=True,
+        assignment="optimal",
+    )
+    assert len(processed()) == 3
+    assert len(pd.read_csv(tmp_path / "out" / "matched_boxes.csv")) == 5
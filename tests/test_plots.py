@@ -7,6 +7,7 @@ from pathlib import Path
 import pandas as pd
 
 from btflow.plots.confidence_kde import plot_confidence_kde
+from btflow.plots.defmap_video import render_defmap_video
 from btflow.plots.heatmap import plot_center_heatmap
 from btflow.plots.iou_boxplot import plot_iou_boxplot
 
@@ -43,3 +44,9 @@ def test_iou_boxplot_writes_png(tmp_path: Path) -> None:
     out = tmp_path / "iou.png"
     plot_iou_boxplot(csvs=[(csv_a, "A"), (csv_b, "B")], out_path=out)
     assert out.exists() and out.stat().st_size > 0
+
+
+def test_defmap_video_renders_saved_stack(synthetic_defmap_stack: Path) -> None:
+    out = render_defmap_video(synthetic_defmap_stack, fps=4.0)
+    assert out == synthetic_defmap_stack.with_suffix(".mp4")
+    assert out.exists() and out.stat().st_size > 0
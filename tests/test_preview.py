@@ -0,0 +1,67 @@
+"""Tests for the LUT-based DefMap preview renderer."""
+
+from __future__ import annotations
+
+from pathlib import Path
+
+import cv2
+import matplotlib
+import numpy as np
+import pytest
+from matplotlib.colors import Normalize
+
+from btflow.preview import PngPreviewWriter, VideoPreviewWriter, colorize, render_stack_video
+
+
+def test_colorize_matches_matplotlib(rng: np.random.Generator) -> None:
+    data = rng.normal(0, 3, size=(24, 24)).astype(np.float32)
+    ours = colorize(data, -4.0, 4.0, "coolwarm")
+    mapper = matplotlib.cm.ScalarMappable(norm=Normalize(-4.0, 4.0), cmap="coolwarm")
+    expected = mapper.to_rgba(data, bytes=True)[..., 2::-1]
+    np.testing.assert_array_equal(ours, expected)
+
+
+def test_png_writer_writes_all_frames(tmp_path: Path, rng: np.random.Generator) -> None:
+    frames = [rng.normal(0, 1, size=(16, 20)).astype(np.float32) for _ in range(12)]
+    with PngPreviewWriter("coolwarm", threads=2, max_pending=2) as writer:
+        for i, data in enumerate(frames):
+            writer.submit(data, tmp_path / f"p_{i:03d}.png", 0.0, 4.0)
+    for i, data in enumerate(frames):
+        img = cv2.imread(str(tmp_path / f"p_{i:03d}.png"))
+        np.testing.assert_array_equal(img, colorize(data, 0.0, 4.0, "coolwarm"))
+
+
+def test_png_writer_surfaces_write_errors(tmp_path: Path) -> None:
+    writer = PngPreviewWriter("coolwarm")
+    writer.submit(np.zeros((4, 4), np.float32), tmp_path / "missing" / "p.png", -1.0, 1.0)
+    with pytest.raises(OSError, match="Could not write preview"):
+        writer.close()
+
+
+def _count_frames(path: Path) -> int:
+    cap = cv2.VideoCapture(str(path))
+    n = 0
+    while cap.read()[0]:
+        n += 1
+    cap.release()
+    return n
+
+
+def test_video_writer_encodes_every_frame(tmp_path: Path, rng: np.random.Generator) -> None:
+    stack = rng.normal(0, 2, size=(7, 32, 48)).astype(np.float32)
+    out = tmp_path / "stack.mp4"
+    assert render_stack_video(stack, out, -4.0, 4.0, fps=5.0) == 7
+    assert _count_frames(out) == 7
+    cap = cv2.VideoCapture(str(out))
+    assert (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))) == (
+        48,
+        32,
+    )
+    cap.release()
+
+
+def test_video_writer_surfaces_open_errors(tmp_path: Path) -> None:
+    writer = VideoPreviewWriter(tmp_path / "missing" / "x.mp4", "coolwarm", -1.0, 1.0)
+    writer.write(np.zeros((16, 16), np.float32))
+    with pytest.raises(OSError, match="Could not open video"):
+        writer.close()
@@ -0,0 +1,91 @@
+"""Unit tests for the chunked DefMap stack format."""
+
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from btflow.stackio import ChunkedStack, grow_npy, open_stack, save_chunked
+
+
+@pytest.fixture
+def stack(rng: np.random.Generator) -> np.ndarray:
+    return rng.normal(0, 2, size=(11, 37, 29)).astype(np.float32)
+
+
+@pytest.mark.parametrize(("quantize", "atol"), [("float16", 4e-3), ("int16", 2e-4)])
+def test_round_trip_within_quantisation_error(
+    stack: np.ndarray, tmp_path: Path, quantize: str, atol: float
+) -> None:
+    path = save_chunked(
+        tmp_path / "s.dmz", stack, chunks=(4, 16, 16), quantize=quantize, meta={"metric": "div"}
+    )
+    with ChunkedStack(path) as reader:
+        assert reader.shape == stack.shape and len(reader) == 11
+        assert reader.meta == {"metric": "div"}
+        np.testing.assert_allclose(np.asarray(reader), stack, atol=atol, rtol=1e-3)
+
+
+@pytest.mark.parametrize(
+    "key",
+    [
+        3,
+        -1,
+        (2, slice(5, 30), slice(20, 29)),
+        (slice(1, 9, 3), 7),
+        (slice(None, None, -2), slice(3, 4), -5),
+        (slice(8, 2),),
+    ],
+)
+def test_indexing_matches_numpy(stack: np.ndarray, tmp_path: Path, key: object) -> None:
+    path = save_chunked(tmp_path / "s.dmz", stack, chunks=(4, 16, 16))
+    expected = stack.astype(np.float16).astype(np.float32)[key]  # type: ignore[index]
+    got = ChunkedStack(path)[key]
+    assert got.shape == expected.shape
+    np.testing.assert_array_equal(got, expected)
+
+
+def test_reads_only_touched_chunks(stack: np.ndarray, tmp_path: Path) -> None:
+    path = save_chunked(tmp_path / "s.dmz", stack, chunks=(4, 16, 16))
+    reader = ChunkedStack(path)
+    reader[5, 18:20, 3:5]
+    assert list(reader._cache) == [(1, 1, 0)]
+    reader[5:7, 14:18, 3]
+    assert sorted(reader._cache) == [(1, 0, 0), (1, 1, 0)]
+
+
+def test_rejects_other_files_and_open_stack_dispatches(stack: np.ndarray, tmp_path: Path) -> None:
+    np.save(tmp_path / "s.npy", stack)
+    assert isinstance(open_stack(tmp_path / "s.npy"), np.ndarray)
+    assert isinstance(open_stack(save_chunked(tmp_path / "s.dmz", stack)), ChunkedStack)
+    (tmp_path / "bad.dmz").write_bytes(b"not a stack at all")
+    with pytest.raises(ValueError, match="not a chunked DefMap stack"):
+        ChunkedStack(tmp_path / "bad.dmz")
+    with pytest.raises(ValueError, match="quantize must be one of"):
+        save_chunked(tmp_path / "x.dmz", stack, quantize="int8")
+
+
+def test_grow_npy_in_place_and_by_copy(stack: np.ndarray, tmp_path: Path) -> None:
+    path = tmp_path / "s.npy"
+    np.save(path, stack)
+    size = path.stat().st_size
+    grow_npy(path, 20)
+    grown = np.load(path)
+    assert grown.shape == (20, 37, 29)
+    assert path.stat().st_size == size + 9 * stack[0].nbytes
+    np.testing.assert_array_equal(grown[:11], stack)
+    assert not grown[11:].any()
+
+    # A header without growth padding forces the copying fallback.
+    header = b"{'descr': '<f4', 'fortran_order': False, 'shape': (11, 37, 29)}\n"
+    tight = tmp_path / "tight.npy"
+    tight.write_bytes(b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header)
+    with tight.open("ab") as f:
+        f.write(stack.tobytes())
+    grow_npy(tight, 1000)
+    assert np.load(tight, mmap_mode="r").shape == (1000, 37, 29)
+    np.testing.assert_array_equal(np.load(tight, mmap_mode="r")[:11], stack)
+    with pytest.raises(ValueError, match="Cannot grow"):
+        grow_npy(path, 5)